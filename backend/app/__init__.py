@@ -1,16 +1,25 @@
+import asyncio
 from contextlib import asynccontextmanager
 from typing import AsyncIterator
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from sentence_transformers import CrossEncoder
 
 from .chat import router as chat_router
-from .config import CROSS_ENCODER_MODEL, USE_CROSS_ENCODER
+from .chat.config import CHAT_WRITE_BEHIND_ENABLED
+from .config import CROSS_ENCODER_MODEL, LLM_PRELOAD, USE_CROSS_ENCODER
 from .feedback import router as feedback_router
 from .history import router as history_router
 from .ingestion import router as ingestion_router
+from .monitoring import router as monitoring_router
 from .search import router as search_router
+from .services.utils.chat_writer import get_chat_writer
+from .services.utils.completion import preload_llm_models
+from .services.utils.llm_gateway import LLMOverloadedError
+from .services.utils.metrics import HTTPMetricsMiddleware
+from .services.utils.tracing import TracingMiddleware, get_slowest_traces
 from .utils import setup_logger
 
 logger = setup_logger()
@@ -29,8 +38,22 @@ async def lifespan(app: FastAPI) -> AsyncIterator[None]:
             CROSS_ENCODER_MODEL,
         )
 
+    if CHAT_WRITE_BEHIND_ENABLED == "True":
+        await get_chat_writer().start()
+
+    if LLM_PRELOAD == "True":
+        # Load the LLMs in the background, without holding up startup
+        app.state.llm_preload = asyncio.create_task(preload_llm_models())
+
     yield
 
+    if CHAT_WRITE_BEHIND_ENABLED == "True":
+        # Write everything queued before the process exits
+        await get_chat_writer().stop()
+
+    # Export the slowest traces of the hour so far
+    get_slowest_traces().flush()
+
     logger.info("Application finished")
 
 
@@ -45,6 +68,9 @@ def create_app() -> FastAPI:
     app.include_router(chat_router)
     app.include_router(history_router)
     app.include_router(feedback_router)
+    app.include_router(monitoring_router)
+
+    app.add_exception_handler(LLMOverloadedError, llm_overloaded_handler)
 
     origins = [
         "http://localhost",
@@ -58,4 +84,20 @@ def create_app() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    app.add_middleware(TracingMiddleware)
+    app.add_middleware(HTTPMetricsMiddleware)
     return app
+
+
+async def llm_overloaded_handler(request: Request, exc: Exception) -> JSONResponse:
+    """
+    Reject requests with a 429 when the LLM is overloaded, telling clients when
+    to retry.
+    """
+    if not isinstance(exc, LLMOverloadedError):
+        raise exc
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
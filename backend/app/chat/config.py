@@ -2,3 +2,77 @@ import os
 
 N_TOP_CONTENT = int(os.getenv("N_TOP_CONTENT", 10))
 N_TOP_RERANK = int(os.getenv("N_TOP_RERANK", 5))
+# Number of exchanges not yet in the rolling summary after which a message is
+# always refined, so the summary catches up. Normally only the newest exchange is
+# new.
+N_RECENT_TURNS = int(os.getenv("N_RECENT_TURNS", 3))
+# Refinement gate: messages that look self-contained are not refined, saving an
+# LLM call. Messages shorter than this number of words are always refined.
+REFINEMENT_GATE_ENABLED = os.getenv("REFINEMENT_GATE_ENABLED", "True")
+REFINEMENT_GATE_MIN_WORDS = int(os.getenv("REFINEMENT_GATE_MIN_WORDS", 4))
+
+# Speculative search: the raw message is searched for while it is being refined,
+# and the results are reused if the refined message's embedding is at least this
+# similar (cosine) to the raw message's
+SPECULATIVE_SEARCH_ENABLED = os.getenv("SPECULATIVE_SEARCH_ENABLED", "True")
+SPECULATIVE_SEARCH_SIMILARITY_THRESHOLD = float(
+    os.getenv("SPECULATIVE_SEARCH_SIMILARITY_THRESHOLD", 0.9)
+)
+
+# Semantic answer cache: a question is answered from the cache if it is at least
+# this similar (cosine) to a cached question, and the cached entry is younger
+# than the TTL.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "True")
+SEMANTIC_CACHE_SIMILARITY_THRESHOLD = float(
+    os.getenv("SEMANTIC_CACHE_SIMILARITY_THRESHOLD", 0.95)
+)
+SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", 86400))
+
+# Idempotency: requests with the same `Idempotency-Key` header are answered once and
+# replayed for the key's TTL. Without the header, if IDEMPOTENCY_DEDUP_WITHOUT_KEY is
+# "True", the same message in the same chat is treated as a duplicate within the
+# window.
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_KEY_TTL_SECONDS", 86400))
+IDEMPOTENCY_DEDUP_WITHOUT_KEY = os.getenv("IDEMPOTENCY_DEDUP_WITHOUT_KEY", "False")
+IDEMPOTENCY_WINDOW_SECONDS = int(os.getenv("IDEMPOTENCY_WINDOW_SECONDS", 30))
+# How long a duplicate waits for the first request
+IDEMPOTENCY_WAIT_TIMEOUT_SECONDS = int(
+    os.getenv("IDEMPOTENCY_WAIT_TIMEOUT_SECONDS", 120)
+)
+# A request in progress renews its claim on the key every third of the lease; a
+# claim that is not renewed for the lease is assumed to belong to a dead request
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", 30))
+
+# Number of messages returned per page by `GET /chat/{chat_id}`, by default and at
+# most
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", 100))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_MAX_PAGE_SIZE", 1000))
+
+# Write-behind persistence: chat requests and responses are queued and inserted in
+# batches by a background task, at most `BATCH_SIZE` rows at a time and at least
+# every `FLUSH_SECONDS`. Requests wait when `QUEUE_SIZE` rows are queued. With a
+# journal directory, queued rows are also synced to disk and survive a crash.
+CHAT_WRITE_BEHIND_ENABLED = os.getenv("CHAT_WRITE_BEHIND_ENABLED", "False")
+CHAT_WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_QUEUE_SIZE", 1000))
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_BATCH_SIZE", 100))
+CHAT_WRITE_BEHIND_FLUSH_SECONDS = float(
+    os.getenv("CHAT_WRITE_BEHIND_FLUSH_SECONDS", 0.2)
+)
+CHAT_WRITE_BEHIND_JOURNAL_DIR = os.getenv("CHAT_WRITE_BEHIND_JOURNAL_DIR", "")
+# Number of request and response ids reserved from the database at a time
+CHAT_ID_BLOCK_SIZE = int(os.getenv("CHAT_ID_BLOCK_SIZE", 100))
+
+# Stop working on a chat request once its client has disconnected, checking this
+# often
+CHAT_CANCEL_ON_DISCONNECT = os.getenv("CHAT_CANCEL_ON_DISCONNECT", "True")
+CHAT_DISCONNECT_POLL_SECONDS = float(os.getenv("CHAT_DISCONNECT_POLL_SECONDS", 0.5))
+
+# Latency budgets, in seconds (0 for none). A request that has spent its budget,
+# or a stage that exceeds its own, falls back: refinement is skipped, reranking
+# is skipped (vector order is kept), and the context is cut when less than the
+# answer's reserve is left, down to the given fraction of the token budget.
+CHAT_LATENCY_BUDGET_SECONDS = float(os.getenv("CHAT_LATENCY_BUDGET_SECONDS", 60))
+CHAT_REFINE_BUDGET_SECONDS = float(os.getenv("CHAT_REFINE_BUDGET_SECONDS", 10))
+CHAT_RERANK_BUDGET_SECONDS = float(os.getenv("CHAT_RERANK_BUDGET_SECONDS", 3))
+CHAT_ANSWER_RESERVE_SECONDS = float(os.getenv("CHAT_ANSWER_RESERVE_SECONDS", 20))
+CHAT_MIN_CONTEXT_FRACTION = float(os.getenv("CHAT_MIN_CONTEXT_FRACTION", 0.25))
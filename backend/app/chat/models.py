@@ -1,14 +1,44 @@
 from datetime import datetime
+from typing import Any
 from uuid import uuid4
 
-from sqlalchemy import JSON, DateTime, ForeignKey, Integer, String
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import (
+    JSON,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    func,
+    select,
+    update,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from ..config import (
+    PGVECTOR_DISTANCE,
+    PGVECTOR_EF_CONSTRUCTION,
+    PGVECTOR_M,
+    PGVECTOR_VECTOR_SIZE,
+)
 from ..models import Base, JSONDict
+from ..services.utils.chat_writer import ChatWrite, get_chat_writer
+from ..services.utils.history_cache import get_history_cache
+from ..services.utils.tracing import span
+from .config import CHAT_WRITE_BEHIND_ENABLED
 from .schemas import (
+    ChatResponse,
     ChatResponseBase,
+    ChatResponseUsage,
+    ChatUsageStats,
+    ChatUserMessage,
     ChatUserMessageRefined,
+    LatencyPercentiles,
+    LLMStageUsage,
 )
 
 
@@ -26,10 +56,20 @@ class ChatRequestDB(Base):
     message: Mapped[str] = mapped_column(String)
     message_original: Mapped[str] = mapped_column(String, nullable=True)
     session_summary: Mapped[str] = mapped_column(String, nullable=True)
+    # Set if the client disconnected before the request was answered
+    cancelled_datetime_utc: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     response: Mapped["ChatResponseDB"] = relationship(
         "ChatResponseDB", back_populates="request"
     )
 
+    __table_args__ = (
+        Index(
+            "chat_requests_chat_id_created_datetime_utc_idx",
+            "chat_id",
+            "created_datetime_utc",
+        ),
+    )
+
 
 class ChatResponseDB(Base):
     """ORM for chat responses"""
@@ -51,6 +91,100 @@ class ChatResponseDB(Base):
     )
     chat_id: Mapped[str] = mapped_column(String, nullable=False)
 
+    # Tokens and seconds spent on the response, see `ChatResponseUsage`
+    refine_model: Mapped[str] = mapped_column(String, nullable=True)
+    refine_prompt_tokens: Mapped[int] = mapped_column(Integer, nullable=True)
+    refine_completion_tokens: Mapped[int] = mapped_column(Integer, nullable=True)
+    refine_llm_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+    answer_model: Mapped[str] = mapped_column(String, nullable=True)
+    answer_prompt_tokens: Mapped[int] = mapped_column(Integer, nullable=True)
+    answer_completion_tokens: Mapped[int] = mapped_column(Integer, nullable=True)
+    answer_llm_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+    embed_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+    search_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+    rerank_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+    time_to_first_token_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+    total_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+
+    __table_args__ = (
+        Index(
+            "chat_responses_chat_id_created_datetime_utc_idx",
+            "chat_id",
+            "created_datetime_utc",
+        ),
+        # For usage statistics over a time window
+        Index("chat_responses_created_datetime_utc_idx", "created_datetime_utc"),
+    )
+
+
+class ChatSummaryDB(Base):
+    """ORM for the rolling summary of each chat"""
+
+    __tablename__ = "chat_summaries"
+
+    chat_id: Mapped[str] = mapped_column(String, primary_key=True)
+    summary: Mapped[str] = mapped_column(String, nullable=False)
+    # The latest request whose exchange is included in the summary
+    last_request_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    updated_datetime_utc: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+
+class SemanticCacheDB(Base):
+    """ORM for cached answers, looked up by the embedding of the refined question"""
+
+    __tablename__ = "semantic_cache"
+
+    __table_args__ = (
+        Index(
+            "semantic_cache_embedding_idx",
+            "question_embedding",
+            postgresql_using="hnsw",
+            postgresql_with={
+                "M": PGVECTOR_M,
+                "ef_construction": PGVECTOR_EF_CONSTRUCTION,
+            },
+            postgresql_ops={"question_embedding": PGVECTOR_DISTANCE},
+        ),
+        Index("semantic_cache_created_datetime_utc_idx", "created_datetime_utc"),
+    )
+
+    cache_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    question: Mapped[str] = mapped_column(String, nullable=False)
+    question_embedding: Mapped[Vector] = mapped_column(
+        Vector(int(PGVECTOR_VECTOR_SIZE)), nullable=False
+    )
+    answer: Mapped[JSONDict] = mapped_column(JSON, nullable=False)
+    # The content used to answer, and the ids of all retrieved content
+    chunks: Mapped[JSONDict] = mapped_column(JSON, nullable=False)
+    content_ids: Mapped[list[int]] = mapped_column(ARRAY(Integer), nullable=False)
+    corpus_version: Mapped[str] = mapped_column(String, nullable=False)
+    n_hits: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    created_datetime_utc: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow, nullable=False
+    )
+
+
+class ChatIdempotencyDB(Base):
+    """ORM for idempotency keys of chat requests, so that duplicate requests, from
+    any worker, wait for and return the result of the first one"""
+
+    __tablename__ = "chat_idempotency"
+
+    __table_args__ = (
+        Index("chat_idempotency_expires_datetime_utc_idx", "expires_datetime_utc"),
+    )
+
+    idempotency_key: Mapped[str] = mapped_column(String, primary_key=True)
+    # "in_progress" or "completed"
+    status: Mapped[str] = mapped_column(String, nullable=False)
+    result: Mapped[JSONDict] = mapped_column(JSON, nullable=True)
+    # Hash of the request a client-supplied key was first used for
+    request_hash: Mapped[str] = mapped_column(String, nullable=True)
+    created_datetime_utc: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    expires_datetime_utc: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
 
 async def save_chat_request(
     chat_request: ChatUserMessageRefined, asession: AsyncSession
@@ -64,21 +198,209 @@ async def save_chat_request(
         message_original=chat_request.message_original,
         session_summary=chat_request.session_summary,
     )
-    asession.add(chat_request_db)
-    await asession.commit()
+    if CHAT_WRITE_BEHIND_ENABLED == "True":
+        await _write_behind(chat_request_db, "request_id")
+    else:
+        asession.add(chat_request_db)
+        with span("db.commit"):
+            await asession.commit()
+    await get_history_cache().append(
+        chat_request_db.chat_id, ChatUserMessage.model_validate(chat_request_db)
+    )
     return chat_request_db
 
 
+async def update_chat_request(
+    request_id: int, chat_request: ChatUserMessageRefined, asession: AsyncSession
+) -> None:
+    """Update a saved chat request with its refined message and session summary"""
+
+    values = {
+        "message": chat_request.message,
+        "message_original": chat_request.message_original,
+        "session_summary": chat_request.session_summary,
+    }
+    if CHAT_WRITE_BEHIND_ENABLED == "True":
+        await get_chat_writer().write(
+            ChatWrite(
+                table=ChatRequestDB.__tablename__,
+                kind="update",
+                values=values,
+                key={"request_id": request_id},
+            )
+        )
+    else:
+        stmt = (
+            update(ChatRequestDB)
+            .where(ChatRequestDB.request_id == request_id)
+            .values(values)
+        )
+        await asession.execute(stmt)
+        with span("db.commit"):
+            await asession.commit()
+    if chat_request.chat_id is not None:
+        await get_history_cache().update_request(
+            chat_request.chat_id, request_id, values
+        )
+
+
+async def mark_chat_request_cancelled(request_id: int, asession: AsyncSession) -> None:
+    """Record that a chat request was cancelled before it was answered"""
+
+    values = {"cancelled_datetime_utc": datetime.utcnow()}
+    if CHAT_WRITE_BEHIND_ENABLED == "True":
+        await get_chat_writer().write(
+            ChatWrite(
+                table=ChatRequestDB.__tablename__,
+                kind="update",
+                values=values,
+                key={"request_id": request_id},
+            )
+        )
+    else:
+        stmt = (
+            update(ChatRequestDB)
+            .where(ChatRequestDB.request_id == request_id)
+            .values(values)
+        )
+        await asession.execute(stmt)
+        with span("db.commit"):
+            await asession.commit()
+
+
 async def save_chat_response(
-    chat_response: ChatResponseBase, asession: AsyncSession
+    chat_response: ChatResponseBase,
+    asession: AsyncSession,
+    usage: ChatResponseUsage | None = None,
 ) -> ChatResponseDB:
-    """Save chat response to database"""
+    """Save chat response to database, with the tokens and seconds spent on it"""
     chat_response_db = ChatResponseDB(
         request_id=chat_response.request_id,
         response=chat_response.response,
         response_metadata=chat_response.response_metadata,
         chat_id=chat_response.chat_id,
+        **(usage.model_dump() if usage is not None else {}),
+    )
+    if CHAT_WRITE_BEHIND_ENABLED == "True":
+        await _write_behind(chat_response_db, "response_id")
+    else:
+        asession.add(chat_response_db)
+        with span("db.commit"):
+            await asession.commit()
+    await get_history_cache().append(
+        chat_response_db.chat_id, ChatResponse.model_validate(chat_response_db)
     )
-    asession.add(chat_response_db)
-    await asession.commit()
     return chat_response_db
+
+
+async def _write_behind(row: ChatRequestDB | ChatResponseDB, id_column: str) -> None:
+    """
+    Queue a new row for the write-behind writer, after giving it an id and a
+    creation time, so that it can be returned before it is inserted.
+    """
+    writer = get_chat_writer()
+    setattr(row, id_column, await writer.allocate_id(row.__tablename__))
+    row.created_datetime_utc = datetime.utcnow()
+    values = {column.key: getattr(row, column.key) for column in row.__table__.columns}
+    await writer.write(ChatWrite(table=row.__tablename__, kind="insert", values=values))
+
+
+async def save_chat_summary(
+    chat_id: str, summary: str, last_request_id: int, asession: AsyncSession
+) -> None:
+    """
+    Save the rolling summary of a chat. A summary is never replaced by one that
+    covers fewer exchanges, e.g. by a slower concurrent request in the same chat.
+    """
+    stmt = insert(ChatSummaryDB).values(
+        chat_id=chat_id,
+        summary=summary,
+        last_request_id=last_request_id,
+        updated_datetime_utc=datetime.utcnow(),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ChatSummaryDB.chat_id],
+        set_={
+            "summary": stmt.excluded.summary,
+            "last_request_id": stmt.excluded.last_request_id,
+            "updated_datetime_utc": stmt.excluded.updated_datetime_utc,
+        },
+        where=ChatSummaryDB.last_request_id < stmt.excluded.last_request_id,
+    )
+    await asession.execute(stmt)
+    with span("db.commit"):
+        await asession.commit()
+
+
+# Stage -> column of its seconds, for the latency percentiles
+_LATENCY_COLUMNS = {
+    "refine_llm": ChatResponseDB.refine_llm_seconds,
+    "answer_llm": ChatResponseDB.answer_llm_seconds,
+    "embed": ChatResponseDB.embed_seconds,
+    "search": ChatResponseDB.search_seconds,
+    "rerank": ChatResponseDB.rerank_seconds,
+    "time_to_first_token": ChatResponseDB.time_to_first_token_seconds,
+    "total": ChatResponseDB.total_seconds,
+}
+# LLM stage -> columns of its prompt tokens, completion tokens and seconds
+_LLM_COLUMNS = {
+    "refine": (
+        ChatResponseDB.refine_prompt_tokens,
+        ChatResponseDB.refine_completion_tokens,
+        ChatResponseDB.refine_llm_seconds,
+    ),
+    "answer": (
+        ChatResponseDB.answer_prompt_tokens,
+        ChatResponseDB.answer_completion_tokens,
+        ChatResponseDB.answer_llm_seconds,
+    ),
+}
+_PERCENTILES = (0.5, 0.95, 0.99)
+
+
+async def get_chat_usage_stats(
+    since: datetime, asession: AsyncSession
+) -> ChatUsageStats:
+    """
+    Get the latency percentiles of each stage and the tokens of each LLM stage, for
+    the responses created since `since`, in a single query.
+    """
+    columns: list[Any] = [func.count()]
+    for seconds in _LATENCY_COLUMNS.values():
+        columns.append(func.count(seconds))
+        columns.extend(
+            func.percentile_cont(q).within_group(seconds) for q in _PERCENTILES
+        )
+    for prompt_tokens, completion_tokens, seconds in _LLM_COLUMNS.values():
+        columns.extend(
+            [
+                func.count(seconds),
+                func.coalesce(func.sum(prompt_tokens), 0),
+                func.coalesce(func.sum(completion_tokens), 0),
+                func.sum(seconds).filter(completion_tokens.isnot(None)),
+            ]
+        )
+    stmt = select(*columns).where(ChatResponseDB.created_datetime_utc >= since)
+    row = iter((await asession.execute(stmt)).one())
+
+    n_responses = next(row)
+    latency = {}
+    for stage in _LATENCY_COLUMNS:
+        n, p50, p95, p99 = (next(row) for _ in range(4))
+        latency[stage] = LatencyPercentiles(n=n, p50=p50, p95=p95, p99=p99)
+    llm = {}
+    for stage in _LLM_COLUMNS:
+        n_calls, n_prompt_tokens, n_completion_tokens, total_seconds = (
+            next(row) for _ in range(4)
+        )
+        llm[stage] = LLMStageUsage(
+            n_calls=n_calls,
+            prompt_tokens=n_prompt_tokens,
+            completion_tokens=n_completion_tokens,
+            tokens_per_second=(
+                round(n_completion_tokens / total_seconds, 2) if total_seconds else None
+            ),
+        )
+    return ChatUsageStats(
+        since=since, n_responses=n_responses, latency=latency, llm=llm
+    )
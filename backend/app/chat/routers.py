@@ -2,51 +2,405 @@
 This module contains FastAPI routes for chat
 """
 
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import json
+import time
+from datetime import datetime
+from functools import partial
+from typing import Any, AsyncIterator, Literal, Optional
+
+import numpy as np
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
 from fastapi.requests import Request
+from fastapi.responses import StreamingResponse
+from numpy import ndarray
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..auth.dependencies import authenticate_key
-from ..config import USE_CROSS_ENCODER
-from ..database import get_async_session
+from ..config import LLM_CONTEXT_TOKEN_BUDGET, USE_CROSS_ENCODER
+from ..database import get_async_session, get_async_session_context_manager
+from ..ingestion.schemas import DocumentChunk
 from ..services.ChatService import ChatService
 from ..services.DocumentService import DocumentService
+from ..services.IdempotencyService import (
+    IdempotencyKeyReusedError,
+    IdempotencyService,
+)
+from ..services.SemanticCacheService import SemanticCacheService
+from ..services.utils.cancellation import (
+    ClientDisconnectedError,
+    get_cancellation_tracker,
+    run_until_disconnected,
+)
 from ..services.utils.completion import (
+    RAGPrompt,
     get_llm_response,
+    get_rag_prompt,
+    stream_llm_response,
 )
 from ..services.utils.embeddings import create_embeddings
-from .config import N_TOP_CONTENT, N_TOP_RERANK
-from .models import save_chat_request, save_chat_response
+from ..services.utils.latency_budget import get_latency_budget, start_latency_budget
+from ..services.utils.llm_gateway import LLMOverloadedError
+from ..services.utils.llm_routing import get_llm_calls, record_llm_calls
+from ..services.utils.metrics import observe_chat_stages, record_cache_lookup
+from ..services.utils.prompts import RAG
+from ..services.utils.refinement_gate import RefinementDecision
+from ..services.utils.stage_graph import StageGraph, StageTiming
+from ..services.utils.tracing import get_trace, wants_trace
+from ..utils import setup_logger
+from .config import (
+    CHAT_CANCEL_ON_DISCONNECT,
+    CHAT_HISTORY_MAX_PAGE_SIZE,
+    CHAT_HISTORY_PAGE_SIZE,
+    CHAT_REFINE_BUDGET_SECONDS,
+    CHAT_RERANK_BUDGET_SECONDS,
+    N_TOP_CONTENT,
+    N_TOP_RERANK,
+    SEMANTIC_CACHE_ENABLED,
+    SPECULATIVE_SEARCH_ENABLED,
+    SPECULATIVE_SEARCH_SIMILARITY_THRESHOLD,
+)
+from .models import (
+    ChatRequestDB,
+    ChatResponseDB,
+    mark_chat_request_cancelled,
+    save_chat_request,
+    save_chat_response,
+    save_chat_summary,
+    update_chat_request,
+)
 from .schemas import (
+    CachedAnswer,
+    ChatContext,
     ChatHistory,
-    ChatResponse,
     ChatResponseBase,
+    ChatResponseUsage,
+    ChatResponseWithTimings,
     ChatUserMessageBase,
+    ChatUserMessageRefined,
+    SpeculationOutcome,
+    SpeculativeSearch,
 )
 
+logger = setup_logger()
+
 router = APIRouter(dependencies=[Depends(authenticate_key)], tags=["Chat endpoints"])
 
+# Tasks that record cancelled requests, referenced until they finish
+_cancellation_tasks: set[asyncio.Task] = set()
+
+# Column of `ChatResponseUsage` -> the stages whose seconds it adds up
+_USAGE_STAGES = {
+    "embed_seconds": ("embed_raw", "embed"),
+    "search_seconds": ("search_raw", "search"),
+    "rerank_seconds": ("rerank",),
+}
+
 
-@router.post("/chat", response_model=ChatResponse)
+@router.post("/chat", response_model=ChatResponseWithTimings)
 async def chat(
     chat_request: ChatUserMessageBase,
     request: Request,
-    asession: AsyncSession = Depends(get_async_session),
-) -> ChatResponse:
+    idempotency_key: Optional[str] = Header(default=None),
+) -> ChatResponseWithTimings:
+    """
+    This is the endpoint called for chat. If the chat has history, the message is
+    refined using it before searching for relevant content and answering.
+
+    The pipeline runs as a graph of stages: saving the request, loading the chat's
+    rolling summary and embedding the raw message run concurrently, each with its own
+    database session. The time taken by each stage is returned in
+    `stage_timings`.
+
+    Duplicate requests, with the same `Idempotency-Key` header or, without one and
+    if `IDEMPOTENCY_DEDUP_WITHOUT_KEY` is enabled, the same message in the same chat
+    shortly after, wait for the first request and return its response instead of
+    answering again.
+
+    If the client disconnects before the answer is ready, the remaining stages are
+    cancelled and the request is recorded as cancelled.
+
+    With the trace debug header (`X-Debug-Trace: 1` by default), the timing
+    waterfall of the request is returned in `trace`.
+    """
+    _check_rerank_config()
+
+    key = IdempotencyService.get_key(chat_request, idempotency_key)
+    try:
+        if key is None:
+            chat_response = await _chat(chat_request, request)
+        else:
+            result = await IdempotencyService.run_once(
+                *key, partial(_chat, chat_request, request)
+            )
+            chat_response = ChatResponseWithTimings.model_validate(result)
+    except IdempotencyKeyReusedError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    except TimeoutError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    except ClientDisconnectedError as e:
+        # Nobody is listening, but the status shows up in the access logs
+        raise HTTPException(status_code=499, detail=str(e)) from e
+
+    chat_response.trace = _get_waterfall(request)
+    return chat_response
+
+
+async def _chat(
+    chat_request: ChatUserMessageBase, request: Request
+) -> ChatResponseWithTimings:
+    """Run all the stages of the chat pipeline."""
+    start = time.perf_counter()
+    record_llm_calls()
+    start_latency_budget()
+    graph = _get_retrieval_graph(chat_request, request)
+    graph.add("answer", _answer, depends_on=["prompt", "cache_hit"])
+    graph.add(
+        "save_response",
+        # The stages it depends on have finished by the time it runs
+        partial(_save_response, stage_timings=graph.timings, start=start),
+        depends_on=[
+            "save_request",
+            "context",
+            "refine_gate",
+            "refine",
+            "speculation",
+            "rerank",
+            "prompt",
+            "answer",
+            "cache_hit",
+        ],
+    )
+    graph.add(
+        "cache_answer",
+        _cache_answer,
+        depends_on=[
+            "refine",
+            "embed",
+            "search",
+            "rerank",
+            "answer",
+            "corpus_version",
+            "cache_hit",
+        ],
+    )
+    if CHAT_CANCEL_ON_DISCONNECT == "True":
+        try:
+            results = await run_until_disconnected(request, graph.run())
+        except ClientDisconnectedError:
+            await _record_cancellation(
+                graph.stage_names,
+                graph.results,
+                {name: timing.duration for name, timing in graph.timings.items()},
+            )
+            raise
+    else:
+        results = await graph.run()
+
+    chat_response = ChatResponseWithTimings.model_validate(results["save_response"])
+    chat_response.stage_timings = {
+        name: round(timing.duration, 4) for name, timing in graph.timings.items()
+    }
+    get_cancellation_tracker().record_completed(chat_response.stage_timings)
+    chat_response.stage_timings["total"] = round(
+        max(timing.start + timing.duration for timing in graph.timings.values()), 4
+    )
+    observe_chat_stages(chat_response.stage_timings)
+
+    return chat_response
+
+
+@router.post("/chat/stream", response_class=StreamingResponse)
+async def chat_stream(
+    chat_request: ChatUserMessageBase,
+    request: Request,
+) -> StreamingResponse:
     """
-    This is the endpoint called for chat. Note that it is currently just a single turn
-    and does not retrieve chat history.
+    Streaming version of `/chat`, using Server-Sent Events. The events are:
+
+    - `retrieval`: the chat and request ids and the content used to answer
+    - `token`: the next piece of the answer, as it is generated
+    - `done`: the saved response, with `time_to_first_token` and the other
+      `stage_timings`, and the timing waterfall with the trace debug header
+    - `error`: if the request fails after the stream has started, with
+      `retry_after` if the LLM is overloaded
+
+    The response is saved once the answer is complete. If the client disconnects
+    before then, the stream is cancelled and the request is recorded as cancelled.
     """
+    _check_rerank_config()
 
-    chat_request = await ChatService.update_request_using_history(
-        chat_request, asession
+    return StreamingResponse(
+        _stream_chat_events(chat_request, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    saved_chat_request = await save_chat_request(chat_request, asession)
 
-    message_embeddings = await create_embeddings(chat_request.message)
-    similar_chunks = await DocumentService.get_similar_n_chunks(
-        message_embeddings, n_similar=N_TOP_CONTENT, asession=asession
+
+async def _stream_chat_events(
+    chat_request: ChatUserMessageBase, request: Request
+) -> AsyncIterator[str]:
+    """Run the retrieval stages, then stream the answer as Server-Sent Events."""
+    start = time.perf_counter()
+    record_llm_calls()
+    start_latency_budget()
+    graph = _get_retrieval_graph(chat_request, request)
+    stage_timings: dict[str, float] = {}
+    answer_start = None
+    try:
+        results = await graph.run()
+        stage_timings.update(
+            (name, round(timing.duration, 4)) for name, timing in graph.timings.items()
+        )
+        save_request = results["save_request"]
+        yield _sse_event(
+            "retrieval",
+            {
+                "chat_id": save_request.chat_id,
+                "request_id": save_request.request_id,
+                "chunks": {i: c.model_dump() for i, c in results["rerank"].items()},
+            },
+        )
+
+        answer_start = time.perf_counter()
+        cache_hit = results["cache_hit"]
+        if cache_hit is not None:
+            answer_stream = _stream_cached_answer(cache_hit)
+        else:
+            answer_stream = stream_llm_response(results["prompt"])
+        answer = None
+        async for item in answer_stream:
+            if isinstance(item, RAG):
+                answer = item
+                continue
+            if "time_to_first_token" not in stage_timings:
+                stage_timings["time_to_first_token"] = round(
+                    time.perf_counter() - start, 4
+                )
+            yield _sse_event("token", {"text": item})
+        if answer is None:
+            raise RuntimeError("The answer stream ended without the parsed answer")
+        stage_timings["answer"] = round(time.perf_counter() - answer_start, 4)
+
+        save_start = time.perf_counter()
+        chat_response_db, _ = await asyncio.gather(
+            _save_response(
+                save_request=save_request,
+                context=results["context"],
+                refine_gate=results["refine_gate"],
+                refine=results["refine"],
+                speculation=results["speculation"],
+                rerank=results["rerank"],
+                prompt=results["prompt"],
+                answer=answer,
+                cache_hit=cache_hit,
+                stage_timings={
+                    **graph.timings,
+                    "answer": StageTiming(
+                        start=answer_start - start,
+                        duration=stage_timings["answer"],
+                    ),
+                },
+                start=start,
+                time_to_first_token=stage_timings.get("time_to_first_token"),
+            ),
+            _cache_answer(
+                refine=results["refine"],
+                embed=results["embed"],
+                search=results["search"],
+                rerank=results["rerank"],
+                answer=answer,
+                corpus_version=results["corpus_version"],
+                cache_hit=cache_hit,
+            ),
+        )
+        stage_timings["save_response"] = round(time.perf_counter() - save_start, 4)
+        stage_timings["total"] = round(time.perf_counter() - start, 4)
+        logger.info(
+            f"Streamed chat {save_request.chat_id}: time to first token "
+            f"{stage_timings.get('time_to_first_token')}s, "
+            f"total {stage_timings['total']}s"
+        )
+
+        completed_stage_seconds = {
+            name: seconds
+            for name, seconds in stage_timings.items()
+            if name not in ("time_to_first_token", "total")
+        }
+        get_cancellation_tracker().record_completed(completed_stage_seconds)
+        observe_chat_stages(stage_timings)
+
+        chat_response = ChatResponseWithTimings.model_validate(chat_response_db)
+        chat_response.stage_timings = stage_timings
+        chat_response.trace = _get_waterfall(request)
+        yield _sse_event("done", chat_response.model_dump(mode="json"))
+    except asyncio.CancelledError:
+        # The client disconnected. This task is being cancelled, so the
+        # cancellation is recorded in a task of its own
+        stage_seconds = {name: t.duration for name, t in graph.timings.items()}
+        if answer_start is not None and "answer" not in stage_timings:
+            stage_seconds["answer"] = time.perf_counter() - answer_start
+        finished = set(graph.results) | (
+            {"answer", "save_response"} & stage_timings.keys()
+        )
+        task = asyncio.create_task(
+            _record_cancellation(
+                graph.stage_names + ["answer", "save_response"],
+                {name: graph.results.get(name) for name in finished},
+                stage_seconds,
+            )
+        )
+        _cancellation_tasks.add(task)
+        task.add_done_callback(_cancellation_tasks.discard)
+        raise
+    except LLMOverloadedError as e:
+        yield _sse_event("error", {"detail": str(e), "retry_after": e.retry_after})
+    except Exception as e:
+        logger.error(f"Streaming chat failed: {e}")
+        yield _sse_event("error", {"detail": str(e)})
+
+
+async def _stream_cached_answer(cache_hit: CachedAnswer) -> AsyncIterator[str | RAG]:
+    """Stream a cached answer like an LLM response, in a single piece."""
+    answer = RAG.model_validate(cache_hit.answer)
+    yield answer.answer
+    yield answer
+
+
+async def _record_cancellation(
+    stage_names: list[str], results: dict[str, Any], stage_seconds: dict[str, float]
+) -> None:
+    """Count a request cancelled after the stages in `results` had finished, and
+    mark it as cancelled if it was saved."""
+    saved = get_cancellation_tracker().record_cancelled(
+        stage_names, set(results), stage_seconds
+    )
+    save_request = results.get("save_request")
+    logger.info(
+        "Client disconnected, cancelled chat request "
+        f"{save_request.request_id if save_request else '(not saved)'}, "
+        f"saving about {saved:.2f} stage seconds"
     )
+    if save_request is not None:
+        async with get_async_session_context_manager() as asession:
+            await mark_chat_request_cancelled(save_request.request_id, asession)
+
+
+def _sse_event(event: str, data: dict) -> str:
+    """Format a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _get_waterfall(request: Request) -> list[str] | None:
+    """The timing waterfall of the request so far, if its headers ask for it."""
+    trace = get_trace()
+    if trace is None or not wants_trace(request.headers):
+        return None
+    return trace.waterfall()
+
+
+def _check_rerank_config() -> None:
+    """Check that the cross-encoder keeps at most as many chunks as are retrieved."""
     if USE_CROSS_ENCODER == "True" and (N_TOP_RERANK > N_TOP_CONTENT):
         raise ValueError(
             (
@@ -55,45 +409,435 @@ async def chat(
             )
         )
 
-    if USE_CROSS_ENCODER == "True" and len(similar_chunks) > 1:
-        similar_chunks = await DocumentService.rerank_chunks(
-            query_text=chat_request.message,
-            similar_chunks=similar_chunks,
-            request=request,
-            n_top_rerank=N_TOP_RERANK,
+
+def _get_retrieval_graph(
+    chat_request: ChatUserMessageBase, request: Request
+) -> StageGraph:
+    """Get the stages that run before answering, up to reranking the content and
+    looking up the semantic cache, and building the prompt."""
+    graph = StageGraph()
+    graph.add("save_request", partial(_save_request, chat_request))
+    graph.add("context", partial(_load_context, chat_request))
+    graph.add("embed_raw", partial(create_embeddings, chat_request.message))
+    graph.add("corpus_version", _get_corpus_version)
+    graph.add(
+        "refine_gate", partial(_decide_refinement, chat_request), depends_on=["context"]
+    )
+    graph.add(
+        "refine",
+        partial(_refine, chat_request),
+        depends_on=["context", "refine_gate"],
+    )
+    graph.add("embed", _embed, depends_on=["refine", "embed_raw"])
+    graph.add("search_raw", _search_raw, depends_on=["embed_raw"])
+    graph.add(
+        "speculation",
+        _check_speculation,
+        depends_on=["refine", "embed", "embed_raw", "search_raw"],
+    )
+    graph.add("cache", _lookup_cache, depends_on=["refine", "refine_gate", "embed"])
+    graph.add(
+        "search",
+        _search,
+        depends_on=["embed", "cache", "corpus_version", "search_raw", "speculation"],
+    )
+    graph.add(
+        "cache_hit", _check_cache, depends_on=["cache", "corpus_version", "search"]
+    )
+    graph.add(
+        "rerank",
+        partial(_rerank, request),
+        depends_on=["refine", "search", "cache_hit"],
+    )
+    graph.add("prompt", _build_prompt, depends_on=["refine", "rerank", "cache_hit"])
+    return graph
+
+
+async def _save_request(chat_request: ChatUserMessageBase) -> ChatRequestDB:
+    """Save the raw request, so that it is persisted while the rest runs."""
+    async with get_async_session_context_manager() as asession:
+        return await save_chat_request(
+            ChatUserMessageRefined.model_validate(chat_request), asession
         )
-    llm_response = await get_llm_response(
-        user_message=chat_request.message,
-        session_summary=chat_request.session_summary or "",
-        similar_chunks=similar_chunks,
+
+
+async def _load_context(chat_request: ChatUserMessageBase) -> ChatContext:
+    """Load the rolling summary and the newest turns of the chat. Only answered
+    requests are loaded, so the request being saved concurrently is excluded."""
+    async with get_async_session_context_manager() as asession:
+        return await ChatService.get_chat_context(chat_request.chat_id, asession)
+
+
+async def _decide_refinement(
+    chat_request: ChatUserMessageBase, context: ChatContext
+) -> RefinementDecision:
+    """Decide whether the message needs to be refined using the chat history."""
+    return ChatService.get_refinement_decision(chat_request, context)
+
+
+async def _refine(
+    chat_request: ChatUserMessageBase,
+    context: ChatContext,
+    refine_gate: RefinementDecision,
+) -> ChatUserMessageRefined:
+    """Update the summary and refine the message, if it needs refining. If that
+    would exceed the refinement's latency budget, the raw message is used."""
+    refined = ChatService.refine_request(chat_request, context, refine_gate)
+    if not refine_gate.refine:
+        return await refined
+    return await get_latency_budget().run_stage(
+        "refine",
+        CHAT_REFINE_BUDGET_SECONDS,
+        refined,
+        "raw_message",
+        partial(ChatService.unrefined_request, chat_request, context),
     )
 
-    chat_response_base = ChatResponseBase(
-        response=llm_response.answer,
-        request_id=saved_chat_request.request_id,
-        chat_id=saved_chat_request.chat_id,
-        response_metadata={
-            i: chunk.model_dump() for i, chunk in similar_chunks.items()
-        },
+
+async def _embed(refine: ChatUserMessageRefined, embed_raw: ndarray) -> ndarray:
+    """Embed the refined message, reusing the raw message's embedding if the
+    message was not changed."""
+    if refine.message_original is None:
+        return embed_raw
+    return await create_embeddings(refine.message)
+
+
+async def _get_corpus_version() -> str | None:
+    """Get the version of the corpus, if the semantic cache is enabled."""
+    if SEMANTIC_CACHE_ENABLED != "True":
+        return None
+    async with get_async_session_context_manager() as asession:
+        return await SemanticCacheService.get_corpus_version(asession)
+
+
+async def _lookup_cache(
+    refine: ChatUserMessageRefined, refine_gate: RefinementDecision, embed: ndarray
+) -> CachedAnswer | None:
+    """Find a cached answer to a similar question, if the cache is enabled. The
+    cache is shared by all chats and only holds answers given without a session
+    summary, see `_cache_answer`. A follow-up is looked up by its refined message,
+    which stands on its own, or if the gate found it needs no refining; not if
+    refining it failed or ran out of time."""
+    if SEMANTIC_CACHE_ENABLED != "True":
+        return None
+    standalone = refine.message_original is not None or not refine_gate.refine
+    if refine.session_summary and not standalone:
+        return None
+    async with get_async_session_context_manager() as asession:
+        return await SemanticCacheService.lookup(embed, asession)
+
+
+async def _search_raw(embed_raw: ndarray) -> SpeculativeSearch | None:
+    """Search for the raw message while it is being refined, if speculative search
+    is enabled."""
+    if SPECULATIVE_SEARCH_ENABLED != "True":
+        return None
+    start = time.perf_counter()
+    async with get_async_session_context_manager() as asession:
+        chunks = await DocumentService.get_similar_n_chunks(
+            embed_raw, n_similar=N_TOP_CONTENT, asession=asession
+        )
+    return SpeculativeSearch(
+        chunks=chunks, search_seconds=round(time.perf_counter() - start, 4)
     )
 
-    saved_chat_response = await save_chat_response(chat_response_base, asession)
-    chat_response = ChatResponse.model_validate(saved_chat_response)
 
-    return chat_response
+async def _check_speculation(
+    refine: ChatUserMessageRefined,
+    embed: ndarray,
+    embed_raw: ndarray,
+    search_raw: SpeculativeSearch | None,
+) -> SpeculationOutcome | None:
+    """Decide whether the results of the speculative search can be used: the
+    message was not refined, or the refined message is close enough to it."""
+    if search_raw is None:
+        return None
+    if refine.message_original is None:
+        similarity = 1.0
+    else:
+        similarity = float(
+            np.dot(embed, embed_raw)
+            / (np.linalg.norm(embed) * np.linalg.norm(embed_raw))
+        )
+    return SpeculationOutcome(
+        reused=similarity >= SPECULATIVE_SEARCH_SIMILARITY_THRESHOLD,
+        similarity=round(similarity, 4),
+        search_seconds=search_raw.search_seconds,
+    )
+
+
+async def _search(
+    embed: ndarray,
+    cache: CachedAnswer | None,
+    corpus_version: str | None,
+    search_raw: SpeculativeSearch | None,
+    speculation: SpeculationOutcome | None,
+) -> dict[int, DocumentChunk] | None:
+    """Retrieve the chunks closest to the message, reusing the speculative search
+    if possible. Skipped if a cached answer was found and the corpus has not
+    changed since it was cached."""
+    if cache is not None and cache.corpus_version == corpus_version:
+        return None
+    if search_raw is not None and speculation is not None and speculation.reused:
+        return search_raw.chunks
+    async with get_async_session_context_manager() as asession:
+        return await DocumentService.get_similar_n_chunks(
+            embed, n_similar=N_TOP_CONTENT, asession=asession
+        )
+
+
+async def _check_cache(
+    cache: CachedAnswer | None,
+    corpus_version: str | None,
+    search: dict[int, DocumentChunk] | None,
+) -> CachedAnswer | None:
+    """Return the cached answer if it can be reused."""
+    if (
+        cache is None
+        or corpus_version is None
+        or not SemanticCacheService.is_valid(cache, corpus_version, search)
+    ):
+        if SEMANTIC_CACHE_ENABLED == "True":
+            record_cache_lookup("semantic", hit=False)
+        return None
+    record_cache_lookup("semantic", hit=True)
+    async with get_async_session_context_manager() as asession:
+        await SemanticCacheService.record_hit(cache.cache_id, asession)
+    return cache
+
+
+async def _rerank(
+    request: Request,
+    refine: ChatUserMessageRefined,
+    search: dict[int, DocumentChunk] | None,
+    cache_hit: CachedAnswer | None,
+) -> dict[int, DocumentChunk]:
+    """Rerank the retrieved chunks with the cross-encoder, if enabled. If that
+    would exceed the reranking's latency budget, the top chunks are kept in vector
+    order. For a cached answer, the content it was based on is returned."""
+    if cache_hit is not None:
+        return cache_hit.chunks
+    if search is None:
+        return {}
+    if USE_CROSS_ENCODER == "True" and len(search) > 1:
+        return await get_latency_budget().run_stage(
+            "rerank",
+            CHAT_RERANK_BUDGET_SECONDS,
+            DocumentService.rerank_chunks(
+                query_text=refine.message,
+                similar_chunks=search,
+                request=request,
+                n_top_rerank=N_TOP_RERANK,
+            ),
+            "vector_order",
+            lambda: dict(enumerate(list(search.values())[:N_TOP_RERANK])),
+        )
+    return search
+
+
+async def _build_prompt(
+    refine: ChatUserMessageRefined,
+    rerank: dict[int, DocumentChunk],
+    cache_hit: CachedAnswer | None,
+) -> RAGPrompt | None:
+    """Build the prompt, fitting the retrieved chunks in the context budget, which
+    is cut if little of the request's latency budget is left. Not needed for a
+    cached answer."""
+    if cache_hit is not None:
+        return None
+    return await asyncio.to_thread(
+        get_rag_prompt,
+        user_message=refine.message,
+        session_summary=refine.session_summary or "",
+        similar_chunks=rerank,
+        context_budget=get_latency_budget().context_token_budget(
+            LLM_CONTEXT_TOKEN_BUDGET
+        ),
+    )
+
+
+async def _answer(prompt: RAGPrompt | None, cache_hit: CachedAnswer | None) -> RAG:
+    """Answer the message using the prompt, or from the cache."""
+    if cache_hit is not None:
+        return RAG.model_validate(cache_hit.answer)
+    if prompt is None:
+        raise ValueError("No prompt to answer with and no cached answer")
+    return await get_llm_response(prompt)
+
+
+async def _save_response(
+    save_request: ChatRequestDB,
+    context: ChatContext,
+    refine_gate: RefinementDecision,
+    refine: ChatUserMessageRefined,
+    speculation: SpeculationOutcome | None,
+    rerank: dict[int, DocumentChunk],
+    prompt: RAGPrompt | None,
+    answer: RAG,
+    cache_hit: CachedAnswer | None,
+    stage_timings: dict[str, StageTiming],
+    start: float,
+    time_to_first_token: float | None = None,
+) -> ChatResponseDB:
+    """Save the response, and the refined message and updated summary if the
+    message was refined. Whether the message was refined, whether the
+    speculative search was used, the prompt's token counts, the models that
+    served each LLM stage and the stages degraded to keep within the latency
+    budget are recorded in the metadata, and answers from the cache are flagged
+    there.
+
+    The tokens and seconds spent on the response are saved in columns of their
+    own, see `_get_response_usage`; `start` is when the request started."""
+    usage = _get_response_usage(
+        stage_timings, time.perf_counter() - start, time_to_first_token
+    )
+    async with get_async_session_context_manager() as asession:
+        if refine.message_original is not None:
+            await update_chat_request(save_request.request_id, refine, asession)
+        # Only a refined message comes with a summary covering the new turns
+        if (
+            context.new_turns
+            and refine.message_original is not None
+            and refine.session_summary is not None
+        ):
+            await save_chat_summary(
+                save_request.chat_id,
+                refine.session_summary,
+                context.new_turns[-1].request_id,
+                asession,
+            )
+
+        response_metadata: dict[str, Any] = {
+            str(i): chunk.model_dump() for i, chunk in rerank.items()
+        }
+        response_metadata["refinement"] = {
+            **refine_gate.model_dump(),
+            "refined": refine.message_original is not None,
+        }
+        if speculation is not None:
+            response_metadata["speculative_search"] = speculation.model_dump()
+        if prompt is not None:
+            response_metadata["prompt"] = prompt.metadata()
+        llm_calls = get_llm_calls()
+        if llm_calls:
+            response_metadata["llm"] = {
+                stage: call.model_dump() for stage, call in llm_calls.items()
+            }
+        response_metadata["degradations"] = [
+            degradation.model_dump()
+            for degradation in get_latency_budget().degradations
+        ]
+        if cache_hit is not None:
+            response_metadata["semantic_cache"] = {
+                "hit": True,
+                "cache_id": cache_hit.cache_id,
+                "similarity": cache_hit.similarity,
+            }
+        chat_response_base = ChatResponseBase(
+            response=answer.answer,
+            request_id=save_request.request_id,
+            chat_id=save_request.chat_id,
+            response_metadata=response_metadata,
+        )
+        return await save_chat_response(chat_response_base, asession, usage)
+
+
+def _get_response_usage(
+    stage_timings: dict[str, StageTiming],
+    total_seconds: float,
+    time_to_first_token: float | None,
+) -> ChatResponseUsage:
+    """
+    The tokens and seconds of the LLM calls of the request, and the seconds spent
+    on embedding, searching and reranking. Embedding and searching add up the
+    stages for the raw and the refined message. `total_seconds` is the time until
+    the answer was ready.
+    """
+    values: dict[str, Any] = {}
+    for stage, llm_call in get_llm_calls().items():
+        values[f"{stage}_model"] = llm_call.model
+        values[f"{stage}_prompt_tokens"] = llm_call.prompt_tokens
+        values[f"{stage}_completion_tokens"] = llm_call.completion_tokens
+        values[f"{stage}_llm_seconds"] = llm_call.seconds
+    for column, stages in _USAGE_STAGES.items():
+        durations = [stage_timings[s].duration for s in stages if s in stage_timings]
+        values[column] = round(sum(durations), 4) if durations else None
+    return ChatResponseUsage(
+        **values,
+        time_to_first_token_seconds=time_to_first_token,
+        total_seconds=round(total_seconds, 4),
+    )
+
+
+async def _cache_answer(
+    refine: ChatUserMessageRefined,
+    embed: ndarray,
+    search: dict[int, DocumentChunk] | None,
+    rerank: dict[int, DocumentChunk],
+    answer: RAG,
+    corpus_version: str | None,
+    cache_hit: CachedAnswer | None,
+) -> None:
+    """Cache a new answer, unless the LLM could not answer. Answers built with a
+    session summary depend on the chat they were given in, so they are not
+    cached."""
+    if (
+        corpus_version is None
+        or search is None
+        or cache_hit is not None
+        or refine.session_summary
+        or answer.answer == RAG.RAG_FAILURE_MESSAGE
+    ):
+        return
+    async with get_async_session_context_manager() as asession:
+        await SemanticCacheService.save(
+            question=refine.message,
+            question_embedding=embed,
+            answer=answer,
+            chunks=rerank,
+            similar_chunks=search,
+            corpus_version=corpus_version,
+            asession=asession,
+        )
 
 
 @router.get("/chat/{chat_id}", response_model=ChatHistory)
 async def get_chat(
     chat_id: str,
+    before: Optional[datetime] = None,
+    limit: int = Query(
+        default=CHAT_HISTORY_PAGE_SIZE, ge=1, le=CHAT_HISTORY_MAX_PAGE_SIZE
+    ),
+    before_kind: Optional[Literal["request", "response"]] = None,
+    before_request_id: Optional[int] = None,
     asession: AsyncSession = Depends(get_async_session),
 ) -> ChatHistory:
     """
-    This endpoint retrieves a chat by chat_id
+    This endpoint retrieves a chat by chat_id, oldest message first, one page at a
+    time: the newest `limit` messages before `before`. To get the previous page,
+    pass the `created_datetime_utc` and `request_id` of the first message as
+    `before` and `before_request_id`, and its kind as `before_kind`: "response"
+    if it has a `response_id`, "request" otherwise. Messages created at the same
+    time as it are then split between the pages without gaps.
     """
+    if (before_kind is None) != (before_request_id is None) or (
+        before_kind is not None and before is None
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail="before_kind and before_request_id are only used together, "
+            "with before",
+        )
 
-    chats = await ChatService.get_chat_history(str(chat_id), asession)
+    chats = await ChatService.get_chat_history(
+        str(chat_id),
+        asession,
+        before=before,
+        limit=limit,
+        before_kind=before_kind,
+        before_request_id=before_request_id,
+    )
 
-    if not chats:
+    if not chats and before is None:
         raise HTTPException(status_code=404, detail=f"Session id: {chat_id} not found")
     return chats
@@ -4,6 +4,8 @@ from typing import Optional
 
 from pydantic import BaseModel, ConfigDict, Field
 
+from ..ingestion.schemas import DocumentChunk
+
 
 class ChatUserMessageBase(BaseModel):
     """
@@ -61,4 +63,120 @@ class ChatResponse(ChatResponseBase):
     created_datetime_utc: datetime
 
 
+class ChatResponseWithTimings(ChatResponse):
+    """
+    Schema for the response to a user's chat message, with the time taken by each
+    stage of the chat pipeline and, if asked for with the debug header, the timing
+    waterfall of the request
+    """
+
+    stage_timings: dict[str, float] = Field(
+        default_factory=dict,
+        examples=[{"history": 0.004, "search": 0.012, "answer": 1.9, "total": 2.1}],
+    )
+    trace: Optional[list[str]] = Field(
+        default=None,
+        examples=[["     0.0   2100.0  total", "     0.3      4.1  history"]],
+    )
+
+
 ChatHistory = list[ChatResponse | ChatUserMessage]
+
+
+class ChatContext(BaseModel):
+    """
+    Schema for what is needed to refine a message: the rolling summary of the chat
+    and the exchanges that happened after it was last updated
+    """
+
+    session_summary: Optional[str] = None
+    last_summarized_request_id: Optional[int] = None
+    new_turns: ChatHistory = Field(default_factory=list)
+
+
+class CachedAnswer(BaseModel):
+    """
+    Schema for an answer found in the semantic cache
+    """
+
+    cache_id: int
+    similarity: float
+    answer: dict
+    chunks: dict[int, DocumentChunk]
+    content_ids: list[int]
+    corpus_version: str
+
+
+class SpeculativeSearch(BaseModel):
+    """
+    Schema for the results of searching for the raw message while it is refined,
+    and how long the search took, in seconds
+    """
+
+    chunks: dict[int, DocumentChunk]
+    search_seconds: float
+
+
+class SpeculationOutcome(BaseModel):
+    """
+    Schema for whether the speculative search results were used. If they were,
+    `search_seconds` were saved; otherwise the search was wasted.
+    """
+
+    reused: bool
+    similarity: float
+    search_seconds: float
+
+
+class ChatResponseUsage(BaseModel):
+    """
+    Schema for the tokens and seconds spent on a response, by the refinement and
+    answer LLM calls and by the other stages of the pipeline. LLM seconds are the
+    calls' own, without waiting for the LLM gateway. Fields are None for work that
+    was not done or not reported, e.g. the answer's LLM call for cached answers.
+    """
+
+    refine_model: Optional[str] = None
+    refine_prompt_tokens: Optional[int] = None
+    refine_completion_tokens: Optional[int] = None
+    refine_llm_seconds: Optional[float] = None
+    answer_model: Optional[str] = None
+    answer_prompt_tokens: Optional[int] = None
+    answer_completion_tokens: Optional[int] = None
+    answer_llm_seconds: Optional[float] = None
+    embed_seconds: Optional[float] = None
+    search_seconds: Optional[float] = None
+    rerank_seconds: Optional[float] = None
+    time_to_first_token_seconds: Optional[float] = None
+    total_seconds: Optional[float] = None
+
+
+class LatencyPercentiles(BaseModel):
+    """Schema for the number of measurements of a stage and their percentiles, in
+    seconds"""
+
+    n: int
+    p50: Optional[float] = None
+    p95: Optional[float] = None
+    p99: Optional[float] = None
+
+
+class LLMStageUsage(BaseModel):
+    """
+    Schema for the tokens of an LLM stage's calls, and the completion tokens
+    generated per second of the calls that reported them
+    """
+
+    n_calls: int
+    prompt_tokens: int
+    completion_tokens: int
+    tokens_per_second: Optional[float] = None
+
+
+class ChatUsageStats(BaseModel):
+    """Schema for the tokens and latencies of the responses since `since`"""
+
+    since: datetime
+    n_responses: int
+    latency: dict[str, LatencyPercentiles]
+    llm: dict[str, LLMStageUsage]
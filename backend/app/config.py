@@ -21,8 +21,85 @@ EMBEDDING_MODEL_NAME = os.environ.get(
     "EMBEDDING_MODEL_NAME", "Alibaba-NLP/gte-base-en-v1.5"
 )  # Update `PGVECTOR_VECTOR_SIZE` accordingly
 
+# Number of threads running model inference (embeddings, reranking)
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 2))
+
+# Ingestion pipeline: concurrent workers per stage and bounded queue size
+INGESTION_PARSE_WORKERS = int(os.environ.get("INGESTION_PARSE_WORKERS", 2))
+INGESTION_EMBED_WORKERS = int(os.environ.get("INGESTION_EMBED_WORKERS", 1))
+# More than one writer can miss near-duplicates between files written concurrently
+INGESTION_WRITE_WORKERS = int(os.environ.get("INGESTION_WRITE_WORKERS", 1))
+INGESTION_QUEUE_SIZE = int(os.environ.get("INGESTION_QUEUE_SIZE", 4))
+# Chunks embedded and written together, so that the batches of a file overlap
+INGESTION_BATCH_CHUNKS = int(os.environ.get("INGESTION_BATCH_CHUNKS", 32))
+
+# Chunking
+CHUNKING_STRATEGY = os.environ.get("CHUNKING_STRATEGY", "token")  # or "page"
+# Capped at the embedding model's maximum sequence length
+CHUNK_MAX_TOKENS = int(os.environ.get("CHUNK_MAX_TOKENS", 512))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", 64))
+
+# Near-duplicate detection
+DEDUP_MODE = os.environ.get("DEDUP_MODE", "link")  # "link", "skip" or "off"
+DEDUP_SIMILARITY_THRESHOLD = float(os.environ.get("DEDUP_SIMILARITY_THRESHOLD", 0.9))
+MINHASH_NUM_PERM = int(os.environ.get("MINHASH_NUM_PERM", 128))
+MINHASH_BANDS = int(os.environ.get("MINHASH_BANDS", 16))  # must divide NUM_PERM
+MINHASH_SHINGLE_SIZE = int(os.environ.get("MINHASH_SHINGLE_SIZE", 5))  # words
+
 LLM_MODEL = os.environ.get("LLM_MODEL", "ollama/llama3.2:1b")  # or "gpt-4o-mini"
 LLM_API_BASE = os.environ.get("LLM_API_BASE", "http://localhost:11434")
+# How long Ollama keeps a model loaded after a call, e.g. "1h", or "-1m" for ever,
+# and whether the Ollama models are loaded when the API starts
+LLM_KEEP_ALIVE = os.environ.get("LLM_KEEP_ALIVE", "1h")
+LLM_PRELOAD = os.environ.get("LLM_PRELOAD", "True")
+# Structured output: "auto" asks each model for the JSON schema of the response if
+# litellm knows it supports schemas, else for JSON if it supports JSON mode;
+# "schema" and "json" ask every model for one of these, "off" for neither
+LLM_STRUCTURED_OUTPUT = os.environ.get("LLM_STRUCTURED_OUTPUT", "auto")
+# Per-stage LLMs: "ANSWER" generates the answer, "REFINE" updates the session
+# summary and rephrases the message, and can run on a smaller model. Each stage
+# defaults to LLM_MODEL. Fallback models (comma-separated) are tried in order when
+# a model errors or exceeds the stage's timeout (0 for none), which for a streamed
+# answer is the time to the first token.
+ANSWER_LLM_MODEL = os.environ.get("ANSWER_LLM_MODEL", LLM_MODEL)
+ANSWER_LLM_FALLBACK_MODELS = os.environ.get("ANSWER_LLM_FALLBACK_MODELS", "")
+ANSWER_LLM_MAX_TOKENS = int(os.environ.get("ANSWER_LLM_MAX_TOKENS", 1024))
+ANSWER_LLM_TEMPERATURE = float(os.environ.get("ANSWER_LLM_TEMPERATURE", 0))
+ANSWER_LLM_TIMEOUT_SECONDS = float(os.environ.get("ANSWER_LLM_TIMEOUT_SECONDS", 0))
+REFINE_LLM_MODEL = os.environ.get("REFINE_LLM_MODEL", LLM_MODEL)
+REFINE_LLM_FALLBACK_MODELS = os.environ.get("REFINE_LLM_FALLBACK_MODELS", "")
+REFINE_LLM_MAX_TOKENS = int(os.environ.get("REFINE_LLM_MAX_TOKENS", 512))
+REFINE_LLM_TEMPERATURE = float(os.environ.get("REFINE_LLM_TEMPERATURE", 0))
+REFINE_LLM_TIMEOUT_SECONDS = float(os.environ.get("REFINE_LLM_TIMEOUT_SECONDS", 0))
+# LLM gateway: concurrent completions per worker process, and the longest a call may
+# wait for a slot before being rejected with a 429. Each worker has its own gateway,
+# so the LLM serves up to the number of workers times LLM_MAX_CONCURRENCY calls.
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 1))
+LLM_MAX_QUEUE_WAIT_SECONDS = float(os.environ.get("LLM_MAX_QUEUE_WAIT_SECONDS", 30))
+# Expected duration of an LLM call, used to estimate waits until calls have completed
+LLM_EXPECTED_CALL_SECONDS = float(os.environ.get("LLM_EXPECTED_CALL_SECONDS", 10))
+# Maximum number of tokens of retrieved content in the RAG prompt
+LLM_CONTEXT_TOKEN_BUDGET = int(os.environ.get("LLM_CONTEXT_TOKEN_BUDGET", 1500))
+
+# Tracing: the slowest TRACE_KEEP_SLOWEST requests of each hour are kept and, at the
+# end of the hour, exported by TRACE_EXPORTER: "file" (JSON lines in TRACE_FILE),
+# "memory" or "off". Requests with the TRACE_DEBUG_HEADER header get their timing
+# waterfall back.
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "off")
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+TRACE_KEEP_SLOWEST = int(os.environ.get("TRACE_KEEP_SLOWEST", 10))
+TRACE_DEBUG_HEADER = os.environ.get("TRACE_DEBUG_HEADER", "X-Debug-Trace")
+
+# Chat history cache: "redis" (shared), "memory" (per worker, so only correct with a
+# single worker) or "off". Defaults to "redis" if REDIS_URL is set and "off"
+# otherwise. Chats are evicted when idle, and from the memory cache when it exceeds
+# its budget
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+HISTORY_CACHE_BACKEND = os.environ.get(
+    "HISTORY_CACHE_BACKEND", "redis" if "REDIS_URL" in os.environ else "off"
+)
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get("HISTORY_CACHE_MAX_BYTES", 64 * 1024**2))
+HISTORY_CACHE_IDLE_SECONDS = int(os.environ.get("HISTORY_CACHE_IDLE_SECONDS", 3600))
 
 # Cross-encoder
 USE_CROSS_ENCODER = os.environ.get("USE_CROSS_ENCODER", "True")
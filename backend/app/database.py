@@ -15,6 +15,7 @@ from .config import (
     POSTGRES_PORT,
     POSTGRES_USER,
 )
+from .services.utils.metrics import TimedAsyncAdaptedQueuePool, instrument_pool
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
@@ -60,11 +61,17 @@ def get_sqlalchemy_engine() -> Engine:
 
 
 def get_sqlalchemy_async_engine() -> AsyncEngine:
-    """Return a SQLAlchemy async engine generator."""
+    """Return a SQLAlchemy async engine generator. Its pool's connections and
+    waits are recorded in the metrics."""
     global _ASYNC_ENGINE
     if _ASYNC_ENGINE is None:
         connection_string = get_connection_url()
-        _ASYNC_ENGINE = create_async_engine(connection_string, pool_size=DB_POOL_SIZE)
+        _ASYNC_ENGINE = create_async_engine(
+            connection_string,
+            pool_size=DB_POOL_SIZE,
+            poolclass=TimedAsyncAdaptedQueuePool,
+        )
+        instrument_pool(_ASYNC_ENGINE.sync_engine.pool)
     return _ASYNC_ENGINE
 
 
@@ -79,6 +86,12 @@ def get_session() -> Generator[Session, None, None]:
         yield session
 
 
+def get_async_session_context_manager() -> AsyncSession:
+    """Return a new SQLAlchemy async session, to be used as an async context
+    manager by code that needs its own session outside of a request."""
+    return AsyncSession(get_sqlalchemy_async_engine(), expire_on_commit=False)
+
+
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     """Return a SQLAlchemy async session."""
     async with AsyncSession(
@@ -8,7 +8,18 @@ from typing import Optional
 
 from numpy import ndarray
 from pgvector.sqlalchemy import Vector
-from sqlalchemy import Boolean, DateTime, Index, Integer, String, Text
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Text,
+)
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Mapped, mapped_column
 
@@ -48,6 +59,7 @@ class DocumentDB(Base):
     file_id: Mapped[str] = mapped_column(String(length=36), nullable=False)
     chunk_id: Mapped[int] = mapped_column(Integer, nullable=False)
     text: Mapped[str] = mapped_column(Text, nullable=False)
+    n_tokens: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     embedding_vector: Mapped[Vector] = mapped_column(
         Vector(int(PGVECTOR_VECTOR_SIZE)), nullable=False
     )
@@ -60,6 +72,82 @@ class DocumentDB(Base):
     is_archived: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
 
 
+class FileDB(Base):
+    """ORM for the per-file summary of ingested documents. Rows are written in the
+    same transaction as the file's chunks so that listing files does not need to
+    aggregate over `documents`."""
+
+    __tablename__ = "files"
+
+    __table_args__ = (
+        Index(
+            "files_created_datetime_utc_file_id_idx",
+            "created_datetime_utc",
+            "file_id",
+        ),
+    )
+
+    file_id: Mapped[str] = mapped_column(String(length=36), primary_key=True)
+    file_name: Mapped[str] = mapped_column(String(length=150), nullable=False)
+    total_chunks: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Chunks not stored because they are near-duplicates of stored chunks
+    n_duplicate_chunks: Mapped[int] = mapped_column(
+        Integer, default=0, server_default="0", nullable=False
+    )
+    file_size: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    created_datetime_utc: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+    updated_datetime_utc: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+    is_archived: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+
+
+class ChunkFingerprintDB(Base):
+    """ORM for the MinHash fingerprints of stored chunks, used to find
+    near-duplicates at ingestion time."""
+
+    __tablename__ = "chunk_fingerprints"
+
+    __table_args__ = (
+        Index(
+            "chunk_fingerprints_band_hashes_idx",
+            "band_hashes",
+            postgresql_using="gin",
+        ),
+    )
+
+    content_id: Mapped[int] = mapped_column(
+        Integer,
+        ForeignKey("documents.content_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    signature: Mapped[list[int]] = mapped_column(ARRAY(BigInteger), nullable=False)
+    band_hashes: Mapped[list[int]] = mapped_column(ARRAY(BigInteger), nullable=False)
+
+
+class ChunkDuplicateDB(Base):
+    """ORM for chunks that were not stored because they are near-duplicates of an
+    existing chunk."""
+
+    __tablename__ = "chunk_duplicates"
+
+    duplicate_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    file_id: Mapped[str] = mapped_column(String(length=36), nullable=False)
+    chunk_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    duplicate_of_content_id: Mapped[int] = mapped_column(
+        Integer,
+        ForeignKey("documents.content_id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    similarity: Mapped[float] = mapped_column(Float, nullable=False)
+    n_text_bytes: Mapped[int] = mapped_column(Integer, nullable=False)
+    created_datetime_utc: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+
+
 async def save_document_to_db(
     *,
     text_embeddings: list[tuple[str, ndarray]],
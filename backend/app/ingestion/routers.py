@@ -1,11 +1,28 @@
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
+from typing import Optional
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+)
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..auth.dependencies import authenticate_key
 from ..database import get_async_session
 from ..services.DocumentService import DocumentService
 from ..utils import setup_logger
-from .schemas import DocumentInfoList, IngestionResponse
+from .schemas import (
+    BatchIngestionResponse,
+    DedupReport,
+    DocumentInfoList,
+    IngestionError,
+    IngestionResponse,
+)
 
 logger = setup_logger()
 
@@ -23,37 +40,100 @@ router = APIRouter(
 @router.post("/ingestion", response_model=IngestionResponse)
 async def upload_document(
     file: UploadFile = File(...),
-    session: AsyncSession = Depends(get_async_session),
 ) -> IngestionResponse:
     """
     Upload and process a document, then store embeddings in the database.
     """
     file_name = file.filename or "unknown filename"
-    try:
-        content = await file.read()
-        chunks = await DocumentService.parse_file(content)
-        embeddings = await DocumentService.create_embeddings(chunks)
+    content = await file.read()
+    results, _ = await DocumentService.ingest_files([(file_name, content)])
 
-        file_id = await DocumentService.save_document(
-            text_embeddings=list(zip(chunks, embeddings)),
-            file_name=file_name,
-            session=session,
-        )
-    except Exception as e:
+    if results[0].error is not None:
         raise HTTPException(
-            status_code=400, detail=f"Failed to process document: {e}"
-        ) from e
+            status_code=400, detail=f"Failed to process document: {results[0].error}"
+        ) from results[0].error
 
-    return IngestionResponse(
-        file_name=file_name, file_id=file_id, total_chunks=len(embeddings)
+    return results[0].value
+
+
+@router.post("/ingestion/batch", response_model=BatchIngestionResponse)
+async def upload_documents(
+    files: list[UploadFile] = File(...),
+) -> BatchIngestionResponse:
+    """
+    Upload and process several documents. Parsing, embedding and saving run as
+    concurrent pipeline stages, and the response includes each stage's
+    throughput and queue occupancy. Files that fail are listed in `errors` and do
+    not prevent the others from being saved.
+    """
+    contents = [
+        (file.filename or "unknown filename", await file.read()) for file in files
+    ]
+    results, metrics = await DocumentService.ingest_files(contents)
+
+    return BatchIngestionResponse(
+        files=[r.value for r in results if r.error is None],
+        errors=[
+            IngestionError(
+                file_name=contents[r.index][0],
+                stage=r.failed_stage or "",
+                detail=str(r.error),
+            )
+            for r in results
+            if r.error is not None
+        ],
+        pipeline_metrics=metrics,
     )
 
 
 @router.get("/ingestion/list_docs", response_model=DocumentInfoList)
 async def get_doc_list(
+    request: Request,
+    response: Response,
+    limit: int = Query(default=50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    is_archived: Optional[bool] = None,
+    file_name: Optional[str] = None,
+    session: AsyncSession = Depends(get_async_session),
+) -> DocumentInfoList | Response:
+    """
+    Return a page of the documents in the database, newest first. Pass the
+    `next_cursor` of a page as `cursor` to get the next one.
+
+    The response has an `ETag` header. If the request's `If-None-Match` header
+    matches it, an empty `304 Not Modified` response is returned instead, after a
+    single aggregate query rather than reading the page.
+    """
+    try:
+        etag = await DocumentService.get_list_etag(
+            session,
+            limit=limit,
+            cursor=cursor,
+            is_archived=is_archived,
+            file_name=file_name,
+        )
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        doc_list = await DocumentService.list_all_docs(
+            session,
+            limit=limit,
+            cursor=cursor,
+            is_archived=is_archived,
+            file_name=file_name,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+    response.headers["ETag"] = etag
+    return doc_list
+
+
+@router.get("/ingestion/dedup_report", response_model=DedupReport)
+async def get_dedup_report(
     session: AsyncSession = Depends(get_async_session),
-) -> DocumentInfoList:
+) -> DedupReport:
     """
-    Return a list of all documents in the database.
+    Return how much storage and vector index size near-duplicate detection saved.
     """
-    return await DocumentService.list_all_docs(session)
+    return await DocumentService.get_dedup_report(session)
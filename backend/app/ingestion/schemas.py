@@ -4,7 +4,28 @@ serialization."""
 from datetime import datetime
 from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+
+
+class TextChunk(BaseModel):
+    """Pydantic model for a chunk of text parsed from an uploaded file."""
+
+    text: str
+    n_tokens: int
+
+
+class StageMetrics(BaseModel):
+    """Pydantic model for the throughput and queue occupancy of a stage of the
+    ingestion pipeline. Queue occupancy is a share of the queue's size."""
+
+    name: str
+    workers: int
+    n_items: int
+    busy_seconds: float
+    items_per_second: float
+    utilisation: float
+    mean_queue_occupancy: float
+    max_queue_occupancy: float
 
 
 class IngestionResponse(BaseModel):
@@ -13,6 +34,34 @@ class IngestionResponse(BaseModel):
     file_name: str
     file_id: str
     total_chunks: int
+    n_duplicate_chunks: int = 0
+
+
+class IngestionError(BaseModel):
+    """Pydantic model for a file that failed to be ingested."""
+
+    file_name: str
+    stage: str
+    detail: str
+
+
+class BatchIngestionResponse(BaseModel):
+    """Pydantic model for the response of the batch ingestion endpoint."""
+
+    files: list[IngestionResponse]
+    errors: list[IngestionError]
+    pipeline_metrics: list[StageMetrics]
+
+
+class DedupReport(BaseModel):
+    """Pydantic model for the storage saved by near-duplicate detection."""
+
+    n_duplicate_chunks: int
+    n_files_with_duplicates: int
+    n_files_all_duplicates: int
+    text_bytes_saved: int
+    vector_bytes_saved: int
+    index_bytes_saved_estimate: int
 
 
 class DocumentInfo(BaseModel):
@@ -21,15 +70,21 @@ class DocumentInfo(BaseModel):
     file_id: str
     file_name: str
     total_chunks: int
+    n_duplicate_chunks: int = 0
+    file_size: Optional[int] = None
     created_datetime_utc: datetime
     updated_datetime_utc: datetime
     is_archived: bool
 
+    model_config = ConfigDict(from_attributes=True)
+
 
 class DocumentInfoList(BaseModel):
-    """Pydantic model for the list of documents."""
+    """Pydantic model for a page of the list of documents. Pass `next_cursor` as
+    `cursor` to get the next page; it is None on the last page."""
 
     documents: list[DocumentInfo]
+    next_cursor: Optional[str] = None
 
 
 class DocumentChunk(BaseModel):
@@ -39,4 +94,5 @@ class DocumentChunk(BaseModel):
     chunk_id: int
     text: str
     distance: float
+    content_id: Optional[int] = None
     rerank_score: Optional[float] = None
@@ -0,0 +1,94 @@
+"""
+This module contains FastAPI routes for monitoring the backend
+"""
+
+from datetime import datetime, timedelta
+
+from fastapi import APIRouter, Depends, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..auth.dependencies import authenticate_key
+from ..chat.models import get_chat_usage_stats
+from ..chat.schemas import ChatUsageStats
+from ..database import get_async_session
+from ..services.utils.cancellation import CancellationStats, get_cancellation_tracker
+from ..services.utils.chat_writer import ChatWriterStats, get_chat_writer
+from ..services.utils.llm_gateway import LLMGatewayStats, get_llm_gateway
+from ..services.utils.metrics import generate_metrics
+from ..services.utils.structured_output import ModelParseStats, get_parse_stats
+from ..services.utils.tracing import Trace, get_slowest_traces
+
+router = APIRouter(
+    dependencies=[Depends(authenticate_key)], tags=["Monitoring endpoints"]
+)
+
+
+@router.get("/metrics", response_class=Response)
+async def metrics() -> Response:
+    """
+    This endpoint returns the Prometheus metrics of all the workers: HTTP and chat
+    stage latencies, LLM calls, tokens and parsing, model inference, database pool
+    and cache lookups
+    """
+    content, content_type = generate_metrics()
+    return Response(content=content, media_type=content_type)
+
+
+@router.get("/monitoring/llm_gateway", response_model=LLMGatewayStats)
+async def llm_gateway_stats() -> LLMGatewayStats:
+    """
+    This endpoint returns the state of the LLM gateway in this worker: calls in
+    flight and queued, mean wait and call times, and the number of rejected calls
+    """
+    return get_llm_gateway().stats()
+
+
+@router.get("/monitoring/chat_writer", response_model=ChatWriterStats)
+async def chat_writer_stats() -> ChatWriterStats:
+    """
+    This endpoint returns the state of the write-behind writer of chat requests and
+    responses in this worker: queued rows, rows written and dropped, batches, and
+    how often requests waited for space in the queue
+    """
+    return get_chat_writer().stats()
+
+
+@router.get("/monitoring/cancellations", response_model=CancellationStats)
+async def cancellation_stats() -> CancellationStats:
+    """
+    This endpoint returns the chat requests completed and cancelled in this worker
+    because their client disconnected, and the estimated stage seconds saved
+    """
+    return get_cancellation_tracker().stats()
+
+
+@router.get("/monitoring/llm_parsing", response_model=dict[str, ModelParseStats])
+async def llm_parsing_stats() -> dict[str, ModelParseStats]:
+    """
+    This endpoint returns, per LLM, how its responses in this worker were parsed:
+    as valid JSON, after repairing them, by extracting the answer, or not at all
+    """
+    return get_parse_stats().stats()
+
+
+@router.get("/monitoring/traces", response_model=list[Trace])
+async def slowest_traces() -> list[Trace]:
+    """
+    This endpoint returns the traces of the slowest requests of this worker kept
+    for the current hour, then those of the previous hour, slowest first
+    """
+    return get_slowest_traces().traces()
+
+
+@router.get("/monitoring/usage", response_model=ChatUsageStats)
+async def chat_usage_stats(
+    hours: float = Query(default=24, gt=0),
+    asession: AsyncSession = Depends(get_async_session),
+) -> ChatUsageStats:
+    """
+    This endpoint returns, for the responses of the last `hours`, the p50, p95 and
+    p99 seconds of each stage, and the tokens and completion tokens per second of
+    each LLM stage
+    """
+    since = datetime.utcnow() - timedelta(hours=hours)
+    return await get_chat_usage_stats(since, asession)
@@ -1,15 +1,43 @@
+from datetime import datetime
+
+from sqlalchemy import (
+    JSON,
+    ColumnElement,
+    Integer,
+    Select,
+    String,
+    literal,
+    null,
+    tuple_,
+    union_all,
+)
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy.orm import InstrumentedAttribute
 
-from ..chat.models import ChatRequestDB, ChatResponseDB
+from ..chat.config import (
+    CHAT_WRITE_BEHIND_ENABLED,
+    REFINEMENT_GATE_ENABLED,
+)
+from ..chat.models import ChatRequestDB, ChatResponseDB, ChatSummaryDB
 from ..chat.schemas import (
+    ChatContext,
     ChatHistory,
     ChatResponse,
     ChatUserMessage,
     ChatUserMessageBase,
     ChatUserMessageRefined,
 )
-from .utils.completion import get_refined_message, get_session_summary
+from ..utils import setup_logger
+from .utils.chat_writer import get_chat_writer
+from .utils.completion import get_summary_and_refined_message
+from .utils.history_cache import get_history_cache
+from .utils.llm_gateway import LLMOverloadedError
+from .utils.metrics import record_cache_lookup
+from .utils.refinement_gate import RefinementDecision, needs_refinement
+from .utils.tracing import span
+
+logger = setup_logger()
 
 
 class ChatService:
@@ -22,61 +50,359 @@ class ChatService:
         chat_request: ChatUserMessageBase, asession: AsyncSession
     ) -> ChatUserMessageRefined:
         """
-        Update chat request using history.
-
+        Update chat request using the rolling summary and the newest turns of the
+        chat. The updated summary is not saved.
         """
-
-        chat_request_refined = ChatUserMessageRefined.model_validate(chat_request)
-        chat_history = await ChatService.get_chat_history(
+        chat_context = await ChatService.get_chat_context(
             chat_request.chat_id, asession
         )
-        if chat_history:
-            session_summary = await get_session_summary(
-                chat_history, chat_request.message
+        return await ChatService.refine_request(chat_request, chat_context)
+
+    @staticmethod
+    def get_refinement_decision(
+        chat_request: ChatUserMessageBase, chat_context: ChatContext
+    ) -> RefinementDecision:
+        """
+        Decide whether the chat request needs to be refined using the chat
+        history. With the refinement gate disabled, every message in a chat with
+        history is refined.
+        """
+        if REFINEMENT_GATE_ENABLED != "True":
+            has_history = bool(chat_context.session_summary or chat_context.new_turns)
+            return RefinementDecision(
+                refine=has_history,
+                reason="gate_disabled" if has_history else "no_history",
             )
-            refined_message = await get_refined_message(
-                session_summary, chat_request.message
+        return needs_refinement(chat_request.message, chat_context)
+
+    @staticmethod
+    def unrefined_request(
+        chat_request: ChatUserMessageBase, chat_context: ChatContext
+    ) -> ChatUserMessageRefined:
+        """
+        The chat request as it is, with the current session summary, for when it is
+        not refined.
+        """
+        chat_request_refined = ChatUserMessageRefined.model_validate(chat_request)
+        chat_request_refined.session_summary = chat_context.session_summary
+        return chat_request_refined
+
+    @staticmethod
+    async def refine_request(
+        chat_request: ChatUserMessageBase,
+        chat_context: ChatContext,
+        decision: RefinementDecision | None = None,
+    ) -> ChatUserMessageRefined:
+        """
+        Refine the chat request using an already loaded chat context. The summary
+        and the refined message come from a single LLM call. If the chat has no
+        history, the message does not need refining (see
+        `get_refinement_decision`, used if `decision` is not given), the LLM is
+        overloaded or its response cannot be parsed, the message is returned
+        unchanged with the current summary. `message_original` is then None, so
+        the summary is not saved and the new turns stay unsummarised.
+        """
+        if decision is None:
+            decision = ChatService.get_refinement_decision(chat_request, chat_context)
+
+        chat_request_refined = ChatService.unrefined_request(chat_request, chat_context)
+        if not decision.refine:
+            return chat_request_refined
+
+        try:
+            refined = await get_summary_and_refined_message(
+                chat_context.session_summary,
+                chat_context.new_turns,
+                chat_request.message,
             )
-            chat_request_refined.message_original = chat_request.message
-            chat_request_refined.message = refined_message
-            chat_request_refined.session_summary = session_summary
+        except LLMOverloadedError:
+            # Answering matters more than refining: carry on with the message as
+            # it is and the summary as it was
+            logger.warning("LLM overloaded, skipping message refinement")
+            return chat_request_refined
+        if refined is None:
+            return chat_request_refined
+        chat_request_refined.message_original = chat_request.message
+        chat_request_refined.message = refined.refined_message
+        chat_request_refined.session_summary = refined.session_summary
 
         return chat_request_refined
 
     @staticmethod
-    async def get_chat_history(
+    async def get_chat_context(
         chat_id: str | None, asession: AsyncSession
+    ) -> ChatContext:
+        """
+        Get the rolling summary of a chat and all the answered exchanges that
+        happened after it was last updated, so that messages answered without
+        refinement are kept until the next refinement folds them into the
+        summary. The exchanges come from the chat history cache; with the cache
+        disabled, this is two small queries whatever the length of the chat.
+        """
+        if chat_id is None:
+            return ChatContext()
+
+        with span("db.chat_summary"):
+            summary_db = await asession.get(ChatSummaryDB, chat_id)
+        last_summarized_request_id = summary_db.last_request_id if summary_db else 0
+
+        if get_history_cache().enabled:
+            history = await ChatService.get_chat_history(chat_id, asession)
+            new_turns = _recent_turns(history, last_summarized_request_id)
+            return ChatContext(
+                session_summary=summary_db.summary if summary_db else None,
+                last_summarized_request_id=(
+                    summary_db.last_request_id if summary_db else None
+                ),
+                new_turns=new_turns,
+            )
+
+        await _flush_chat_writes()
+        stmt = (
+            select(ChatRequestDB, ChatResponseDB)
+            .join(ChatResponseDB, ChatResponseDB.request_id == ChatRequestDB.request_id)
+            .where(ChatRequestDB.chat_id == chat_id)
+            .where(ChatRequestDB.request_id > last_summarized_request_id)
+            .order_by(ChatRequestDB.request_id)
+        )
+        with span("db.history"):
+            rows = (await asession.execute(stmt)).all()
+
+        new_turns = []
+        for chat_request_db, chat_response_db in rows:
+            new_turns.append(ChatUserMessage.model_validate(chat_request_db))
+            new_turns.append(ChatResponse.model_validate(chat_response_db))
+
+        return ChatContext(
+            session_summary=summary_db.summary if summary_db else None,
+            last_summarized_request_id=(
+                summary_db.last_request_id if summary_db else None
+            ),
+            new_turns=new_turns,
+        )
+
+    @staticmethod
+    async def get_chat_history(
+        chat_id: str | None,
+        asession: AsyncSession,
+        before: datetime | None = None,
+        limit: int | None = None,
+        before_kind: str | None = None,
+        before_request_id: int | None = None,
     ) -> ChatHistory:
         """
-        Get chat history for a chat.
+        Get chat history for a chat, oldest message first, from the chat history
+        cache. On a cache miss it is read from the database, and cached if the
+        whole history was read.
 
-        Note: At present it is only retrieving it from Db. To make it
-        more performant, we can cache the chat history in redis.
+        Messages are ordered by creation time, then request id, with a request
+        before its response, so that messages created at the same time are in a
+        stable order across pages.
+
+        Parameters
+        ----------
+        chat_id
+            The chat to get the history of.
+        asession
+            The database session.
+        before
+            Only get messages created strictly before this time, e.g. the
+            `created_datetime_utc` of the oldest message of the previous page.
+        limit
+            Only get the newest `limit` messages (before `before`).
+        before_kind
+            With `before_request_id`, the kind of the oldest message of the
+            previous page, "request" or "response". Messages created at `before`
+            that come before that message are then included.
+        before_request_id
+            With `before_kind`, the request id of the oldest message of the
+            previous page.
         """
         if chat_id is None:
             return []
 
-        stmt_requests = (
-            select(ChatRequestDB)
-            .where(ChatRequestDB.chat_id == chat_id)
-            .order_by(ChatRequestDB.created_datetime_utc)
+        history_cache = get_history_cache()
+        with span("history_cache") as attributes:
+            history = await history_cache.get(chat_id)
+            attributes["hit"] = history is not None
+        record_cache_lookup("history", history is not None)
+        if history is not None:
+            if before is not None:
+                history = [
+                    m
+                    for m in history
+                    if _is_before(m, before, before_kind, before_request_id)
+                ]
+            if limit is not None:
+                history = history[max(0, len(history) - limit) :]
+            return history
+
+        is_full_history = before is None and limit is None
+        token = await history_cache.begin_load(chat_id) if is_full_history else None
+
+        await _flush_chat_writes()
+        stmt = _chat_history_query(
+            chat_id, before, limit, before_kind, before_request_id
         )
+        with span("db.history"):
+            rows = (await asession.execute(stmt)).mappings().all()
+        history = [
+            (
+                ChatResponse.model_validate(dict(row))
+                if row["kind"] == "response"
+                else ChatUserMessage.model_validate(dict(row))
+            )
+            for row in reversed(rows)
+        ]
 
-        chat_requests_db = (await asession.execute(stmt_requests)).scalars().all()
-        chat_requests = [ChatUserMessage.model_validate(c) for c in chat_requests_db]
+        if is_full_history:
+            await history_cache.set(chat_id, history, token)
+        return history
 
-        stmt_responses = (
-            select(ChatResponseDB)
-            .join(ChatRequestDB)
-            .where(ChatRequestDB.chat_id == chat_id)
-            .order_by(
+
+def _chat_history_query(
+    chat_id: str,
+    before: datetime | None,
+    limit: int | None,
+    before_kind: str | None = None,
+    before_request_id: int | None = None,
+) -> Select:
+    """
+    Build the query for the messages of a chat, newest first: requests and
+    responses in a single `UNION ALL`, each side read from its
+    `(chat_id, created_datetime_utc)` index. See `ChatService.get_chat_history`
+    for the order and the parameters.
+    """
+    requests = select(
+        literal("request").label("kind"),
+        ChatRequestDB.chat_id,
+        ChatRequestDB.created_datetime_utc,
+        ChatRequestDB.request_id,
+        ChatRequestDB.user_id,
+        ChatRequestDB.message,
+        ChatRequestDB.message_original,
+        ChatRequestDB.session_summary,
+        null().cast(Integer).label("response_id"),
+        null().cast(String).label("response"),
+        null().cast(JSON).label("response_metadata"),
+    ).where(ChatRequestDB.chat_id == chat_id)
+    responses = select(
+        literal("response").label("kind"),
+        ChatResponseDB.chat_id,
+        ChatResponseDB.created_datetime_utc,
+        ChatResponseDB.request_id,
+        null().cast(Integer).label("user_id"),
+        null().cast(String).label("message"),
+        null().cast(String).label("message_original"),
+        null().cast(String).label("session_summary"),
+        ChatResponseDB.response_id,
+        ChatResponseDB.response,
+        ChatResponseDB.response_metadata,
+    ).where(ChatResponseDB.chat_id == chat_id)
+
+    if before is not None:
+        requests = requests.where(
+            _before_clause(
+                "request",
+                ChatRequestDB.created_datetime_utc,
+                ChatRequestDB.request_id,
+                before,
+                before_kind,
+                before_request_id,
+            )
+        )
+        responses = responses.where(
+            _before_clause(
+                "response",
                 ChatResponseDB.created_datetime_utc,
+                ChatResponseDB.request_id,
+                before,
+                before_kind,
+                before_request_id,
             )
         )
+    if limit is not None:
+        # Each side only needs its newest `limit` rows, which its index gives
+        # without reading the rest of the chat
+        requests = requests.order_by(
+            ChatRequestDB.created_datetime_utc.desc(), ChatRequestDB.request_id.desc()
+        ).limit(limit)
+        responses = responses.order_by(
+            ChatResponseDB.created_datetime_utc.desc(),
+            ChatResponseDB.request_id.desc(),
+        ).limit(limit)
 
-        chat_responses_db = (await asession.execute(stmt_responses)).scalars().all()
-        chat_responses = [ChatResponse.model_validate(c) for c in chat_responses_db]
+    messages = union_all(requests, responses).subquery()
+    stmt = select(messages).order_by(
+        messages.c.created_datetime_utc.desc(),
+        messages.c.request_id.desc(),
+        messages.c.kind.desc(),
+    )
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
 
-        return sorted(
-            [*chat_requests, *chat_responses], key=lambda x: x.created_datetime_utc
-        )
+
+def _before_clause(
+    kind: str,
+    created_datetime_utc: InstrumentedAttribute,
+    request_id: InstrumentedAttribute,
+    before: datetime,
+    before_kind: str | None,
+    before_request_id: int | None,
+) -> ColumnElement[bool]:
+    """
+    Filter one side of the history query, whose messages are all of `kind`, to
+    the messages before the cursor in the order of `_chat_history_query`.
+    """
+    if before_kind is None or before_request_id is None:
+        return created_datetime_utc < before
+    key = tuple_(created_datetime_utc, request_id)
+    cursor = tuple_(literal(before), literal(before_request_id))
+    # A request is before the response to it
+    return key <= cursor if kind < before_kind else key < cursor
+
+
+def _is_before(
+    message: ChatUserMessage | ChatResponse,
+    before: datetime,
+    before_kind: str | None,
+    before_request_id: int | None,
+) -> bool:
+    """Whether a cached message is before the cursor, as in `_before_clause`."""
+    if before_kind is None or before_request_id is None:
+        return message.created_datetime_utc < before
+    kind = "response" if isinstance(message, ChatResponse) else "request"
+    return (message.created_datetime_utc, message.request_id, kind) < (
+        before,
+        before_request_id,
+        before_kind,
+    )
+
+
+async def _flush_chat_writes() -> None:
+    """Wait for queued chat writes to be committed before reading the database."""
+    if CHAT_WRITE_BEHIND_ENABLED == "True":
+        await get_chat_writer().flush()
+
+
+def _recent_turns(history: ChatHistory, after_request_id: int) -> ChatHistory:
+    """
+    Get the answered exchanges in a chat history whose request id is greater
+    than `after_request_id`, as request, response pairs.
+    """
+    responses = {m.request_id: m for m in history if isinstance(m, ChatResponse)}
+    requests = sorted(
+        (
+            m
+            for m in history
+            if isinstance(m, ChatUserMessage)
+            and m.request_id > after_request_id
+            and m.request_id in responses
+        ),
+        key=lambda m: m.request_id,
+    )
+    new_turns: ChatHistory = []
+    for request in requests:
+        new_turns.extend([request, responses[request.request_id]])
+    return new_turns
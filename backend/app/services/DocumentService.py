@@ -1,32 +1,95 @@
+import asyncio
+import base64
+import hashlib
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from typing import List, Optional
+from typing import Any, List, Optional
 from uuid import uuid4
 
 from fastapi import Request
 from numpy import ndarray
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.sql import func, select
+from sqlalchemy.sql import Select, func, literal, select, tuple_
 
-from ..ingestion.models import DocumentDB
-from ..ingestion.schemas import DocumentChunk, DocumentInfo, DocumentInfoList
+from ..config import (
+    DEDUP_MODE,
+    DEDUP_SIMILARITY_THRESHOLD,
+    INGESTION_BATCH_CHUNKS,
+    INGESTION_EMBED_WORKERS,
+    INGESTION_PARSE_WORKERS,
+    INGESTION_QUEUE_SIZE,
+    INGESTION_WRITE_WORKERS,
+    PGVECTOR_M,
+    PGVECTOR_VECTOR_SIZE,
+)
+from ..database import get_async_session_context_manager
+from ..ingestion.models import (
+    ChunkDuplicateDB,
+    ChunkFingerprintDB,
+    DocumentDB,
+    FileDB,
+)
+from ..ingestion.schemas import (
+    DedupReport,
+    DocumentChunk,
+    DocumentInfo,
+    DocumentInfoList,
+    IngestionResponse,
+    StageMetrics,
+    TextChunk,
+)
+from ..services.utils.dedup import (
+    estimate_similarity,
+    lsh_band_hashes,
+    minhash_signature,
+)
 from ..services.utils.embeddings import create_embeddings
+from ..services.utils.inference import run_inference
 from ..services.utils.parse_file import parse_file
+from ..services.utils.pipeline import Pipeline, PipelineResult, Stage
+from ..services.utils.tracing import span
 from ..utils import setup_logger
+from .SemanticCacheService import SemanticCacheService
 
 logger = setup_logger()
 
 
+@dataclass
+class _ChunkBatch:
+    """A batch of consecutive chunks of a file being ingested."""
+
+    file_id: str
+    file_name: str
+    file_size: int
+    n_chunks: int
+    n_batches: int
+    first_chunk_id: int
+    chunks: list[TextChunk]
+    embeddings: list[ndarray] = field(default_factory=list)
+
+
+@dataclass
+class _FileTransaction:
+    """The transaction a file's batches are written in, until all are written."""
+
+    session: AsyncSession | None = None
+    n_written: int = 0
+    n_duplicates: int = 0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
 class DocumentService:
     """
     Service class for handling document ingestion and retrieval.
     """
 
     @staticmethod
-    async def parse_file(file: bytes) -> List[str]:
+    async def parse_file(file: bytes) -> List[TextChunk]:
         """Parse the content of an uploaded file into chunks.
 
-        For PDFs, each page is treated as its own chunk.
-        For text files, the content is split into chunks of fixed size.
+        By default, the text is split into chunks sized in tokens of the embedding
+        model. See `CHUNKING_STRATEGY` for the legacy per-page strategy.
 
         Parameters
         ----------
@@ -35,52 +98,526 @@ class DocumentService:
 
         Returns
         -------
-        List[str]
-            A list of text chunks extracted from the file.
+        List[TextChunk]
+            A list of text chunks extracted from the file, with their token counts.
         """
         return await parse_file(file)
 
     @staticmethod
     async def save_document(
-        text_embeddings: List[tuple[str, ndarray]],
+        text_embeddings: List[tuple[TextChunk, ndarray]],
         file_name: str,
+        file_size: int,
         session: AsyncSession,
-    ) -> str:
+    ) -> IngestionResponse:
         """
-        Save document embeddings to the database.
+        Save document embeddings to the database, along with a summary row for the
+        file in the `files` table.
+
+        Unless `DEDUP_MODE` is "off", chunks that are near-duplicates of a chunk
+        already in the database (or earlier in the same file) are not stored. In
+        "link" mode they are recorded in `chunk_duplicates` with a reference to the
+        chunk they duplicate; in "skip" mode they are only counted, in the file's
+        summary row. A file whose chunks are all duplicates is still listed.
 
         Parameters
         ----------
-        text_embeddings : List[Tuple[str, ndarray]]
-            A list of tuples where each tuple has text and its embedding vector.
+        text_embeddings : List[Tuple[TextChunk, ndarray]]
+            A list of tuples where each tuple has a text chunk and its embedding
+            vector.
         file_name : str
             The name of the document file.
+        file_size : int
+            The size of the uploaded file in bytes.
         session : AsyncSession
             The async session for database interaction.
 
         Returns
         -------
-        str
-            The unique file_id generated for the saved document.
+        IngestionResponse
+            The unique file_id generated for the saved document, with the number of
+            chunks parsed and the number of near-duplicate chunks.
+        """
+        (response,) = await DocumentService.save_documents(
+            [(file_name, file_size, text_embeddings)], session
+        )
+        return response
+
+    @staticmethod
+    async def save_documents(
+        files: list[tuple[str, int, List[tuple[TextChunk, ndarray]]]],
+        session: AsyncSession,
+    ) -> list[IngestionResponse]:
+        """
+        Save several files in one transaction, with one multi-row INSERT per table,
+        e.g. to bulk-load a corpus. Chunks are deduplicated as in `save_document`,
+        against the database, earlier files of the batch and earlier chunks of the
+        same file.
+
+        Parameters
+        ----------
+        files
+            A list of (file name, file size in bytes, text chunks and their
+            embeddings) tuples.
+        session
+            The async session for database interaction.
+
+        Returns
+        -------
+        list[IngestionResponse]
+            One response per file, in order.
+        """
+        if not files:
+            return []
+        file_ids = [str(uuid4()) for _ in files]
+        n_duplicates = await DocumentService.insert_chunks(
+            [
+                (file_id, 0, text_embeddings)
+                for file_id, (_, _, text_embeddings) in zip(file_ids, files)
+            ],
+            session,
+        )
+        responses = await DocumentService.insert_files(
+            [
+                (file_id, file_name, file_size, len(text_embeddings), n)
+                for file_id, (file_name, file_size, text_embeddings), n in zip(
+                    file_ids, files, n_duplicates
+                )
+            ],
+            session,
+        )
+        # The new files change the corpus version, so that cached answers are only
+        # reused if the same content is retrieved for them. Drop expired ones.
+        await SemanticCacheService.evict_expired(session)
+        await session.commit()
+        await session.rollback()
+
+        return responses
+
+    @staticmethod
+    async def insert_chunks(
+        batches: list[tuple[str, int, List[tuple[TextChunk, ndarray]]]],
+        session: AsyncSession,
+    ) -> list[int]:
+        """
+        Insert batches of chunks of files, with one multi-row INSERT per table,
+        without committing. Chunks are deduplicated as in `save_document`, against
+        the database, including chunks inserted earlier in the same transaction,
+        and earlier chunks of the batches.
+
+        Parameters
+        ----------
+        batches
+            A list of (file_id, chunk_id of the first chunk, text chunks and their
+            embeddings) tuples.
+        session
+            The async session for database interaction.
+
+        Returns
+        -------
+        list[int]
+            The number of near-duplicate chunks of each batch, which were not
+            stored.
         """
-        documents = []
-        file_id = str(uuid4())
-        for chunk_id, (text, embedding_vector) in enumerate(text_embeddings):
-            document = DocumentDB(
+        now = datetime.now(timezone.utc)
+        deduplicate = DEDUP_MODE != "off"
+
+        document_rows: list[dict[str, Any]] = []
+        # Fingerprints of the new document rows, in the same order, if deduplicating
+        new_signatures: list[list[int]] = []
+        new_band_hashes: list[list[int]] = []
+        # (file_id, chunk_id, text, content_id of a stored chunk or index in
+        # `document_rows`, similarity)
+        duplicates: list[tuple[str, int, str, int | None, int | None, float]] = []
+        n_duplicates_by_batch: list[int] = []
+
+        # Map LSH band hashes to stored chunks and to new chunks of these batches
+        existing_by_band: dict[int, list[tuple[int, list[int]]]] = {}
+        new_by_band: dict[int, list[int]] = {}
+        if deduplicate:
+            signatures = [
+                [minhash_signature(chunk.text) for chunk, _ in text_embeddings]
+                for _, _, text_embeddings in batches
+            ]
+            band_hashes = [
+                [lsh_band_hashes(signature) for signature in batch_signatures]
+                for batch_signatures in signatures
+            ]
+            candidates = await DocumentService.get_fingerprint_candidates(
+                [
+                    h
+                    for batch_hashes in band_hashes
+                    for hashes in batch_hashes
+                    for h in hashes
+                ],
+                session,
+            )
+            for content_id, signature, hashes in candidates:
+                for h in hashes:
+                    existing_by_band.setdefault(h, []).append((content_id, signature))
+
+        for batch_index, (file_id, first_chunk_id, text_embeddings) in enumerate(
+            batches
+        ):
+            n_duplicates = 0
+            for i, (chunk, embedding_vector) in enumerate(text_embeddings):
+                chunk_id = first_chunk_id + i
+                if deduplicate:
+                    signature = signatures[batch_index][i]
+                    hashes = band_hashes[batch_index][i]
+                    duplicate = DocumentService._find_duplicate(
+                        signature, hashes, existing_by_band, new_by_band, new_signatures
+                    )
+                    if duplicate is not None:
+                        duplicates.append((file_id, chunk_id, chunk.text, *duplicate))
+                        n_duplicates += 1
+                        continue
+                    for h in hashes:
+                        new_by_band.setdefault(h, []).append(len(document_rows))
+                    new_signatures.append(signature)
+                    new_band_hashes.append(hashes)
+
+                document_rows.append(
+                    {
+                        "file_id": file_id,
+                        "chunk_id": chunk_id,
+                        "text": chunk.text,
+                        "n_tokens": chunk.n_tokens,
+                        "embedding_vector": embedding_vector,
+                        "created_datetime_utc": now,
+                        "updated_datetime_utc": now,
+                        "is_archived": False,
+                    }
+                )
+            n_duplicates_by_batch.append(n_duplicates)
+
+        content_ids: list[int] = []
+        if document_rows:
+            result = await session.execute(
+                insert(DocumentDB).returning(
+                    DocumentDB.content_id, sort_by_parameter_order=True
+                ),
+                document_rows,
+            )
+            content_ids = list(result.scalars())
+        if new_signatures:
+            await session.execute(
+                insert(ChunkFingerprintDB),
+                [
+                    {"content_id": c, "signature": s, "band_hashes": h}
+                    for c, s, h in zip(content_ids, new_signatures, new_band_hashes)
+                ],
+            )
+        if duplicates and DEDUP_MODE == "link":
+            await session.execute(
+                insert(ChunkDuplicateDB),
+                [
+                    {
+                        "file_id": file_id,
+                        "chunk_id": chunk_id,
+                        "duplicate_of_content_id": (
+                            content_id if index is None else content_ids[index]
+                        ),
+                        "similarity": similarity,
+                        "n_text_bytes": len(text.encode()),
+                        "created_datetime_utc": now,
+                    }
+                    for file_id, chunk_id, text, content_id, index, similarity in (
+                        duplicates
+                    )
+                ],
+            )
+        return n_duplicates_by_batch
+
+    @staticmethod
+    async def insert_files(
+        files: list[tuple[str, str, int, int, int]],
+        session: AsyncSession,
+    ) -> list[IngestionResponse]:
+        """
+        Insert the summary rows of files whose chunks were inserted, without
+        committing, and log those with near-duplicate chunks.
+
+        Parameters
+        ----------
+        files
+            A list of (file_id, file name, file size in bytes, number of chunks,
+            number of near-duplicate chunks) tuples.
+        session
+            The async session for database interaction.
+
+        Returns
+        -------
+        list[IngestionResponse]
+            One response per file, in order.
+        """
+        now = datetime.now(timezone.utc)
+        await session.execute(
+            insert(FileDB),
+            [
+                {
+                    "file_id": file_id,
+                    "file_name": file_name,
+                    "total_chunks": n_chunks - n_duplicates,
+                    "n_duplicate_chunks": n_duplicates,
+                    "file_size": file_size,
+                    "created_datetime_utc": now,
+                    "updated_datetime_utc": now,
+                    "is_archived": False,
+                }
+                for file_id, file_name, file_size, n_chunks, n_duplicates in files
+            ],
+        )
+        for _, file_name, _, n_chunks, n_duplicates in files:
+            if n_duplicates and n_duplicates == n_chunks:
+                logger.warning(
+                    f"All {n_duplicates} chunks of {file_name} are near-duplicates "
+                    "of stored chunks, so it adds no searchable content"
+                )
+            elif n_duplicates:
+                logger.info(
+                    f"Skipped {n_duplicates} near-duplicate chunks out of "
+                    f"{n_chunks} in {file_name}"
+                )
+        return [
+            IngestionResponse(
                 file_name=file_name,
                 file_id=file_id,
-                chunk_id=chunk_id,
-                text=text,
-                embedding_vector=embedding_vector,
-                created_datetime_utc=datetime.now(timezone.utc),
-                updated_datetime_utc=datetime.now(timezone.utc),
+                total_chunks=n_chunks,
+                n_duplicate_chunks=n_duplicates,
             )
-            documents.append(document)
+            for file_id, file_name, _, n_chunks, n_duplicates in files
+        ]
 
-        session.add_all(documents)
-        await session.commit()
-        await session.rollback()
-        return file_id
+    @staticmethod
+    async def ingest_files(
+        files: list[tuple[str, bytes]],
+    ) -> tuple[list[PipelineResult], list[StageMetrics]]:
+        """
+        Parse, embed and save files through a pipeline of concurrent stages
+        connected by bounded queues. Each file is split into batches of
+        `INGESTION_BATCH_CHUNKS` chunks that are embedded and written separately,
+        so that one batch is embedded while the previous one is written to the
+        database, within a file as across files. The batches of a file are
+        written in one transaction, committed once all of them are written.
+
+        Parameters
+        ----------
+        files
+            A list of (file name, file content) tuples.
+
+        Returns
+        -------
+        tuple[list[PipelineResult], list[StageMetrics]]
+            One result per file, in order, whose value is an `IngestionResponse`
+            unless the file failed, and the throughput and queue occupancy of each
+            stage, whose items are batches after parsing.
+        """
+        file_ids = [str(uuid4()) for _ in files]
+        # The open transaction of each file being written, with a lock so that
+        # concurrent writers do not use it at the same time
+        transactions: dict[str, _FileTransaction] = {}
+
+        async def parse(index: int) -> list[_ChunkBatch]:
+            """Parse a file and split its chunks into batches."""
+            file_name, content = files[index]
+            chunks = await DocumentService.parse_file(content)
+            n_batches = max(1, -(-len(chunks) // INGESTION_BATCH_CHUNKS))
+            return [
+                _ChunkBatch(
+                    file_id=file_ids[index],
+                    file_name=file_name,
+                    file_size=len(content),
+                    n_chunks=len(chunks),
+                    n_batches=n_batches,
+                    first_chunk_id=i * INGESTION_BATCH_CHUNKS,
+                    chunks=chunks[
+                        i * INGESTION_BATCH_CHUNKS : (i + 1) * INGESTION_BATCH_CHUNKS
+                    ],
+                )
+                for i in range(n_batches)
+            ]
+
+        async def embed(batch: _ChunkBatch) -> _ChunkBatch:
+            """Embed the chunks of a batch."""
+            if batch.chunks:
+                batch.embeddings = list(
+                    await DocumentService.create_embeddings(
+                        [chunk.text for chunk in batch.chunks]
+                    )
+                )
+            return batch
+
+        async def write(batch: _ChunkBatch) -> IngestionResponse | None:
+            """Insert a batch in its file's transaction. Once all the batches of
+            the file are in, insert the file's row and commit."""
+            transaction = transactions.setdefault(batch.file_id, _FileTransaction())
+            async with transaction.lock:
+                if transaction.session is None:
+                    transaction.session = get_async_session_context_manager()
+                session = transaction.session
+                (n_duplicates,) = await DocumentService.insert_chunks(
+                    [
+                        (
+                            batch.file_id,
+                            batch.first_chunk_id,
+                            list(zip(batch.chunks, batch.embeddings)),
+                        )
+                    ],
+                    session,
+                )
+                transaction.n_duplicates += n_duplicates
+                transaction.n_written += 1
+                if transaction.n_written < batch.n_batches:
+                    return None
+
+                (response,) = await DocumentService.insert_files(
+                    [
+                        (
+                            batch.file_id,
+                            batch.file_name,
+                            batch.file_size,
+                            batch.n_chunks,
+                            transaction.n_duplicates,
+                        )
+                    ],
+                    session,
+                )
+                await SemanticCacheService.evict_expired(session)
+                await session.commit()
+                return response
+
+        pipeline = Pipeline(
+            [
+                Stage(
+                    "parse",
+                    parse,
+                    INGESTION_PARSE_WORKERS,
+                    INGESTION_QUEUE_SIZE,
+                    split=True,
+                ),
+                Stage("embed", embed, INGESTION_EMBED_WORKERS, INGESTION_QUEUE_SIZE),
+                Stage("write", write, INGESTION_WRITE_WORKERS, INGESTION_QUEUE_SIZE),
+            ]
+        )
+        try:
+            batch_results = await pipeline.run(range(len(files)))
+        finally:
+            # Files with a failed batch were not committed: roll them back
+            for transaction in transactions.values():
+                if transaction.session is not None:
+                    await transaction.session.close()
+
+        # One result per file: its response, or the first error of its batches
+        results = [PipelineResult(index=index) for index in range(len(files))]
+        for batch_result in batch_results:
+            result = results[batch_result.index]
+            if batch_result.error is not None and result.error is None:
+                result.error = batch_result.error
+                result.failed_stage = batch_result.failed_stage
+            elif batch_result.value is not None:
+                result.value = batch_result.value
+        for result in results:
+            if result.error is not None:
+                result.value = None
+
+        for metrics in pipeline.metrics:
+            logger.info(
+                f"Ingestion stage {metrics.name}: {metrics.n_items} items, "
+                f"{metrics.items_per_second:.2f} items/s, "
+                f"utilisation {metrics.utilisation:.0%}, "
+                f"mean queue occupancy {metrics.mean_queue_occupancy:.0%}"
+            )
+
+        return results, pipeline.metrics
+
+    @staticmethod
+    async def get_fingerprint_candidates(
+        band_hashes: list[int], session: AsyncSession
+    ) -> list[tuple[int, list[int], list[int]]]:
+        """
+        Return the stored fingerprints that share at least one LSH band hash with
+        `band_hashes`, as tuples of content_id, signature and band hashes.
+        """
+        if not band_hashes:
+            return []
+        query = select(
+            ChunkFingerprintDB.content_id,
+            ChunkFingerprintDB.signature,
+            ChunkFingerprintDB.band_hashes,
+        ).where(ChunkFingerprintDB.band_hashes.overlap(list(set(band_hashes))))
+        rows = (await session.execute(query)).all()
+        return [(row.content_id, row.signature, row.band_hashes) for row in rows]
+
+    @staticmethod
+    def _find_duplicate(
+        signature: list[int],
+        band_hashes: list[int],
+        existing_by_band: dict[int, list[tuple[int, list[int]]]],
+        new_by_band: dict[int, list[int]],
+        new_signatures: list[list[int]],
+    ) -> tuple[int | None, int | None, float] | None:
+        """
+        Return the most similar candidate above `DEDUP_SIMILARITY_THRESHOLD` as
+        (content_id, None, similarity) for a stored chunk or (None, index,
+        similarity) for a new chunk, with its index in `new_signatures`.
+        """
+        best: tuple[int | None, int | None, float] | None = None
+        seen_existing: set[int] = set()
+        seen_new: set[int] = set()
+        for h in band_hashes:
+            for content_id, candidate in existing_by_band.get(h, []):
+                if content_id in seen_existing:
+                    continue
+                seen_existing.add(content_id)
+                similarity = estimate_similarity(signature, candidate)
+                if similarity >= DEDUP_SIMILARITY_THRESHOLD and (
+                    best is None or similarity > best[2]
+                ):
+                    best = (content_id, None, similarity)
+            for index in new_by_band.get(h, []):
+                if index in seen_new:
+                    continue
+                seen_new.add(index)
+                similarity = estimate_similarity(signature, new_signatures[index])
+                if similarity >= DEDUP_SIMILARITY_THRESHOLD and (
+                    best is None or similarity > best[2]
+                ):
+                    best = (None, index, similarity)
+        return best
+
+    @staticmethod
+    async def get_dedup_report(session: AsyncSession) -> DedupReport:
+        """
+        Report the storage saved by not storing near-duplicate chunks, in "skip"
+        and "link" mode. The text saved is only known for chunks linked in "link"
+        mode. Vector and index sizes are estimates based on pgvector's on-disk
+        layout: 4 bytes per dimension plus an 8-byte header per vector, and 2 * M
+        neighbour pointers of 6 bytes each on the bottom layer of the HNSW graph.
+        """
+        files_query = select(
+            func.coalesce(func.sum(FileDB.n_duplicate_chunks), 0).label(
+                "n_duplicate_chunks"
+            ),
+            func.count().filter(FileDB.n_duplicate_chunks > 0).label("n_files"),
+            func.count()
+            .filter(FileDB.n_duplicate_chunks > 0, FileDB.total_chunks == 0)
+            .label("n_files_all_duplicates"),
+        )
+        row = (await session.execute(files_query)).one()
+        text_query = select(func.coalesce(func.sum(ChunkDuplicateDB.n_text_bytes), 0))
+        text_bytes = (await session.execute(text_query)).scalar_one()
+
+        vector_bytes = 4 * int(PGVECTOR_VECTOR_SIZE) + 8
+        index_bytes = vector_bytes + 2 * int(PGVECTOR_M) * 6
+        return DedupReport(
+            n_duplicate_chunks=row.n_duplicate_chunks,
+            n_files_with_duplicates=row.n_files,
+            n_files_all_duplicates=row.n_files_all_duplicates,
+            text_bytes_saved=text_bytes,
+            vector_bytes_saved=row.n_duplicate_chunks * vector_bytes,
+            index_bytes_saved_estimate=row.n_duplicate_chunks * index_bytes,
+        )
 
     @staticmethod
     async def get_document(
@@ -111,41 +648,117 @@ class DocumentService:
     @staticmethod
     async def list_all_docs(
         session: AsyncSession,
+        limit: int,
+        cursor: Optional[str] = None,
+        is_archived: Optional[bool] = None,
+        file_name: Optional[str] = None,
     ) -> DocumentInfoList:
         """
-        List all documents in the database, only returning the name of the file,
-        the total number of chunks associated with it, when it was uploaded,
-        and when it was last updated.
+        List documents in the database, newest first, only returning the name of
+        the file, the total number of chunks associated with it, its size, when it
+        was uploaded, and when it was last updated.
+
+        Documents are read from the `files` table with keyset pagination, so the
+        cost of a page does not depend on how many documents come before it.
+
+        Parameters
+        ----------
+        session
+            AsyncSession object for database transactions.
+        limit
+            The maximum number of documents to return.
+        cursor
+            The `next_cursor` of the previous page, if any.
+        is_archived
+            If given, only return documents with this archived status.
+        file_name
+            If given, only return documents whose name contains this string
+            (case-insensitive).
+
+        Returns
+        -------
+        DocumentInfoList
+            A page of documents and the cursor of the next page.
         """
-        query = select(
-            DocumentDB.file_id,
-            DocumentDB.file_name,
-            DocumentDB.is_archived,
-            func.count(DocumentDB.chunk_id).label("total_chunks"),
-            func.min(DocumentDB.created_datetime_utc).label("created_datetime_utc"),
-            func.max(DocumentDB.updated_datetime_utc).label("updated_datetime_utc"),
-        ).group_by(
-            DocumentDB.file_id,
-            DocumentDB.file_name,
-            DocumentDB.is_archived,
+        query = DocumentService._filter_files(select(FileDB), is_archived, file_name)
+        if cursor is not None:
+            created_datetime_utc, file_id = DocumentService._decode_cursor(cursor)
+            query = query.where(
+                tuple_(FileDB.created_datetime_utc, FileDB.file_id)
+                < tuple_(literal(created_datetime_utc), literal(file_id))
+            )
+        query = query.order_by(
+            FileDB.created_datetime_utc.desc(), FileDB.file_id.desc()
+        ).limit(limit + 1)
+
+        files = (await session.execute(query)).scalars().all()
+        documents = [DocumentInfo.model_validate(f) for f in files[:limit]]
+        next_cursor = (
+            DocumentService._encode_cursor(files[limit - 1])
+            if len(files) > limit
+            else None
         )
 
-        result = await session.execute(query)
-        rows = result.fetchall()
-
-        documents = [
-            DocumentInfo(
-                file_id=row.file_id,
-                file_name=row.file_name,
-                is_archived=row.is_archived,
-                total_chunks=row.total_chunks,
-                created_datetime_utc=row.created_datetime_utc,
-                updated_datetime_utc=row.updated_datetime_utc,
-            )
-            for row in rows
-        ]
+        return DocumentInfoList(documents=documents, next_cursor=next_cursor)
+
+    @staticmethod
+    async def get_list_etag(
+        session: AsyncSession,
+        limit: int,
+        cursor: Optional[str] = None,
+        is_archived: Optional[bool] = None,
+        file_name: Optional[str] = None,
+    ) -> str:
+        """
+        Get an ETag for a page of `list_all_docs`, without reading the page. It
+        changes when a file matching the filters is added or updated, since files
+        are only ever inserted and their `updated_datetime_utc` set on update.
+        Raises ValueError if the cursor is invalid.
+        """
+        if cursor is not None:
+            DocumentService._decode_cursor(cursor)
+        query = DocumentService._filter_files(
+            select(func.count(FileDB.file_id), func.max(FileDB.updated_datetime_utc)),
+            is_archived,
+            file_name,
+        )
+        n_files, last_updated = (await session.execute(query)).one()
+        key = "|".join(
+            map(str, [n_files, last_updated, limit, cursor, is_archived, file_name])
+        )
+        return f'W/"{hashlib.sha256(key.encode()).hexdigest()}"'
+
+    @staticmethod
+    def _filter_files(
+        query: Select, is_archived: Optional[bool], file_name: Optional[str]
+    ) -> Select:
+        """
+        Apply the filters of `list_all_docs` to a query on `files`.
+        """
+        if is_archived is not None:
+            query = query.where(FileDB.is_archived == is_archived)
+        if file_name:
+            query = query.where(FileDB.file_name.icontains(file_name, autoescape=True))
+        return query
 
-        return DocumentInfoList(documents=documents)
+    @staticmethod
+    def _encode_cursor(file: FileDB) -> str:
+        """
+        Encode the sort key of a file into an opaque pagination cursor.
+        """
+        key = f"{file.created_datetime_utc.isoformat()}|{file.file_id}"
+        return base64.urlsafe_b64encode(key.encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> tuple[datetime, str]:
+        """
+        Decode a pagination cursor. Raises ValueError if the cursor is invalid.
+        """
+        try:
+            created, file_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+            return datetime.fromisoformat(created), file_id
+        except (ValueError, UnicodeDecodeError) as e:
+            raise ValueError(f"Invalid cursor: {cursor}") from e
 
     @staticmethod
     async def get_similar_n_chunks(
@@ -173,7 +786,8 @@ class DocumentService:
             "distance"
         )
         query = select(DocumentDB, distance).order_by(distance).limit(n_similar)
-        search_results = (await asession.execute(query)).all()
+        with span("db.vector_search", n_similar=n_similar):
+            search_results = (await asession.execute(query)).all()
 
         results_dict = {}
         for i, r in enumerate(search_results):
@@ -182,6 +796,7 @@ class DocumentService:
                 chunk_id=r[0].chunk_id,
                 text=r[0].text,
                 distance=r[1],
+                content_id=r[0].content_id,
             )
 
         return results_dict
@@ -198,7 +813,9 @@ class DocumentService:
         """
         encoder = request.app.state.crossencoder
         contents = similar_chunks.values()
-        scores = encoder.predict([(query_text, content.text) for content in contents])
+        scores = await run_inference(
+            encoder.predict, [(query_text, content.text) for content in contents]
+        )
 
         sorted_by_score = [
             DocumentService.add_rerank_score(content, score)
@@ -220,4 +837,5 @@ class DocumentService:
             text=content.text,
             distance=content.distance,
             rerank_score=score,
+            content_id=content.content_id,
         )
@@ -0,0 +1,263 @@
+import asyncio
+import hashlib
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+from pydantic import BaseModel
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..chat.config import (
+    IDEMPOTENCY_DEDUP_WITHOUT_KEY,
+    IDEMPOTENCY_KEY_TTL_SECONDS,
+    IDEMPOTENCY_LEASE_SECONDS,
+    IDEMPOTENCY_WAIT_TIMEOUT_SECONDS,
+    IDEMPOTENCY_WINDOW_SECONDS,
+)
+from ..chat.models import ChatIdempotencyDB
+from ..chat.schemas import ChatUserMessageBase
+from ..database import get_async_session_context_manager
+from ..utils import setup_logger
+from .utils.cancellation import ClientDisconnectedError
+
+logger = setup_logger()
+
+POLL_INTERVAL_SECONDS = 0.25
+
+# Requests in progress in this process, with the hash of the request their key
+# was used for, so that duplicates in the same worker wait on a future instead of
+# polling the database
+_in_flight: dict[str, tuple[asyncio.Future, str | None]] = {}
+
+
+class _FirstRequestCancelledError(Exception):
+    """The request that duplicates in this process were waiting for was cancelled,
+    or its client disconnected, so one of them runs it instead."""
+
+
+class IdempotencyKeyReusedError(Exception):
+    """An idempotency key was reused for a different request."""
+
+
+class IdempotencyService:
+    """
+    Service class for running a request only once, whatever the number of
+    duplicate requests and workers.
+
+    The first request for a key claims it in the `chat_idempotency` table and
+    stores its result there. Duplicates in the same process await the first
+    request directly; duplicates in other processes poll the table until the
+    result is available. The first request renews its claim while it runs, so
+    that a slow request is not mistaken for a dead one and run again.
+    """
+
+    @staticmethod
+    def get_key(
+        chat_request: ChatUserMessageBase, idempotency_key: str | None
+    ) -> tuple[str, int, str | None] | None:
+        """
+        Get the idempotency key for a chat request, how long it is kept, in
+        seconds, and the hash of the request it is used for.
+
+        A client-supplied key is bound to the hash of the whole request, so that
+        reusing it for a different request is rejected. Without one, the key is a
+        hash of the chat id, user and message, kept for a short window, if
+        `IDEMPOTENCY_DEDUP_WITHOUT_KEY` is enabled; otherwise there is no key and
+        the same message sent twice is answered twice.
+        """
+        if idempotency_key is not None:
+            return (
+                f"key:{chat_request.user_id}:{idempotency_key}",
+                IDEMPOTENCY_KEY_TTL_SECONDS,
+                hashlib.sha256(chat_request.model_dump_json().encode()).hexdigest(),
+            )
+        if IDEMPOTENCY_DEDUP_WITHOUT_KEY != "True":
+            return None
+        digest = hashlib.sha256(
+            f"{chat_request.chat_id}\n{chat_request.user_id}\n{chat_request.message}".encode()
+        ).hexdigest()
+        return f"hash:{digest}", IDEMPOTENCY_WINDOW_SECONDS, None
+
+    @staticmethod
+    async def run_once(
+        key: str,
+        ttl_seconds: int,
+        request_hash: str | None,
+        func: Callable[[], Awaitable[BaseModel]],
+    ) -> dict:
+        """
+        Run `func` unless a request with the same key has already run or is
+        running, and return its result as a JSON-compatible dict. If the request
+        that duplicates in this process are waiting for is cancelled, or its
+        client disconnects, one of them claims the key and runs `func` instead.
+
+        Raises
+        ------
+        IdempotencyKeyReusedError
+            If the key was used for a request with a different `request_hash`.
+        TimeoutError
+            If a duplicate request does not complete within
+            `IDEMPOTENCY_WAIT_TIMEOUT_SECONDS`.
+        """
+        while key in _in_flight:
+            in_flight, in_flight_hash = _in_flight[key]
+            IdempotencyService._check_request_hash(key, in_flight_hash, request_hash)
+            logger.info(f"Waiting for duplicate request in this worker: {key}")
+            try:
+                return await asyncio.shield(in_flight)
+            except _FirstRequestCancelledError:
+                logger.info(f"Duplicate request was cancelled, claiming it: {key}")
+
+        future = asyncio.get_running_loop().create_future()
+        _in_flight[key] = future, request_hash
+        try:
+            result = await IdempotencyService._run_once_across_workers(
+                key, ttl_seconds, request_hash, func
+            )
+            future.set_result(result)
+            return result
+        except (asyncio.CancelledError, ClientDisconnectedError):
+            # Cancelling the future, or passing on the disconnection, would fail
+            # the waiting duplicates too, although their clients are still there
+            future.set_exception(_FirstRequestCancelledError())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del _in_flight[key]
+
+    @staticmethod
+    async def _run_once_across_workers(
+        key: str,
+        ttl_seconds: int,
+        request_hash: str | None,
+        func: Callable[[], Awaitable[BaseModel]],
+    ) -> dict:
+        """
+        Claim the key and run `func`, or wait for the worker that claimed it.
+        """
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT_SECONDS
+        while True:
+            async with get_async_session_context_manager() as asession:
+                claimed = await IdempotencyService._claim(key, request_hash, asession)
+                if not claimed:
+                    row = await asession.get(ChatIdempotencyDB, key)
+
+            if claimed:
+                break
+            if row is not None:
+                IdempotencyService._check_request_hash(
+                    key, row.request_hash, request_hash
+                )
+            if row is not None and row.status == "completed":
+                logger.info(f"Returning result of duplicate request: {key}")
+                return row.result
+            # If the row was deleted, the first request failed: try to claim again
+            if row is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for duplicate request {key}")
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+        renew_lease = asyncio.create_task(IdempotencyService._renew_lease(key))
+        try:
+            result = (await func()).model_dump(mode="json")
+        except BaseException:
+            # Let a retry run the request again
+            async with get_async_session_context_manager() as asession:
+                await asession.execute(
+                    delete(ChatIdempotencyDB).where(
+                        ChatIdempotencyDB.idempotency_key == key
+                    )
+                )
+                await asession.commit()
+            raise
+        finally:
+            renew_lease.cancel()
+
+        async with get_async_session_context_manager() as asession:
+            await asession.execute(
+                update(ChatIdempotencyDB)
+                .where(ChatIdempotencyDB.idempotency_key == key)
+                .values(
+                    status="completed",
+                    result=result,
+                    expires_datetime_utc=datetime.utcnow()
+                    + timedelta(seconds=ttl_seconds),
+                )
+            )
+            await asession.execute(
+                delete(ChatIdempotencyDB).where(
+                    ChatIdempotencyDB.expires_datetime_utc < datetime.utcnow()
+                )
+            )
+            await asession.commit()
+        return result
+
+    @staticmethod
+    async def _renew_lease(key: str) -> None:
+        """
+        Renew the claim on a key every third of `IDEMPOTENCY_LEASE_SECONDS` while
+        its request runs, until cancelled.
+        """
+        while True:
+            await asyncio.sleep(IDEMPOTENCY_LEASE_SECONDS / 3)
+            try:
+                async with get_async_session_context_manager() as asession:
+                    await asession.execute(
+                        update(ChatIdempotencyDB)
+                        .where(ChatIdempotencyDB.idempotency_key == key)
+                        .where(ChatIdempotencyDB.status == "in_progress")
+                        .values(
+                            expires_datetime_utc=datetime.utcnow()
+                            + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+                        )
+                    )
+                    await asession.commit()
+            except Exception as e:
+                logger.warning(f"Failed to renew the claim on {key}: {e}")
+
+    @staticmethod
+    def _check_request_hash(
+        key: str, first_hash: str | None, request_hash: str | None
+    ) -> None:
+        """Raise if a key is reused for a different request than the first one."""
+        if first_hash != request_hash:
+            raise IdempotencyKeyReusedError(
+                f"Idempotency key {key} was already used for a different request"
+            )
+
+    @staticmethod
+    async def _claim(
+        key: str, request_hash: str | None, asession: AsyncSession
+    ) -> bool:
+        """
+        Claim a key if it is new or expired. While its request is in progress, a
+        key expires when its lease is not renewed, i.e. its request most likely
+        died; its TTL starts when the request completes.
+        """
+        now = datetime.utcnow()
+        values = {
+            "status": "in_progress",
+            "result": None,
+            "request_hash": request_hash,
+            "created_datetime_utc": now,
+            "expires_datetime_utc": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS),
+        }
+        stmt = (
+            insert(ChatIdempotencyDB)
+            .values(idempotency_key=key, **values)
+            .on_conflict_do_update(
+                index_elements=[ChatIdempotencyDB.idempotency_key],
+                set_=values,
+                where=ChatIdempotencyDB.expires_datetime_utc < now,
+            )
+            .returning(ChatIdempotencyDB.idempotency_key)
+        )
+        claimed = (await asession.execute(stmt)).first() is not None
+        await asession.commit()
+        return claimed
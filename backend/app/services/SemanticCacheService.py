@@ -0,0 +1,152 @@
+from datetime import datetime, timedelta
+
+from numpy import ndarray
+from sqlalchemy import delete, func, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from ..chat.config import (
+    SEMANTIC_CACHE_SIMILARITY_THRESHOLD,
+    SEMANTIC_CACHE_TTL_SECONDS,
+)
+from ..chat.models import SemanticCacheDB
+from ..chat.schemas import CachedAnswer
+from ..ingestion.models import FileDB
+from ..ingestion.schemas import DocumentChunk
+from ..utils import setup_logger
+from .utils.prompts import RAG
+from .utils.tracing import span
+
+logger = setup_logger()
+
+
+class SemanticCacheService:
+    """
+    Service class for the semantic answer cache. Answers are cached by the
+    embedding of the refined question, so that a question close enough to one
+    already answered does not call the LLM again.
+
+    A cached answer can be reused if either the corpus has not changed since it
+    was cached, or the content retrieved for the new question is the same as the
+    content retrieved for the cached one.
+
+    The cache is shared by all chats, so it only holds answers given without a
+    chat's session summary. Follow-ups refined into standalone questions can
+    still reuse them.
+    """
+
+    @staticmethod
+    async def get_corpus_version(asession: AsyncSession) -> str:
+        """
+        Get a version of the corpus that changes whenever a file is ingested or
+        updated.
+        """
+        stmt = select(func.count(FileDB.file_id), func.max(FileDB.updated_datetime_utc))
+        n_files, last_updated = (await asession.execute(stmt)).one()
+        return f"{n_files}:{last_updated.isoformat() if last_updated else ''}"
+
+    @staticmethod
+    async def lookup(
+        question_embedding: ndarray, asession: AsyncSession
+    ) -> CachedAnswer | None:
+        """
+        Find the unexpired cached answer whose question is closest to the given
+        embedding, if it is within the similarity threshold.
+        """
+        distance = SemanticCacheDB.question_embedding.cosine_distance(
+            question_embedding
+        ).label("distance")
+        stmt = (
+            select(SemanticCacheDB, distance)
+            .where(SemanticCacheDB.created_datetime_utc >= _expiry_cutoff())
+            .order_by(distance)
+            .limit(1)
+        )
+        with span("db.semantic_cache_lookup"):
+            row = (await asession.execute(stmt)).first()
+        if row is None or 1 - row.distance < SEMANTIC_CACHE_SIMILARITY_THRESHOLD:
+            return None
+
+        cached = row[0]
+        return CachedAnswer(
+            cache_id=cached.cache_id,
+            similarity=1 - row.distance,
+            answer=cached.answer,
+            chunks={int(i): DocumentChunk(**c) for i, c in cached.chunks.items()},
+            content_ids=cached.content_ids,
+            corpus_version=cached.corpus_version,
+        )
+
+    @staticmethod
+    def is_valid(
+        cached: CachedAnswer,
+        corpus_version: str,
+        similar_chunks: dict[int, DocumentChunk] | None,
+    ) -> bool:
+        """
+        Check whether a cached answer can be reused: the corpus is unchanged, or
+        the retrieved content is the same as when it was cached.
+        """
+        if cached.corpus_version == corpus_version:
+            return True
+        if similar_chunks is None:
+            return False
+        content_ids = {c.content_id for c in similar_chunks.values()}
+        return content_ids == set(cached.content_ids)
+
+    @staticmethod
+    async def record_hit(cache_id: int, asession: AsyncSession) -> None:
+        """
+        Count a hit on a cached answer.
+        """
+        stmt = (
+            update(SemanticCacheDB)
+            .where(SemanticCacheDB.cache_id == cache_id)
+            .values(n_hits=SemanticCacheDB.n_hits + 1)
+        )
+        await asession.execute(stmt)
+        await asession.commit()
+
+    @staticmethod
+    async def save(
+        question: str,
+        question_embedding: ndarray,
+        answer: RAG,
+        chunks: dict[int, DocumentChunk],
+        similar_chunks: dict[int, DocumentChunk],
+        corpus_version: str,
+        asession: AsyncSession,
+    ) -> None:
+        """
+        Cache an answer. `chunks` is the content used to answer and
+        `similar_chunks` all the content retrieved for the question.
+        """
+        asession.add(
+            SemanticCacheDB(
+                question=question,
+                question_embedding=question_embedding,
+                answer=answer.model_dump(),
+                chunks={i: c.model_dump() for i, c in chunks.items()},
+                content_ids=[c.content_id for c in similar_chunks.values()],
+                corpus_version=corpus_version,
+            )
+        )
+        await asession.commit()
+
+    @staticmethod
+    async def evict_expired(asession: AsyncSession) -> int:
+        """
+        Delete cached answers older than the TTL. The caller commits.
+        """
+        stmt = delete(SemanticCacheDB).where(
+            SemanticCacheDB.created_datetime_utc < _expiry_cutoff()
+        )
+        result = await asession.execute(stmt)
+        if result.rowcount:
+            logger.info(f"Evicted {result.rowcount} expired cached answers")
+        return result.rowcount
+
+
+def _expiry_cutoff() -> datetime:
+    """Cached answers created before this time have expired."""
+    return datetime.utcnow() - timedelta(seconds=SEMANTIC_CACHE_TTL_SECONDS)
@@ -0,0 +1,140 @@
+"""This module stops the work on a chat request once its client has disconnected,
+and counts the requests cancelled and the work that saved.
+
+An answer that nobody will read still takes embedding, reranking and LLM time
+away from the users who are waiting. `run_until_disconnected` runs the work as a
+task and cancels it when the client goes away; cancelling the stages cancels the
+LLM and inference calls they are awaiting.
+
+The work saved is estimated per stage: each stage that had not finished would
+have taken, on average, as long as it took in completed requests, less the time
+it had already run.
+"""
+
+import asyncio
+from typing import Any, Coroutine, TypeVar
+
+from fastapi.requests import Request
+from pydantic import BaseModel
+
+from ...chat.config import CHAT_DISCONNECT_POLL_SECONDS
+
+T = TypeVar("T")
+
+
+class ClientDisconnectedError(Exception):
+    """The client of a request disconnected before it was answered."""
+
+
+class CancellationStats(BaseModel):
+    """Requests completed and cancelled in this worker, and the estimated stage
+    seconds that cancelling saved."""
+
+    n_completed: int
+    n_cancelled: int
+    stage_seconds_saved: float
+    mean_stage_seconds: dict[str, float]
+
+
+class CancellationTracker:
+    """
+    Track how long each stage takes in completed requests, and estimate the stage
+    seconds saved by cancelled ones.
+    """
+
+    def __init__(self) -> None:
+        """Start with no requests recorded."""
+        self._n_completed = 0
+        self._n_cancelled = 0
+        self._stage_seconds_saved = 0.0
+        # Stage name -> (number of completed runs, total seconds)
+        self._stage_totals: dict[str, tuple[int, float]] = {}
+
+    def record_completed(self, stage_seconds: dict[str, float]) -> None:
+        """Record the seconds each stage of a completed request took."""
+        self._n_completed += 1
+        for name, seconds in stage_seconds.items():
+            n, total = self._stage_totals.get(name, (0, 0.0))
+            self._stage_totals[name] = (n + 1, total + seconds)
+
+    def record_cancelled(
+        self,
+        stage_names: list[str],
+        finished: set[str],
+        stage_seconds: dict[str, float],
+    ) -> float:
+        """
+        Record a cancelled request and return the stage seconds saved.
+
+        Parameters
+        ----------
+        stage_names
+            All the stages the request would have run.
+        finished
+            The stages that had finished.
+        stage_seconds
+            The seconds each stage that started had run.
+        """
+        saved = 0.0
+        for name in stage_names:
+            if name in finished:
+                continue
+            mean = self._mean_stage_seconds().get(name, 0.0)
+            saved += max(0.0, mean - stage_seconds.get(name, 0.0))
+        self._n_cancelled += 1
+        self._stage_seconds_saved += saved
+        return saved
+
+    def stats(self) -> CancellationStats:
+        """Get the counts so far."""
+        return CancellationStats(
+            n_completed=self._n_completed,
+            n_cancelled=self._n_cancelled,
+            stage_seconds_saved=round(self._stage_seconds_saved, 4),
+            mean_stage_seconds={
+                name: round(mean, 4)
+                for name, mean in self._mean_stage_seconds().items()
+            },
+        )
+
+    def _mean_stage_seconds(self) -> dict[str, float]:
+        """Mean seconds of each stage in completed requests."""
+        return {name: total / n for name, (n, total) in self._stage_totals.items()}
+
+
+async def run_until_disconnected(
+    request: Request,
+    work: Coroutine[Any, Any, T],
+    poll_seconds: float = CHAT_DISCONNECT_POLL_SECONDS,
+) -> T:
+    """
+    Run `work`, checking every `poll_seconds` whether the client has disconnected.
+    If it has, `work` is cancelled and `ClientDisconnectedError` is raised once it
+    has stopped.
+    """
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_seconds)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                if not task.cancelled():
+                    # It finished before it could be cancelled
+                    return task.result()
+                raise ClientDisconnectedError("Client disconnected")
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+
+_CANCELLATION_TRACKER = CancellationTracker()
+
+
+def get_cancellation_tracker() -> CancellationTracker:
+    """
+    Return the cancellation tracker of this process.
+    """
+    return _CANCELLATION_TRACKER
@@ -0,0 +1,500 @@
+"""This module contains a write-behind writer for chat requests and responses.
+
+Instead of committing each row on the request path, rows are handed to a
+background task that inserts them in batches, across requests, once a batch is
+full or a short interval has passed. Primary keys are allocated up front from
+the tables' sequences, in blocks, so that the ids can be returned right away.
+
+The queue is bounded: when it is full, writing waits for space, slowing requests
+down rather than letting memory grow. Queued rows are written on shutdown. To
+also keep them across a crash, set a journal directory: each row is appended to
+a journal file, and synced to disk, before it is queued, and journals left by a
+dead process are written on startup.
+"""
+
+import asyncio
+import fcntl
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import IO, Any, AsyncContextManager, Awaitable, Callable, Literal
+from uuid import uuid4
+
+from pydantic import BaseModel
+from sqlalchemy import DateTime, Table, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ...chat.config import (
+    CHAT_ID_BLOCK_SIZE,
+    CHAT_WRITE_BEHIND_BATCH_SIZE,
+    CHAT_WRITE_BEHIND_FLUSH_SECONDS,
+    CHAT_WRITE_BEHIND_JOURNAL_DIR,
+    CHAT_WRITE_BEHIND_QUEUE_SIZE,
+)
+from ...database import get_async_session_context_manager
+from ...models import Base
+from ...utils import setup_logger
+
+logger = setup_logger()
+
+N_COMMIT_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 0.5
+
+SessionFactory = Callable[[], AsyncContextManager[AsyncSession]]
+
+
+class ChatWrite(BaseModel):
+    """A row to insert, or the values to update in the row with primary key `key`."""
+
+    table: str
+    kind: Literal["insert", "update"]
+    values: dict[str, Any]
+    key: dict[str, Any] | None = None
+
+
+class ChatWriterStats(BaseModel):
+    """Current state of the write-behind writer."""
+
+    running: bool
+    journal_dir: str | None
+    queue_depth: int
+    max_queue_size: int
+    n_written: int
+    n_batches: int
+    n_dropped: int
+    n_retries: int
+    n_backpressure_waits: int
+    last_batch_size: int
+    last_commit_seconds: float | None
+
+
+class IdAllocator:
+    """
+    Allocate primary keys from the sequence of a table's serial column, fetching
+    `block_size` at a time.
+    """
+
+    def __init__(
+        self,
+        table: str,
+        column: str,
+        block_size: int,
+        session_factory: SessionFactory,
+    ) -> None:
+        """Start with no ids fetched."""
+        self.table = table
+        self.column = column
+        self.block_size = block_size
+        self._session_factory = session_factory
+        self._ids: list[int] = []
+        self._lock = asyncio.Lock()
+
+    async def next_id(self) -> int:
+        """Get the next allocated id."""
+        async with self._lock:
+            if not self._ids:
+                async with self._session_factory() as asession:
+                    result = await asession.execute(
+                        text(
+                            "SELECT nextval(pg_get_serial_sequence(:table, :column)) "
+                            "FROM generate_series(1, :n)"
+                        ),
+                        {
+                            "table": self.table,
+                            "column": self.column,
+                            "n": self.block_size,
+                        },
+                    )
+                    # Pop from the end, in increasing order
+                    self._ids = sorted(result.scalars().all(), reverse=True)
+            return self._ids.pop()
+
+
+class ChatWriter:
+    """
+    Write chat rows in batches from a background task.
+
+    Example
+    -------
+    >>> writer = ChatWriter()
+    >>> await writer.start()
+    >>> request_id = await writer.allocate_id("chat_requests")
+    >>> await writer.write(ChatWrite(table="chat_requests", kind="insert", ...))
+    >>> await writer.flush()  # wait until it is committed
+    >>> await writer.stop()  # write everything queued
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = CHAT_WRITE_BEHIND_QUEUE_SIZE,
+        batch_size: int = CHAT_WRITE_BEHIND_BATCH_SIZE,
+        flush_seconds: float = CHAT_WRITE_BEHIND_FLUSH_SECONDS,
+        journal_dir: str | None = CHAT_WRITE_BEHIND_JOURNAL_DIR or None,
+        id_block_size: int = CHAT_ID_BLOCK_SIZE,
+        session_factory: SessionFactory = get_async_session_context_manager,
+    ) -> None:
+        """Set up the queue and id allocators; nothing runs until `start`."""
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.journal_dir = Path(journal_dir) if journal_dir else None
+        self._session_factory = session_factory
+        self._id_allocators = {
+            table: IdAllocator(table, column, id_block_size, session_factory)
+            for table, column in [
+                ("chat_requests", "request_id"),
+                ("chat_responses", "response_id"),
+            ]
+        }
+
+        # Items are (journal segment, write)
+        self._queue: asyncio.Queue[tuple[int, ChatWrite] | None] = asyncio.Queue(
+            maxsize=max_queue_size
+        )
+        self._task: asyncio.Task | None = None
+        self._n_enqueued = 0
+        self._n_committed = 0
+        self._committed = asyncio.Condition()
+        self._flush_requested = asyncio.Event()
+        # Set when a write is queued or a flush is requested
+        self._wakeup = asyncio.Event()
+
+        self._journal_name = f"chat-writes-{os.getpid()}-{uuid4().hex[:8]}"
+        self._segment = 0
+        self._journal: IO[str] | None = None
+        self._pending_by_segment: dict[int, int] = {}
+        # Held while appending to the journal and while starting a new segment, so
+        # that a segment is not closed during an append
+        self._journal_lock = asyncio.Lock()
+
+        self._n_written = 0
+        self._n_batches = 0
+        self._n_dropped = 0
+        self._n_retries = 0
+        self._n_backpressure_waits = 0
+        self._last_batch_size = 0
+        self._last_commit_seconds: float | None = None
+
+    async def start(self) -> None:
+        """Write the journals left by dead processes, then start writing."""
+        if self.journal_dir is not None:
+            self.journal_dir.mkdir(parents=True, exist_ok=True)
+            await self._replay_journals(self.journal_dir)
+            self._open_segment()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Chat write-behind writer started")
+
+    async def stop(self) -> None:
+        """Write everything queued, then stop."""
+        if self._task is None:
+            return
+        if not self._task.done():
+            await self._queue.put(None)
+            self._wakeup.set()
+        await self._task
+        self._task = None
+        if self._journal is not None:
+            self._close_segment()
+        logger.info(f"Chat write-behind writer stopped, {self._n_written} rows written")
+
+    async def allocate_id(self, table: str) -> int:
+        """Allocate the primary key of a new row of `table`."""
+        return await self._id_allocators[table].next_id()
+
+    async def write(self, chat_write: ChatWrite) -> None:
+        """
+        Queue a write, after saving it to the journal if there is one. Waits for
+        space in the queue if it is full.
+
+        Raises
+        ------
+        RuntimeError
+            If the writer is not running, e.g. because it failed.
+        """
+        self._check_running()
+        async with self._journal_lock:
+            # The segment the write is appended to, even if a new one is started
+            # before it is queued
+            segment, journal = self._segment, self._journal
+            if journal is not None:
+                await asyncio.to_thread(_append_to_journal, journal, chat_write)
+                self._pending_by_segment[segment] += 1
+        if self._queue.full():
+            self._n_backpressure_waits += 1
+            logger.warning("Chat write-behind queue is full, waiting")
+        await self._while_running(self._queue.put((segment, chat_write)))
+        self._n_enqueued += 1
+        self._wakeup.set()
+
+    async def flush(self) -> None:
+        """
+        Wait until everything queued so far is committed.
+
+        Raises
+        ------
+        RuntimeError
+            If the writer is not running, e.g. because it failed.
+        """
+        target = self._n_enqueued
+        if self._n_committed >= target:
+            return
+        self._check_running()
+        self._flush_requested.set()
+        self._wakeup.set()
+        await self._while_running(self._wait_committed(target))
+
+    def stats(self) -> ChatWriterStats:
+        """Get the current state of the writer."""
+        return ChatWriterStats(
+            running=self._task is not None,
+            journal_dir=str(self.journal_dir) if self.journal_dir else None,
+            queue_depth=self._queue.qsize(),
+            max_queue_size=self.max_queue_size,
+            n_written=self._n_written,
+            n_batches=self._n_batches,
+            n_dropped=self._n_dropped,
+            n_retries=self._n_retries,
+            n_backpressure_waits=self._n_backpressure_waits,
+            last_batch_size=self._last_batch_size,
+            last_commit_seconds=self._last_commit_seconds,
+        )
+
+    def _check_running(self) -> None:
+        """Raise if the writer is not running, with the error that stopped it."""
+        if self._task is None:
+            raise RuntimeError("The chat writer is not running")
+        if self._task.done():
+            error = None if self._task.cancelled() else self._task.exception()
+            raise RuntimeError("The chat writer stopped") from error
+
+    async def _while_running(self, awaitable: Awaitable[Any]) -> None:
+        """Wait for `awaitable`, unless the writer stops first, which raises."""
+        waiter = asyncio.ensure_future(awaitable)
+        try:
+            if self._task is not None:
+                await asyncio.wait(
+                    [waiter, self._task], return_when=asyncio.FIRST_COMPLETED
+                )
+            if not waiter.done():
+                self._check_running()
+            await waiter
+        finally:
+            waiter.cancel()
+
+    async def _wait_committed(self, target: int) -> None:
+        """Wait until `target` writes have been committed."""
+        async with self._committed:
+            await self._committed.wait_for(lambda: self._n_committed >= target)
+
+    async def _run(self) -> None:
+        """Commit batches until stopped, then commit what is left."""
+        stopping = False
+        while not stopping:
+            batch, stopping = await self._next_batch()
+            if not batch:
+                continue
+            async with self._journal_lock:
+                if (
+                    self._journal is not None
+                    and self._pending_by_segment[self._segment]
+                ):
+                    # Start a new segment so that this one can be deleted once
+                    # written
+                    self._open_segment()
+            await self._commit([write for _, write in batch])
+            await self._mark_committed(batch)
+
+    async def _next_batch(self) -> tuple[list[tuple[int, ChatWrite]], bool]:
+        """
+        Wait for a write, then collect more until the batch is full, the flush
+        interval has passed or a flush is requested. Returns the batch and whether
+        the writer is stopping.
+        """
+        item = await self._queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.flush_seconds
+        while len(batch) < self.batch_size:
+            if self._queue.empty():
+                timeout = deadline - time.monotonic()
+                if self._flush_requested.is_set() or timeout <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                continue
+            item = self._queue.get_nowait()
+            if item is None:
+                return batch, True
+            batch.append(item)
+        if self._queue.empty():
+            self._flush_requested.clear()
+        return batch, False
+
+    async def _commit(self, writes: list[ChatWrite]) -> None:
+        """
+        Commit a batch in one transaction: inserted requests first, then updates
+        to them, then inserted responses, which reference requests. If the batch
+        keeps failing, commit the writes one by one, dropping those that fail.
+        """
+        start = time.monotonic()
+        for attempt in range(N_COMMIT_ATTEMPTS):
+            try:
+                async with self._session_factory() as asession:
+                    await _execute(writes, asession)
+                    await asession.commit()
+                self._n_written += len(writes)
+                break
+            except Exception as e:
+                logger.error(f"Failed to write {len(writes)} chat rows: {e}")
+                if attempt < N_COMMIT_ATTEMPTS - 1:
+                    self._n_retries += 1
+                    await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2**attempt)
+        else:
+            for write in writes:
+                try:
+                    async with self._session_factory() as asession:
+                        await _execute([write], asession)
+                        await asession.commit()
+                    self._n_written += 1
+                except Exception as e:
+                    self._n_dropped += 1
+                    logger.error(f"Dropping chat write {write.model_dump()}: {e}")
+
+        self._n_batches += 1
+        self._last_batch_size = len(writes)
+        self._last_commit_seconds = round(time.monotonic() - start, 4)
+
+    async def _mark_committed(self, batch: list[tuple[int, ChatWrite]]) -> None:
+        """Wake up flushes waiting for this batch and delete written journals."""
+        if self._journal is not None:
+            for segment, _ in batch:
+                self._pending_by_segment[segment] -= 1
+            for segment, n_pending in list(self._pending_by_segment.items()):
+                if n_pending == 0 and segment != self._segment:
+                    self._segment_path(segment).unlink(missing_ok=True)
+                    del self._pending_by_segment[segment]
+
+        async with self._committed:
+            self._n_committed += len(batch)
+            self._committed.notify_all()
+
+    def _segment_path(self, segment: int) -> Path:
+        """Path of a journal segment of this process."""
+        if self.journal_dir is None:
+            raise RuntimeError("The chat writer has no journal")
+        return self.journal_dir / f"{self._journal_name}-{segment}.jsonl"
+
+    def _open_segment(self) -> None:
+        """Start a new journal segment. Segments are locked while their process
+        is alive."""
+        previous = self._journal
+        self._segment += 1
+        self._journal = open(self._segment_path(self._segment), "a")
+        fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._pending_by_segment[self._segment] = 0
+        if previous is not None:
+            previous.close()
+
+    def _close_segment(self) -> None:
+        """Close the journal. Its segments have all been written by now."""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        for segment in self._pending_by_segment:
+            self._segment_path(segment).unlink(missing_ok=True)
+        self._pending_by_segment.clear()
+
+    async def _replay_journals(self, journal_dir: Path) -> None:
+        """Write the journal segments of dead processes, i.e. those that are not
+        locked. Replaying is safe if some of the writes were already committed."""
+        for path in sorted(journal_dir.glob("chat-writes-*.jsonl")):
+            try:
+                f = open(path)
+            except FileNotFoundError:
+                continue  # Replayed by another worker
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # Owned by a live process, or being replayed
+                writes = [
+                    ChatWrite.model_validate_json(line) for line in f if line.strip()
+                ]
+                for start in range(0, len(writes), self.batch_size):
+                    await self._commit(writes[start : start + self.batch_size])
+                path.unlink()
+            logger.info(f"Replayed {len(writes)} chat writes from {path}")
+
+
+def _append_to_journal(journal: IO[str], chat_write: ChatWrite) -> None:
+    """Append a write to a journal segment and sync it to disk."""
+    journal.write(chat_write.model_dump_json() + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+async def _execute(writes: list[ChatWrite], asession: AsyncSession) -> None:
+    """Execute writes in an order that respects the foreign keys."""
+    inserts: dict[str, list[dict]] = {"chat_requests": [], "chat_responses": []}
+    updates: list[ChatWrite] = []
+    for write in writes:
+        if write.kind == "insert":
+            inserts[write.table].append(_from_json(write.table, write.values))
+        else:
+            updates.append(write)
+
+    if inserts["chat_requests"]:
+        await _insert("chat_requests", inserts["chat_requests"], asession)
+    for write in updates:
+        if write.key is None:
+            raise ValueError(f"Update of {write.table} without the key of the row")
+        table = _table(write.table)
+        stmt = update(table).values(_from_json(write.table, write.values))
+        for column, value in write.key.items():
+            stmt = stmt.where(table.c[column] == value)
+        await asession.execute(stmt)
+    if inserts["chat_responses"]:
+        await _insert("chat_responses", inserts["chat_responses"], asession)
+
+
+async def _insert(table_name: str, rows: list[dict], asession: AsyncSession) -> None:
+    """Insert rows, ignoring those already inserted, e.g. when replaying."""
+    stmt = insert(_table(table_name)).values(rows).on_conflict_do_nothing()
+    await asession.execute(stmt)
+
+
+def _table(name: str) -> Table:
+    """Get a table by name."""
+    return Base.metadata.tables[name]
+
+
+def _from_json(table_name: str, values: dict[str, Any]) -> dict[str, Any]:
+    """Parse the datetimes of a row read from the journal."""
+    table = _table(table_name)
+    return {
+        column: (
+            datetime.fromisoformat(value)
+            if isinstance(value, str) and isinstance(table.c[column].type, DateTime)
+            else value
+        )
+        for column, value in values.items()
+    }
+
+
+_CHAT_WRITER: ChatWriter | None = None
+
+
+def get_chat_writer() -> ChatWriter:
+    """
+    Return the write-behind writer of this process.
+    """
+    global _CHAT_WRITER
+    if _CHAT_WRITER is None:
+        _CHAT_WRITER = ChatWriter()
+    return _CHAT_WRITER
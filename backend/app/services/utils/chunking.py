@@ -0,0 +1,206 @@
+"""This module contains the token-aware chunker used to split parsed documents
+before they are embedded."""
+
+import re
+from typing import Callable, NamedTuple
+
+from ...ingestion.schemas import TextChunk
+
+PARAGRAPH_BOUNDARY = re.compile(r"\n\s*\n")
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+
+class _Unit(NamedTuple):
+    """A sentence (or part of a sentence) and its token count."""
+
+    text: str
+    n_tokens: int
+    paragraph: int
+
+
+class TokenChunker:
+    """
+    Split text into chunks that fit in a token budget.
+
+    Chunks are built greedily from whole sentences. A new chunk is started at a
+    paragraph boundary when the next paragraph does not fit and the current chunk is
+    at least half full. Sentences that are longer than the budget on their own are
+    split on words.
+
+    Parameters
+    ----------
+    count_tokens
+        Function returning the number of tokens in a piece of text. This should use
+        the tokenizer of the embedding model.
+    max_tokens
+        The token budget for each chunk.
+    overlap_tokens
+        Number of tokens at the end of a chunk that are repeated at the start of the
+        next one. Overlap is made of whole sentences, so the actual overlap can be
+        smaller.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_tokens: int,
+        overlap_tokens: int = 0,
+    ) -> None:
+        """Check the token budget and overlap, and set them."""
+        if max_tokens <= 0:
+            raise ValueError("max_tokens must be a positive integer")
+        if not 0 <= overlap_tokens < max_tokens:
+            raise ValueError("overlap_tokens must be between 0 and max_tokens")
+
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+
+    def split(self, text: str) -> list[TextChunk]:
+        """
+        Split `text` into chunks of at most `max_tokens` tokens.
+        """
+        chunks: list[TextChunk] = []
+        current: list[_Unit] = []
+        n_new_units = 0
+
+        for paragraph_index, paragraph in enumerate(PARAGRAPH_BOUNDARY.split(text)):
+            units = self._split_paragraph(paragraph, paragraph_index)
+            if not units:
+                continue
+
+            current_tokens = sum(u.n_tokens for u in current)
+            paragraph_tokens = sum(u.n_tokens for u in units)
+            if (
+                n_new_units > 0
+                and current_tokens + paragraph_tokens > self.max_tokens
+                and current_tokens >= self.max_tokens // 2
+            ):
+                chunks.extend(self._make_chunks(current))
+                current, n_new_units = self._get_overlap(current), 0
+
+            for unit in units:
+                current_tokens = sum(u.n_tokens for u in current)
+                if current and current_tokens + unit.n_tokens > self.max_tokens:
+                    if n_new_units > 0:
+                        chunks.extend(self._make_chunks(current))
+                        current, n_new_units = self._get_overlap(current), 0
+                    # Drop overlap from the front until the next unit fits
+                    while current and (
+                        sum(u.n_tokens for u in current) + unit.n_tokens
+                        > self.max_tokens
+                    ):
+                        current.pop(0)
+                current.append(unit)
+                n_new_units += 1
+
+        if n_new_units > 0:
+            chunks.extend(self._make_chunks(current))
+
+        return chunks
+
+    def _split_paragraph(self, paragraph: str, paragraph_index: int) -> list[_Unit]:
+        """
+        Split a paragraph into units that each fit in the token budget.
+        """
+        units = []
+        for sentence in SENTENCE_BOUNDARY.split(paragraph.strip()):
+            sentence = " ".join(sentence.split())
+            if not sentence:
+                continue
+            n_tokens = self.count_tokens(sentence)
+            if n_tokens <= self.max_tokens:
+                units.append(_Unit(sentence, n_tokens, paragraph_index))
+            else:
+                units.extend(
+                    _Unit(part, part_tokens, paragraph_index)
+                    for part, part_tokens in self._split_long_sentence(sentence)
+                )
+        return units
+
+    def _split_long_sentence(self, sentence: str) -> list[tuple[str, int]]:
+        """
+        Split a sentence that does not fit in the token budget on words.
+        """
+        parts: list[tuple[str, int]] = []
+        words: list[str] = []
+        n_tokens = 0
+        for word in sentence.split():
+            word_tokens = self.count_tokens(word)
+            if word_tokens > self.max_tokens:
+                # A single "word" (e.g. a long URL or table row) over budget
+                if words:
+                    parts.append((" ".join(words), n_tokens))
+                    words, n_tokens = [], 0
+                parts.extend(self._split_long_word(word, word_tokens))
+                continue
+            if n_tokens + word_tokens > self.max_tokens:
+                parts.append((" ".join(words), n_tokens))
+                words, n_tokens = [], 0
+            words.append(word)
+            n_tokens += word_tokens
+        if words:
+            parts.append((" ".join(words), n_tokens))
+        return parts
+
+    def _split_long_word(self, word: str, n_tokens: int) -> list[tuple[str, int]]:
+        """
+        Split a word that does not fit in the token budget on characters.
+        """
+        n_chars = max(1, len(word) * self.max_tokens // (n_tokens + 1))
+        parts = []
+        for i in range(0, len(word), n_chars):
+            part = word[i : i + n_chars]
+            parts.append((part, self.count_tokens(part)))
+        return parts
+
+    def _get_overlap(self, units: list[_Unit]) -> list[_Unit]:
+        """
+        Return the trailing units of a chunk that fit in the overlap budget.
+        """
+        overlap: list[_Unit] = []
+        n_tokens = 0
+        for unit in reversed(units):
+            if n_tokens + unit.n_tokens > self.overlap_tokens:
+                break
+            overlap.insert(0, unit)
+            n_tokens += unit.n_tokens
+        return overlap
+
+    def _make_chunks(self, units: list[_Unit]) -> list[TextChunk]:
+        """
+        Join units into a chunk. Sentences in the same paragraph are joined with a
+        space and paragraphs with a blank line.
+
+        Units are counted one by one, and the joined text can have more tokens than
+        their sum (e.g. where a tokenizer merges across the separator). A chunk over
+        the budget is split before the first unit that does not fit.
+        """
+        text = self._join(units)
+        n_tokens = self.count_tokens(text)
+        if n_tokens <= self.max_tokens:
+            return [TextChunk(text=text, n_tokens=n_tokens)]
+        if len(units) == 1:
+            # A part of a sentence split on words, counted word by word. The
+            # embedding model truncates it to the budget
+            return [TextChunk(text=text, n_tokens=self.max_tokens)]
+
+        # The longest prefix that fits, of at least one unit
+        fits, too_long = 1, len(units)
+        while too_long - fits > 1:
+            middle = (fits + too_long) // 2
+            if self.count_tokens(self._join(units[:middle])) <= self.max_tokens:
+                fits = middle
+            else:
+                too_long = middle
+        return self._make_chunks(units[:fits]) + self._make_chunks(units[fits:])
+
+    @staticmethod
+    def _join(units: list[_Unit]) -> str:
+        """Join units with a space within a paragraph and a blank line between
+        paragraphs."""
+        text = units[0].text
+        for previous, unit in zip(units, units[1:]):
+            separator = " " if unit.paragraph == previous.paragraph else "\n\n"
+            text += separator + unit.text
+        return text
@@ -1,93 +1,388 @@
-from litellm import acompletion
-from pydantic import ValidationError
+import asyncio
+import time
+from typing import AsyncIterator
+
+import httpx
+from litellm import acompletion, token_counter
+from pydantic import BaseModel, ValidationError
 
 from ...chat.schemas import ChatHistory, ChatResponse
-from ...config import LLM_API_BASE, LLM_MODEL
+from ...config import (
+    ANSWER_LLM_MODEL,
+    LLM_API_BASE,
+    LLM_CONTEXT_TOKEN_BUDGET,
+    LLM_KEEP_ALIVE,
+)
 from ...ingestion.schemas import DocumentChunk
-from ...utils import remove_json_markdown, setup_logger
+from ...utils import setup_logger
+from .context import AssembledContext, assemble_context
+from .json_stream import JSONStringFieldExtractor
+from .llm_gateway import LLMOverloadedError, get_llm_gateway
+from .llm_routing import (
+    LLM_STAGE_CONFIGS,
+    LLMStage,
+    LLMStageConfig,
+    get_llm_calls,
+    record_llm_call,
+)
+from .metrics import observe_llm_call
 from .prompts import (
     RAG,
-    RefineMessageUsingHistory,
-    SummarizeConversationHistory,
+    SummarizeAndRefineMessage,
 )
+from .structured_output import get_parse_stats, get_response_format, parse_json_object
+from .tracing import span
 
 logger = setup_logger()
 
 
-async def get_llm_response(
-    user_message: str, session_summary: str, similar_chunks: dict[int, DocumentChunk]
-) -> RAG:
+class RAGPrompt(BaseModel):
+    """The prompt for answering a message, with its token counts. The system
+    prompt is the same for every message; the user message has the summary, the
+    context and the question."""
+
+    system_prompt: str
+    user_message: str
+    context: AssembledContext
+    n_prompt_tokens: int
+
+    def metadata(self) -> dict:
+        """Token counts to record with the response"""
+        return {
+            "prompt_tokens": self.n_prompt_tokens,
+            "context_tokens": self.context.n_tokens,
+            "context_budget": self.context.budget,
+            "trimmed_chunks": self.context.trimmed_chunks,
+            "dropped_chunks": self.context.dropped_chunks,
+        }
+
+
+def count_llm_tokens(text: str) -> int:
+    """
+    Count the tokens in `text` with the tokenizer of `ANSWER_LLM_MODEL`, where
+    litellm knows it (it falls back to a generic tokenizer otherwise).
+    """
+    return token_counter(model=ANSWER_LLM_MODEL, text=text)
+
+
+def get_rag_prompt(
+    user_message: str,
+    session_summary: str,
+    similar_chunks: dict[int, DocumentChunk],
+    context_budget: int = LLM_CONTEXT_TOKEN_BUDGET,
+) -> RAGPrompt:
+    """
+    Build the prompt for answering a message, fitting the retrieved content in
+    `context_budget` tokens. The instructions come first and are the same for
+    every message, so that the LLM can reuse their cache; the parts that change
+    come last.
+    """
+    context = assemble_context(
+        similar_chunks, user_message, context_budget, count_llm_tokens
+    )
+    rag_user_message = RAG.user_prompt.format(
+        session_summary=session_summary, context=context.text, question=user_message
+    )
+    return RAGPrompt(
+        system_prompt=RAG.prompt,
+        user_message=rag_user_message,
+        context=context,
+        n_prompt_tokens=count_llm_tokens(RAG.prompt)
+        + count_llm_tokens(rag_user_message),
+    )
+
+
+async def get_llm_response(rag_prompt: RAGPrompt) -> RAG:
     """
     Get the response from the LLM model
     """
-    context_string = get_context_string_from_search_results(similar_chunks)
-    prompt = RAG.prompt.format(context=context_string, session_summary=session_summary)
-    llm_answer = await _ask_llm_async(user_message, prompt, LLM_MODEL)
-    llm_answer_trimmed = remove_json_markdown(llm_answer)
+    llm_answer = await _ask_llm_async(
+        rag_prompt.user_message,
+        rag_prompt.system_prompt,
+        LLMStage.ANSWER,
+        response_model=RAG,
+    )
+    return parse_rag_response(llm_answer, _served_model(LLMStage.ANSWER))
+
+
+async def stream_llm_response(rag_prompt: RAGPrompt) -> AsyncIterator[str | RAG]:
+    """
+    Stream the response from the LLM model. Yields the text of the `answer` field
+    as it is generated, then the parsed `RAG` response once the stream completes.
+
+    If the LLM does not answer with the expected JSON, nothing is yielded until
+    the end and the answer is recovered by `parse_rag_response`.
+    """
+    extractor = JSONStringFieldExtractor("answer")
+    llm_answer = ""
+
+    async for delta in _ask_llm_stream(
+        rag_prompt.user_message,
+        rag_prompt.system_prompt,
+        LLMStage.ANSWER,
+        response_model=RAG,
+    ):
+        llm_answer += delta
+        answer_delta = extractor.feed(delta)
+        if answer_delta:
+            yield answer_delta
+
+    yield parse_rag_response(llm_answer, _served_model(LLMStage.ANSWER))
+
+
+def parse_rag_response(llm_answer: str, model: str) -> RAG:
+    """
+    Parse the LLM's answer, repairing broken JSON. If it cannot be parsed, the
+    `answer` field is extracted from it, e.g. when the response was cut off after
+    it; a response that is not JSON at all is used as the answer, and one with no
+    answer to recover is answered with `RAG.RAG_FAILURE_MESSAGE`. How the response
+    was parsed is counted for `model`.
+    """
+    data, outcome = parse_json_object(llm_answer)
+    response = None
+    if data is not None:
+        try:
+            response = RAG.model_validate(data)
+        except ValidationError:
+            if isinstance(data.get("answer"), str):
+                extracted_info = data.get("extracted_info")
+                response = RAG(
+                    extracted_info=(
+                        [info for info in extracted_info or [] if isinstance(info, str)]
+                        if isinstance(extracted_info, list)
+                        else []
+                    ),
+                    answer=data["answer"],
+                )
+                outcome = "repaired"
+            else:
+                outcome = "failed"
 
+    if response is None:
+        answer = JSONStringFieldExtractor("answer").feed(llm_answer)
+        if answer:
+            response, outcome = RAG(extracted_info=[], answer=answer), "extracted"
+        elif "{" not in llm_answer and llm_answer.strip():
+            response = RAG(extracted_info=[], answer=llm_answer.strip())
+            outcome = "prose"
+        else:
+            response = RAG(extracted_info=[], answer=RAG.RAG_FAILURE_MESSAGE)
+            outcome = "failed"
+
+    get_parse_stats().record(model, outcome)
+    if outcome != "json":
+        logger.error(f"LLM response was not valid JSON ({outcome}): {llm_answer}")
+    return response
+
+
+async def get_summary_and_refined_message(
+    session_summary: str | None, new_turns: ChatHistory, user_message: str
+) -> SummarizeAndRefineMessage | None:
+    """
+    Update the rolling session summary with the turns that happened since it was
+    last updated and refine the user message using it, in a single LLM call. The
+    size of the prompt does not depend on the length of the conversation.
+
+    If the response cannot be parsed, None is returned, so that the summary is
+    left as it was and the new turns are summarised next time.
+    """
+    new_turns_str = "\n".join(
+        f"AI: {m.response}" if isinstance(m, ChatResponse) else f"Human: {m.message}"
+        for m in new_turns
+    )
+    prompt = SummarizeAndRefineMessage.user_prompt.format(
+        session_summary=session_summary or "No conversation yet.",
+        new_turns=new_turns_str or "None.",
+        user_message=user_message,
+    )
+    llm_response = await _ask_llm_async(
+        prompt,
+        SummarizeAndRefineMessage.prompt,
+        LLMStage.REFINE,
+        response_model=SummarizeAndRefineMessage,
+    )
+
+    data, outcome = parse_json_object(llm_response)
     try:
-        response = RAG.model_validate_json(llm_answer_trimmed)
-    except ValidationError as e:
-        logger.error(f"Failed to parse LLM response: {e}. LLM response: {llm_answer}")
-        response = RAG(extracted_info=[], answer=llm_answer_trimmed)
+        if data is None:
+            raise ValueError("No JSON object in the response")
+        response = SummarizeAndRefineMessage.model_validate(data)
+    except (ValidationError, ValueError) as e:
+        logger.error(
+            f"Failed to parse summary and refined message: {e}. "
+            f"LLM response: {llm_response}"
+        )
+        get_parse_stats().record(_served_model(LLMStage.REFINE), "failed")
+        return None
+    get_parse_stats().record(_served_model(LLMStage.REFINE), outcome)
+
+    logger.info(f"Session summary: {response.session_summary}")
+    logger.info(f"Refined message: {response.refined_message}")
 
     return response
 
 
-def get_context_string_from_search_results(
-    search_results: dict[int, DocumentChunk],
+async def _ask_llm_async(
+    user_message: str,
+    system_message: str,
+    stage: LLMStage,
+    response_model: type[BaseModel] | None = None,
 ) -> str:
     """
-    Get the context string from the retrieved content
+    Ask the stage's LLM a question and return the response, as structured output
+    of `response_model` where the model supports it. If the model errors
+    or exceeds the stage's timeout, the stage's fallback models are tried in
+    order. Each attempt waits for a slot in the LLM gateway, and is a span of the
+    request's trace.
+
+    The model's tokens and the time it took, without waiting for the slot, are
+    recorded with the model.
     """
-    context_list = []
-    for key, result in search_results.items():
-        context_list.append(f"{key}. {result.file_name}\n{result.text}")
-    context_string = "\n\n".join(context_list)
-    return context_string
+    config = LLM_STAGE_CONFIGS[stage]
+    failed_models: list[str] = []
+    for model in config.models:
+        params = _get_completion_params(
+            user_message, system_message, model, config, response_model
+        )
+        with span("llm", stage=stage.value, model=model) as attributes:
+            try:
+                queue_start = time.perf_counter()
+                async with get_llm_gateway().slot(stage.priority):
+                    call_start = time.perf_counter()
+                    attributes["queued_ms"] = round((call_start - queue_start) * 1000)
+                    llm_response_raw = await asyncio.wait_for(
+                        acompletion(**params), config.timeout_seconds
+                    )
+                    call_seconds = time.perf_counter() - call_start
+            except Exception as e:
+                attributes["error"] = type(e).__name__
+                if isinstance(e, LLMOverloadedError) or model == config.models[-1]:
+                    raise
+                _log_fallback(stage, model, e)
+                failed_models.append(model)
+                continue
+            usage = _get_usage(llm_response_raw)
+            attributes["prompt_tokens"], attributes["completion_tokens"] = usage
+
+        record_llm_call(
+            stage, model, failed_models, *usage, seconds=round(call_seconds, 4)
+        )
+        observe_llm_call(stage.value, model, call_seconds, *usage)
+        logger.info(f"LLM output: {llm_response_raw.choices[0].message.content}")
+        return llm_response_raw.choices[0].message.content
+    raise ValueError(f"No model configured for LLM stage {stage.value}")
 
 
-async def get_session_summary(chat_history: ChatHistory, user_message: str) -> str:
+async def _ask_llm_stream(
+    user_message: str,
+    system_message: str,
+    stage: LLMStage,
+    response_model: type[BaseModel] | None = None,
+) -> AsyncIterator[str]:
     """
-    Get the session summary from the LLM model
+    Ask the stage's LLM a question and yield the response as it is generated. The
+    LLM gateway slot is held until the stream ends.
+
+    If the model errors or does not produce a first token within the stage's
+    timeout, the stage's fallback models are tried in order. Once a model has
+    produced a token, it is used until the end of the stream. Its tokens, if it
+    reports them, and the time it took are recorded once the stream ends.
     """
-    all_messages_dict = [
-        {"AI": m.response} if isinstance(m, ChatResponse) else {"Human": m.message}
-        for m in chat_history
-    ]
-    all_messages_str = "\n".join(
-        [
-            f"{k}: {v}"
-            for message_dict in all_messages_dict
-            for k, v in message_dict.items()
-        ]
+    config = LLM_STAGE_CONFIGS[stage]
+    failed_models: list[str] = []
+    for model in config.models:
+        params = _get_completion_params(
+            user_message, system_message, model, config, response_model
+        )
+        with span("llm", stage=stage.value, model=model) as attributes:
+            queue_start = time.perf_counter()
+            async with get_llm_gateway().slot(stage.priority):
+                call_start = time.perf_counter()
+                attributes["queued_ms"] = round((call_start - queue_start) * 1000)
+                try:
+                    chunks, first_delta = await asyncio.wait_for(
+                        _open_llm_stream(params), config.timeout_seconds
+                    )
+                except Exception as e:
+                    attributes["error"] = type(e).__name__
+                    if model == config.models[-1]:
+                        raise
+                    _log_fallback(stage, model, e)
+                    failed_models.append(model)
+                    continue
+
+                attributes["first_token_ms"] = round(
+                    (time.perf_counter() - call_start) * 1000
+                )
+                record_llm_call(stage, model, failed_models)
+                if first_delta:
+                    yield first_delta
+                usage: tuple[int | None, int | None] = (None, None)
+                async for chunk in chunks:
+                    if getattr(chunk, "usage", None) is not None:
+                        usage = _get_usage(chunk)
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        yield delta
+                call_seconds = time.perf_counter() - call_start
+                attributes["prompt_tokens"], attributes["completion_tokens"] = usage
+            record_llm_call(
+                stage, model, failed_models, *usage, seconds=round(call_seconds, 4)
+            )
+            observe_llm_call(stage.value, model, call_seconds, *usage)
+            return
+    raise ValueError(f"No model configured for LLM stage {stage.value}")
+
+
+async def _open_llm_stream(params: dict) -> tuple[AsyncIterator, str]:
+    """
+    Start a streamed completion and wait for its first token. Returns the
+    iterator over the remaining chunks and the first token, which is empty if
+    the response is.
+    """
+    llm_response_stream = await acompletion(
+        **params, stream=True, stream_options={"include_usage": True}
     )
+    chunks = aiter(llm_response_stream)
+    async for chunk in chunks:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            return chunks, delta
+    return chunks, ""
 
-    prompt = SummarizeConversationHistory.prompt.format(context=user_message)
-    chat_summary = await _ask_llm_async(all_messages_str, prompt, LLM_MODEL)
 
-    logger.error(f"Chat history: {all_messages_str}")
-    logger.error(f"Session summary: {chat_summary}")
+def _get_usage(response: object) -> tuple[int | None, int | None]:
+    """The prompt and completion tokens of a completion, or of the last chunk of
+    a streamed one, if the model reported them."""
+    usage = getattr(response, "usage", None)
+    return (
+        getattr(usage, "prompt_tokens", None),
+        getattr(usage, "completion_tokens", None),
+    )
 
-    return chat_summary
 
+def _log_fallback(stage: LLMStage, model: str, error: Exception) -> None:
+    """Log that a model failed and the stage falls back to the next one."""
+    reason = "timed out" if isinstance(error, asyncio.TimeoutError) else repr(error)
+    logger.warning(f"LLM {model} failed for {stage.value} ({reason}), falling back")
 
-async def get_refined_message(chat_summary: str, user_message: str) -> str:
-    """
-    Given chat summary, refine the user message to add context and make it less
-    ambiguous.
-    """
-    prompt = RefineMessageUsingHistory.prompt.format(context=chat_summary)
-    refined_message = await _ask_llm_async(user_message, prompt, LLM_MODEL)
-    logger.error(f"User message: {user_message}")
-    logger.error(f"Refined message: {refined_message}")
 
-    return refined_message
+def _served_model(stage: LLMStage) -> str:
+    """The model that answered the stage's last call in this request."""
+    llm_call = get_llm_calls().get(stage.value)
+    return llm_call.model if llm_call else LLM_STAGE_CONFIGS[stage].models[0]
 
 
-async def _ask_llm_async(user_message: str, system_message: str, model: str) -> str:
+def _get_completion_params(
+    user_message: str,
+    system_message: str,
+    model: str,
+    config: LLMStageConfig,
+    response_model: type[BaseModel] | None = None,
+) -> dict:
     """
-    Ask the LLM model a question and return the response
+    Get the parameters for a completion call. If a `response_model` is given, the
+    model is asked for structured output where it supports it.
     """
     messages = [
         {"role": "system", "content": system_message},
@@ -97,14 +392,42 @@ async def _ask_llm_async(user_message: str, system_message: str, model: str) ->
     params = {
         "model": model,
         "messages": messages,
-        "temperature": 0,
-        "max_tokens": 1024,
-        # "response_format": {"type": "json_object"},
+        "temperature": config.temperature,
+        "max_tokens": config.max_tokens,
     }
+    if response_model is not None:
+        response_format = get_response_format(model, response_model)
+        if response_format is not None:
+            params["response_format"] = response_format
 
     if model.startswith("ollama"):
         params["api_base"] = LLM_API_BASE
+        params["keep_alive"] = LLM_KEEP_ALIVE
+
+    return params
+
 
-    llm_response_raw = await acompletion(**params)
-    logger.info(f"LLM output: {llm_response_raw.choices[0].message.content}")
-    return llm_response_raw.choices[0].message.content
+async def preload_llm_models() -> None:
+    """
+    Load the Ollama models of all the LLM stages, so that the first requests do
+    not wait for them to load. They then stay loaded for `LLM_KEEP_ALIVE` after
+    each call.
+    """
+    models = {
+        model
+        for config in LLM_STAGE_CONFIGS.values()
+        for model in config.models
+        if model.startswith("ollama")
+    }
+    async with httpx.AsyncClient(base_url=LLM_API_BASE, timeout=300) as client:
+        for model in sorted(models):
+            # A request without a prompt only loads the model
+            name = model.split("/", 1)[1]
+            try:
+                response = await client.post(
+                    "/api/generate", json={"model": name, "keep_alive": LLM_KEEP_ALIVE}
+                )
+                response.raise_for_status()
+                logger.info(f"Preloaded LLM {model}")
+            except httpx.HTTPError as e:
+                logger.warning(f"Failed to preload LLM {model}: {e!r}")
@@ -0,0 +1,123 @@
+"""This module assembles the retrieved content into the context of the RAG prompt,
+within a token budget."""
+
+import re
+from typing import Callable
+
+from pydantic import BaseModel
+
+from ...ingestion.schemas import DocumentChunk
+from .chunking import SENTENCE_BOUNDARY
+
+WORD = re.compile(r"\w+")
+TRIMMED_SEPARATOR = " ... "
+
+
+class AssembledContext(BaseModel):
+    """The context string for the RAG prompt and how the budget was spent.
+    Chunks are identified by their key in the search results."""
+
+    text: str
+    n_tokens: int
+    budget: int
+    full_chunks: list[int]
+    trimmed_chunks: list[int]
+    dropped_chunks: list[int]
+
+
+def assemble_context(
+    similar_chunks: dict[int, DocumentChunk],
+    query: str,
+    budget: int,
+    count_tokens: Callable[[str], int],
+) -> AssembledContext:
+    """
+    Fill the token budget with the retrieved chunks, in order (i.e. in rerank
+    order). A chunk that does not fit in full is trimmed to its sentences most
+    relevant to the query that fit; chunks are only dropped once the budget is
+    spent.
+
+    Parameters
+    ----------
+    similar_chunks
+        The retrieved chunks, most relevant first.
+    query
+        The user message, used to pick the sentences to keep when trimming.
+    budget
+        The maximum number of tokens in the context.
+    count_tokens
+        Function returning the number of tokens in a piece of text. This should use
+        the tokenizer of the LLM.
+    """
+    query_words = _words(query)
+    separator_tokens = count_tokens("\n\n")
+    parts: list[str] = []
+    n_tokens = 0
+    full_chunks, trimmed_chunks, dropped_chunks = [], [], []
+
+    for key, chunk in similar_chunks.items():
+        header = f"{key}. {chunk.file_name}\n"
+        overhead = count_tokens(header) + (separator_tokens if parts else 0)
+        remaining = budget - n_tokens - overhead
+        if remaining <= 0:
+            dropped_chunks.append(key)
+            continue
+
+        chunk_tokens = count_tokens(chunk.text)
+        if chunk_tokens <= remaining:
+            text = chunk.text
+            full_chunks.append(key)
+        else:
+            text, chunk_tokens = _trim_to_relevant_sentences(
+                chunk.text, query_words, remaining, count_tokens
+            )
+            if not text:
+                dropped_chunks.append(key)
+                continue
+            trimmed_chunks.append(key)
+
+        parts.append(header + text)
+        n_tokens += overhead + chunk_tokens
+
+    return AssembledContext(
+        text="\n\n".join(parts),
+        n_tokens=n_tokens,
+        budget=budget,
+        full_chunks=full_chunks,
+        trimmed_chunks=trimmed_chunks,
+        dropped_chunks=dropped_chunks,
+    )
+
+
+def _trim_to_relevant_sentences(
+    text: str,
+    query_words: set[str],
+    budget: int,
+    count_tokens: Callable[[str], int],
+) -> tuple[str, int]:
+    """
+    Keep the sentences sharing the most words with the query that fit in the
+    budget, in their original order. Returns the trimmed text and its token count.
+    """
+    sentences = [s for s in SENTENCE_BOUNDARY.split(text) if s.strip()]
+    by_relevance = sorted(
+        range(len(sentences)),
+        key=lambda i: (-len(_words(sentences[i]) & query_words), i),
+    )
+
+    separator_tokens = count_tokens(TRIMMED_SEPARATOR)
+    kept: list[int] = []
+    n_tokens = 0
+    for i in by_relevance:
+        sentence_tokens = count_tokens(sentences[i]) + (separator_tokens if kept else 0)
+        if n_tokens + sentence_tokens <= budget:
+            kept.append(i)
+            n_tokens += sentence_tokens
+
+    trimmed = TRIMMED_SEPARATOR.join(sentences[i] for i in sorted(kept))
+    return trimmed, n_tokens
+
+
+def _words(text: str) -> set[str]:
+    """Lowercase words in `text`, for a simple measure of overlap."""
+    return set(WORD.findall(text.lower()))
@@ -0,0 +1,94 @@
+"""This module contains MinHash fingerprinting used to detect near-duplicate chunks
+at ingestion time.
+
+Each chunk is reduced to a set of word shingles and a MinHash signature. The
+signature is split into bands that are hashed for locality-sensitive hashing
+(LSH): two chunks sharing at least one band hash are candidates, and the share of
+equal signature values estimates their Jaccard similarity.
+"""
+
+import hashlib
+import re
+
+import numpy as np
+
+from ...config import MINHASH_BANDS, MINHASH_NUM_PERM, MINHASH_SHINGLE_SIZE
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_LOW_29_BITS = np.uint64((1 << 29) - 1)
+_WORD = re.compile(r"\w+")
+
+# Fixed seed so that signatures are comparable across processes and restarts
+_generator = np.random.RandomState(seed=1)
+_PERMUTATIONS = (
+    _generator.randint(1, _MERSENNE_PRIME, size=MINHASH_NUM_PERM, dtype=np.uint64),
+    _generator.randint(0, _MERSENNE_PRIME, size=MINHASH_NUM_PERM, dtype=np.uint64),
+)
+
+
+def get_shingles(text: str, shingle_size: int = MINHASH_SHINGLE_SIZE) -> set[str]:
+    """
+    Return the set of word n-grams of `text`, ignoring case and punctuation.
+    Texts shorter than `shingle_size` words are a single shingle.
+    """
+    words = _WORD.findall(text.lower())
+    if len(words) <= shingle_size:
+        return {" ".join(words)}
+    return {
+        " ".join(words[i : i + shingle_size])
+        for i in range(len(words) - shingle_size + 1)
+    }
+
+
+def minhash_signature(text: str) -> list[int]:
+    """
+    Compute the MinHash signature of `text` with `MINHASH_NUM_PERM` permutations.
+    """
+    shingle_hashes = np.array(
+        [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), "big")
+            for s in get_shingles(text)
+        ],
+        dtype=np.uint64,
+    )
+    a, b = _PERMUTATIONS
+    permuted = (_multiply_mod_prime(shingle_hashes, a) + b) % _MERSENNE_PRIME
+    return (permuted & _MAX_HASH).min(axis=0).tolist()
+
+
+def _multiply_mod_prime(hashes: np.ndarray, factors: np.ndarray) -> np.ndarray:
+    """
+    Return `hashes[i] * factors[j] % _MERSENNE_PRIME` for all pairs, without
+    overflowing 64 bits: the 32-bit hashes are multiplied by the low and high 32
+    bits of the factors separately, and shifting by 32 bits modulo 2^61 - 1 is a
+    rotation of 61-bit numbers.
+    """
+    low = np.outer(hashes, factors & _MAX_HASH) % _MERSENNE_PRIME
+    high = np.outer(hashes, factors >> np.uint64(32)) % _MERSENNE_PRIME
+    high = ((high & _LOW_29_BITS) << np.uint64(32)) + (high >> np.uint64(29))
+    return (high % _MERSENNE_PRIME + low) % _MERSENNE_PRIME
+
+
+def lsh_band_hashes(signature: list[int], n_bands: int = MINHASH_BANDS) -> list[int]:
+    """
+    Hash each band of the signature. The band index is part of the hash so that
+    equal values in different bands do not collide. Hashes fit in a signed 64-bit
+    integer.
+    """
+    rows_per_band = len(signature) // n_bands
+    band_hashes = []
+    for band in range(n_bands):
+        rows = signature[band * rows_per_band : (band + 1) * rows_per_band]
+        digest = hashlib.blake2b(
+            f"{band}:{','.join(map(str, rows))}".encode(), digest_size=8
+        ).digest()
+        band_hashes.append(int.from_bytes(digest, "big") >> 1)
+    return band_hashes
+
+
+def estimate_similarity(signature_a: list[int], signature_b: list[int]) -> float:
+    """
+    Estimate the Jaccard similarity of two texts from their signatures.
+    """
+    return float(np.mean(np.array(signature_a) == np.array(signature_b)))
@@ -1,15 +1,47 @@
+from functools import lru_cache
+
 from numpy import ndarray
 from sentence_transformers import SentenceTransformer
 
 from ...config import EMBEDDING_MODEL_NAME
 from ...utils import setup_logger
+from .inference import run_inference
 
 logger = setup_logger()
 
 
+@lru_cache(maxsize=1)
+def get_embedding_model() -> SentenceTransformer:
+    """
+    Load the embedding model once per process and reuse it across calls.
+    """
+    return SentenceTransformer(EMBEDDING_MODEL_NAME, trust_remote_code=True)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count the number of tokens in `text` using the embedding model's tokenizer.
+    Special tokens added by the encoder are not included.
+    """
+    tokenizer = get_embedding_model().tokenizer
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def get_max_sequence_length() -> int:
+    """
+    Return the number of content tokens the embedding model can encode before it
+    starts truncating, i.e. its maximum sequence length minus special tokens.
+    """
+    embed_model = get_embedding_model()
+    n_special_tokens = embed_model.tokenizer.num_special_tokens_to_add()
+    return embed_model.max_seq_length - n_special_tokens
+
+
 async def create_embeddings(chunks: list[str] | str) -> ndarray:
     """
-    Create embeddings for a list of text chunks using `sentence_transformers`
+    Create embeddings for a list of text chunks using `sentence_transformers`.
+    Encoding runs in the inference thread pool so that it does not block the
+    event loop.
 
     Parameters
     ----------
@@ -22,13 +54,13 @@ async def create_embeddings(chunks: list[str] | str) -> ndarray:
         A list of embedding vectors corresponding to each text chunk.
     """
 
-    embed_model = SentenceTransformer(EMBEDDING_MODEL_NAME, trust_remote_code=True)
+    embed_model = get_embedding_model()
 
     logger.info(
         f"""Generating embeddings for {len(chunks)} chunks using
                     async batch processing"""
     )
-    embeddings = embed_model.encode(chunks)
+    embeddings = await run_inference(embed_model.encode, chunks)
     logger.info("Embeddings generated successfully")
 
     return embeddings
@@ -0,0 +1,352 @@
+"""This module contains the chat history cache.
+
+The full history of a chat is cached under its `chat_id` the first time it is read.
+Saving a request or a response writes through to the cache, so that later turns
+read the history from the cache instead of Postgres. Writes for a chat that is not
+cached are skipped: the next read loads the history from the database.
+
+Two backends are available: an in-process LRU cache, bounded by idle time and
+memory, and Redis, shared by all workers. The API runs several workers, so the
+cache is off unless Redis is configured.
+"""
+
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any
+
+from ...chat.schemas import ChatHistory, ChatResponse, ChatUserMessage
+from ...config import (
+    HISTORY_CACHE_BACKEND,
+    HISTORY_CACHE_IDLE_SECONDS,
+    HISTORY_CACHE_MAX_BYTES,
+    REDIS_URL,
+)
+from ...utils import setup_logger
+
+logger = setup_logger()
+
+# Attempts at updating a request in Redis while other writes change the chat
+MAX_UPDATE_ATTEMPTS = 5
+
+ChatMessage = ChatUserMessage | ChatResponse
+
+
+class HistoryCache(ABC):
+    """
+    Interface for chat history caches.
+
+    To avoid caching a history that misses a message saved while it was being
+    loaded from the database, a load is bracketed by `begin_load` and `set`: `set`
+    is ignored if a message was written for the chat in between.
+    """
+
+    # Whether histories are cached at all
+    enabled = True
+
+    @abstractmethod
+    async def get(self, chat_id: str) -> ChatHistory | None:
+        """Get the cached history of a chat, or None if it is not cached."""
+
+    @abstractmethod
+    async def begin_load(self, chat_id: str) -> Any:
+        """Start loading a history from the database. Returns a token for `set`."""
+
+    @abstractmethod
+    async def set(self, chat_id: str, history: ChatHistory, token: Any) -> None:
+        """Cache the history loaded since `begin_load` returned `token`."""
+
+    @abstractmethod
+    async def append(self, chat_id: str, message: ChatMessage) -> None:
+        """Add a new message to a cached history."""
+
+    @abstractmethod
+    async def update_request(self, chat_id: str, request_id: int, values: dict) -> None:
+        """Update fields of a request in a cached history, e.g. once it has been
+        refined."""
+
+    @abstractmethod
+    async def delete(self, chat_id: str) -> None:
+        """Remove a chat from the cache."""
+
+
+class NoHistoryCache(HistoryCache):
+    """A cache that caches nothing, to disable caching."""
+
+    enabled = False
+
+    async def get(self, chat_id: str) -> ChatHistory | None:
+        """Nothing is cached."""
+        return None
+
+    async def begin_load(self, chat_id: str) -> Any:
+        """Nothing to do."""
+        return None
+
+    async def set(self, chat_id: str, history: ChatHistory, token: Any) -> None:
+        """Nothing to do."""
+
+    async def append(self, chat_id: str, message: ChatMessage) -> None:
+        """Nothing to do."""
+
+    async def update_request(self, chat_id: str, request_id: int, values: dict) -> None:
+        """Nothing to do."""
+
+    async def delete(self, chat_id: str) -> None:
+        """Nothing to do."""
+
+
+class InMemoryHistoryCache(HistoryCache):
+    """
+    In-process LRU cache. Chats not read or written for `idle_seconds` are
+    evicted, as are the least recently used chats when the serialized histories
+    exceed `max_bytes`.
+
+    Each worker has its own cache, and writes only reach the cache of the worker
+    that handles them. Use it with a single worker, or for tests.
+    """
+
+    def __init__(self, max_bytes: int, idle_seconds: float) -> None:
+        """Start empty, holding up to `max_bytes` of serialized history."""
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        # chat_id -> (serialized messages, their size, last access time)
+        self._entries: OrderedDict[str, tuple[list[str], int, float]] = OrderedDict()
+        self._n_bytes = 0
+        # Chats being loaded -> whether a message was written during the load
+        self._loading: dict[str, bool] = {}
+
+    @property
+    def n_bytes(self) -> int:
+        """Size of the cached histories, serialized."""
+        return self._n_bytes
+
+    def __len__(self) -> int:
+        """The number of chats cached."""
+        return len(self._entries)
+
+    async def get(self, chat_id: str) -> ChatHistory | None:
+        """Get the cached history of a chat, or None if it is not cached."""
+        self._evict_idle()
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return None
+        self._put(chat_id, entry[0])
+        return [_deserialize(m) for m in entry[0]]
+
+    async def begin_load(self, chat_id: str) -> Any:
+        """Start loading a history from the database."""
+        self._loading[chat_id] = False
+        return None
+
+    async def set(self, chat_id: str, history: ChatHistory, token: Any) -> None:
+        """Cache the history, unless a message was written during the load."""
+        if self._loading.pop(chat_id, False):
+            return
+        self._put(chat_id, [_serialize(m) for m in history])
+        self._evict_over_budget()
+
+    async def append(self, chat_id: str, message: ChatMessage) -> None:
+        """Add a new message to a cached history."""
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            if chat_id in self._loading:
+                self._loading[chat_id] = True
+            return
+        self._put(chat_id, [*entry[0], _serialize(message)])
+        self._evict_over_budget()
+
+    async def update_request(self, chat_id: str, request_id: int, values: dict) -> None:
+        """Update fields of a request in a cached history."""
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            if chat_id in self._loading:
+                self._loading[chat_id] = True
+            return
+        messages = [_updated(m, request_id, values) for m in entry[0]]
+        self._put(chat_id, messages)
+        self._evict_over_budget()
+
+    async def delete(self, chat_id: str) -> None:
+        """Remove a chat from the cache."""
+        entry = self._entries.pop(chat_id, None)
+        if entry is not None:
+            self._n_bytes -= entry[1]
+
+    def _put(self, chat_id: str, messages: list[str]) -> None:
+        """Store a chat's messages as the most recently used entry."""
+        old = self._entries.pop(chat_id, None)
+        if old is not None:
+            self._n_bytes -= old[1]
+        size = sum(len(m) for m in messages)
+        self._entries[chat_id] = (messages, size, time.monotonic())
+        self._n_bytes += size
+
+    def _evict_idle(self) -> None:
+        """Evict chats not used for `idle_seconds`. The least recently used chats
+        come first, so stop at the first chat still in use."""
+        cutoff = time.monotonic() - self.idle_seconds
+        while self._entries:
+            chat_id, (_, size, last_used) = next(iter(self._entries.items()))
+            if last_used >= cutoff:
+                break
+            del self._entries[chat_id]
+            self._n_bytes -= size
+
+    def _evict_over_budget(self) -> None:
+        """Evict the least recently used chats until the cache fits its budget."""
+        self._evict_idle()
+        while self._n_bytes > self.max_bytes and self._entries:
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._n_bytes -= size
+
+
+class RedisHistoryCache(HistoryCache):
+    """
+    Cache shared by all workers, in Redis. Each chat is a list of serialized
+    messages that expires after `idle_seconds` without being read or written.
+    The memory budget is Redis's own: configure `maxmemory` with an LRU
+    `maxmemory-policy` on the server.
+    """
+
+    def __init__(self, url: str, idle_seconds: float) -> None:
+        """Connect to Redis at `url`, with the `redis` package imported lazily."""
+        from redis import asyncio as aioredis
+
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self.idle_seconds = int(idle_seconds)
+
+    async def get(self, chat_id: str) -> ChatHistory | None:
+        """Get the cached history of a chat, or None if it is not cached."""
+        key = _history_key(chat_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.expire(key, self.idle_seconds)
+            pipe.exists(key)
+            messages, _, exists = await pipe.execute()
+        if not exists:
+            return None
+        # The first element marks the list as existing, even for an empty chat
+        return [_deserialize(m) for m in messages[1:]]
+
+    async def begin_load(self, chat_id: str) -> Any:
+        """Return the number of writes to the chat so far."""
+        return await self._redis.get(_generation_key(chat_id))
+
+    async def set(self, chat_id: str, history: ChatHistory, token: Any) -> None:
+        """Cache the history, unless a message was written during the load."""
+        key, generation_key = _history_key(chat_id), _generation_key(chat_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            await pipe.watch(generation_key)
+            if await pipe.get(generation_key) != token:
+                return
+            pipe.multi()
+            pipe.delete(key)
+            pipe.rpush(key, "", *[_serialize(m) for m in history])
+            pipe.expire(key, self.idle_seconds)
+            try:
+                await pipe.execute()
+            except Exception as e:
+                # A write happened during the load: leave the chat uncached
+                logger.info(f"Not caching history of chat {chat_id}: {e}")
+
+    async def append(self, chat_id: str, message: ChatMessage) -> None:
+        """Add a new message to a cached history."""
+        key = _history_key(chat_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.rpushx(key, _serialize(message))
+            pipe.expire(key, self.idle_seconds)
+            pipe.incr(_generation_key(chat_id))
+            pipe.expire(_generation_key(chat_id), self.idle_seconds)
+            await pipe.execute()
+
+    async def update_request(self, chat_id: str, request_id: int, values: dict) -> None:
+        """
+        Update fields of a request in a cached history. The history is watched
+        while the request is found, and read again if another write changed it
+        before the update; if it keeps changing, the chat is left uncached.
+        """
+        from redis.exceptions import WatchError
+
+        key, generation_key = _history_key(chat_id), _generation_key(chat_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            for _ in range(MAX_UPDATE_ATTEMPTS):
+                try:
+                    await pipe.watch(key)
+                    messages: list[Any] = await pipe.lrange(key, 0, -1)
+                    pipe.multi()
+                    pipe.incr(generation_key)
+                    pipe.expire(generation_key, self.idle_seconds)
+                    for index, serialized in enumerate(messages[1:], start=1):
+                        updated = _updated(serialized, request_id, values)
+                        if updated is not serialized:
+                            pipe.lset(key, index, updated)
+                            break
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+        logger.info(f"Not caching history of chat {chat_id}: too many writes")
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.incr(generation_key)
+            await pipe.execute()
+
+    async def delete(self, chat_id: str) -> None:
+        """Remove a chat from the cache."""
+        await self._redis.delete(_history_key(chat_id))
+
+
+def _history_key(chat_id: str) -> str:
+    """Redis key of a chat's history."""
+    return f"chat_history:{chat_id}"
+
+
+def _generation_key(chat_id: str) -> str:
+    """Redis key counting the writes to a chat."""
+    return f"chat_history_generation:{chat_id}"
+
+
+def _serialize(message: ChatMessage) -> str:
+    """Serialize a message to JSON."""
+    return message.model_dump_json()
+
+
+def _deserialize(serialized: str) -> ChatMessage:
+    """Deserialize a message from JSON."""
+    data = json.loads(serialized)
+    if "response_id" in data:
+        return ChatResponse.model_validate(data)
+    return ChatUserMessage.model_validate(data)
+
+
+def _updated(serialized: str, request_id: int, values: dict) -> str:
+    """Apply `values` to a serialized message if it is the request with this id.
+    Other messages are returned as they are."""
+    data = json.loads(serialized)
+    if "response_id" in data or data["request_id"] != request_id:
+        return serialized
+    return json.dumps({**data, **values})
+
+
+_HISTORY_CACHE: HistoryCache | None = None
+
+
+def get_history_cache() -> HistoryCache:
+    """
+    Return the chat history cache of this process, as configured by
+    `HISTORY_CACHE_BACKEND`: "redis", "memory" or "off".
+    """
+    global _HISTORY_CACHE
+    if _HISTORY_CACHE is None:
+        if HISTORY_CACHE_BACKEND == "redis":
+            _HISTORY_CACHE = RedisHistoryCache(REDIS_URL, HISTORY_CACHE_IDLE_SECONDS)
+        elif HISTORY_CACHE_BACKEND == "memory":
+            _HISTORY_CACHE = InMemoryHistoryCache(
+                HISTORY_CACHE_MAX_BYTES, HISTORY_CACHE_IDLE_SECONDS
+            )
+        else:
+            _HISTORY_CACHE = NoHistoryCache()
+    return _HISTORY_CACHE
@@ -0,0 +1,96 @@
+"""This module contains the thread pool used to run model inference (embeddings,
+reranking) without blocking the event loop."""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator, TypeVar
+
+from ...config import INFERENCE_WORKERS
+from .metrics import INFERENCE_QUEUED, INFERENCE_SECONDS
+from .tracing import span
+
+T = TypeVar("T")
+
+# global so that all requests share the same bounded pool of inference threads
+_INFERENCE_EXECUTOR: ThreadPoolExecutor | None = None
+
+
+def get_inference_executor() -> ThreadPoolExecutor:
+    """Return the process-wide inference thread pool."""
+    global _INFERENCE_EXECUTOR
+    if _INFERENCE_EXECUTOR is None:
+        _INFERENCE_EXECUTOR = ThreadPoolExecutor(
+            max_workers=INFERENCE_WORKERS, thread_name_prefix="inference"
+        )
+    return _INFERENCE_EXECUTOR
+
+
+# The time, as of `time.monotonic`, after which inference calls of the current task
+# are not started, e.g. the end of the budget of the stage that makes them
+_deadline: ContextVar[float | None] = ContextVar("inference_deadline", default=None)
+
+
+@contextmanager
+def inference_deadline(deadline: float) -> Iterator[None]:
+    """Do not start inference calls made in the block, including by tasks it
+    creates, after `deadline`, as of `time.monotonic`."""
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+async def run_inference(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Run a blocking inference call in the inference thread pool and await its
+    result. The calls waiting for a thread and the time each call takes are
+    recorded in the metrics, and the call is a span of the request's trace.
+
+    A call cannot be interrupted once it has started, so under an
+    `inference_deadline` it is not submitted, nor started by the thread that
+    takes it, once the deadline has passed.
+
+    Raises
+    ------
+    TimeoutError
+        If the deadline passed before the call started.
+    """
+    name = getattr(func, "__qualname__", "unknown")
+    deadline = _deadline.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise TimeoutError(f"No time left to run {name}")
+    loop = asyncio.get_running_loop()
+    INFERENCE_QUEUED.inc()
+    queued = True
+    lock = threading.Lock()
+
+    def dequeue() -> None:
+        """Leave the queue once, when a thread starts the call or it is cancelled
+        before that."""
+        nonlocal queued
+        with lock:
+            if queued:
+                queued = False
+                INFERENCE_QUEUED.dec()
+
+    def run() -> T:
+        """Run the call, unless its deadline passed while it was queued."""
+        dequeue()
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError(f"{name} was not started before its deadline")
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            INFERENCE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+    try:
+        with span("inference", function=name):
+            return await loop.run_in_executor(get_inference_executor(), run)
+    finally:
+        dequeue()
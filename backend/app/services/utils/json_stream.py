@@ -0,0 +1,132 @@
+"""This module contains a helper to read a string field out of a JSON object while
+it is still being generated, so that an LLM's answer can be streamed before the
+whole JSON response is available.
+"""
+
+import re
+
+_SIMPLE_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+_REPLACEMENT_CHARACTER = 0xFFFD
+
+
+class JSONStringFieldExtractor:
+    """
+    Incrementally extract the value of a top-level string field from a JSON object
+    received in pieces.
+
+    Example
+    -------
+    >>> extractor = JSONStringFieldExtractor("answer")
+    >>> extractor.feed('{"extracted_info": [], "ans')
+    ''
+    >>> extractor.feed('wer": "Hello\\\\nwor')
+    'Hello\\nwor'
+    >>> extractor.feed('ld"}')
+    'ld'
+    """
+
+    def __init__(self, field: str) -> None:
+        """Wait for the start of the value of `field`."""
+        self._field_start = re.compile(rf'"{re.escape(field)}"\s*:\s*"')
+        self._buffer = ""
+        # Position in the buffer of the next character of the value to decode,
+        # or None until the start of the value has been found
+        self._position: int | None = None
+        self.done = False
+
+    def feed(self, text: str) -> str:
+        """
+        Add the next piece of the JSON text and return the newly decoded part of
+        the field's value. Escapes split across pieces are held back until they
+        are complete.
+        """
+        self._buffer += text
+        if self.done:
+            return ""
+
+        if self._position is None:
+            match = self._field_start.search(self._buffer)
+            if match is None:
+                return ""
+            self._position = match.end()
+
+        decoded = []
+        while self._position < len(self._buffer):
+            char = self._buffer[self._position]
+            if char == '"':
+                self.done = True
+                break
+            if char != "\\":
+                decoded.append(char)
+                self._position += 1
+                continue
+
+            # Escape sequence: wait until it is complete
+            if self._position + 1 >= len(self._buffer):
+                break
+            escape = self._buffer[self._position + 1]
+            if escape == "u":
+                code_point, length = self._decode_unicode_escape(self._position)
+                if length == 0:
+                    break
+                decoded.append(chr(code_point))
+                self._position += length
+            else:
+                decoded.append(_SIMPLE_ESCAPES.get(escape, escape))
+                self._position += 2
+
+        return "".join(decoded)
+
+    def _decode_unicode_escape(self, position: int) -> tuple[int, int]:
+        """
+        Decode the `\\uXXXX` escape at `position`, with the low surrogate that
+        follows it if it is a high surrogate. Returns the code point and the
+        length of the escape, or a length of 0 if it is not complete yet. Invalid
+        hex digits and unpaired surrogates decode to U+FFFD, consuming only the
+        escape and its valid hex digits.
+        """
+        code_point, length = self._read_hex(position)
+        if length < 6:
+            return code_point, length
+        if 0xDC00 <= code_point <= 0xDFFF:
+            return _REPLACEMENT_CHARACTER, length
+        if not 0xD800 <= code_point <= 0xDBFF:
+            return code_point, length
+
+        # A high surrogate, decoded with the low surrogate following it
+        following = self._buffer[position + 6 : position + 8]
+        if following != "\\u"[: len(following)]:
+            return _REPLACEMENT_CHARACTER, length
+        if len(following) < 2:
+            return 0, 0
+        low, low_length = self._read_hex(position + 6)
+        if low_length == 0:
+            return 0, 0
+        if low_length == 6 and 0xDC00 <= low <= 0xDFFF:
+            return 0x10000 + ((code_point - 0xD800) << 10) + (low - 0xDC00), 12
+        # The following escape is decoded on its own
+        return _REPLACEMENT_CHARACTER, length
+
+    def _read_hex(self, position: int) -> tuple[int, int]:
+        """
+        Read the four hex digits of the `\\u` escape at `position`. Returns the
+        code point and a length of 6, U+FFFD and the length up to the first
+        invalid digit, or a length of 0 if the digits are not all received yet.
+        """
+        digits = self._buffer[position + 2 : position + 6]
+        for i, digit in enumerate(digits):
+            if digit not in _HEX_DIGITS:
+                return _REPLACEMENT_CHARACTER, 2 + i
+        if len(digits) < 4:
+            return 0, 0
+        return int(digits, 16), 6
@@ -0,0 +1,157 @@
+"""This module keeps chat requests within a latency budget.
+
+Each request has an end-to-end budget and some stages have budgets of their own.
+A stage that would exceed its budget, or the time the request has left, is
+replaced by a cheaper fallback rather than making the request slower, and the
+fallback is recorded as a degradation of the response.
+"""
+
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Callable, Coroutine, TypeVar
+
+from pydantic import BaseModel
+
+from ...chat.config import (
+    CHAT_ANSWER_RESERVE_SECONDS,
+    CHAT_LATENCY_BUDGET_SECONDS,
+    CHAT_MIN_CONTEXT_FRACTION,
+)
+from ...utils import setup_logger
+from .inference import inference_deadline
+
+logger = setup_logger()
+
+T = TypeVar("T")
+
+
+class Degradation(BaseModel):
+    """A stage replaced by a fallback, and the seconds it had to run in."""
+
+    stage: str
+    fallback: str
+    budget_seconds: float
+
+
+class LatencyBudget:
+    """
+    The latency budget of a request. `total_seconds` of 0 means no end-to-end
+    budget.
+    """
+
+    def __init__(self, total_seconds: float = CHAT_LATENCY_BUDGET_SECONDS) -> None:
+        """Start the clock for a request now."""
+        self.total_seconds = total_seconds
+        self.start = time.monotonic()
+        self.degradations: list[Degradation] = []
+
+    def remaining(self) -> float | None:
+        """Seconds left in the end-to-end budget, or None if there is none."""
+        if self.total_seconds <= 0:
+            return None
+        return max(0.0, self.start + self.total_seconds - time.monotonic())
+
+    def stage_timeout(self, stage_seconds: float) -> float | None:
+        """
+        Seconds a stage with a budget of `stage_seconds` (0 for none) may run: the
+        smaller of its budget and the time left. None if neither is limited.
+        """
+        limits = [
+            limit
+            for limit in (stage_seconds or None, self.remaining())
+            if limit is not None
+        ]
+        return min(limits) if limits else None
+
+    def degrade(
+        self, stage: str, fallback: str, budget_seconds: float, started: bool = False
+    ) -> None:
+        """Record that a stage was replaced by a fallback. `started` is whether the
+        stage had started work that cannot be interrupted, e.g. inference."""
+        logger.warning(
+            f"Latency budget: {stage} replaced by {fallback} "
+            f"after {budget_seconds:.2f}s"
+            + (
+                "; any inference it started continues in the background"
+                if started
+                else ""
+            )
+        )
+        self.degradations.append(
+            Degradation(
+                stage=stage, fallback=fallback, budget_seconds=round(budget_seconds, 4)
+            )
+        )
+
+    async def run_stage(
+        self,
+        stage: str,
+        stage_seconds: float,
+        work: Coroutine[object, object, T],
+        fallback: str,
+        get_fallback: Callable[[], T],
+    ) -> T:
+        """
+        Run a stage within its budget. If it runs out of time, or no time is left
+        to start it, return the result of `get_fallback` instead.
+
+        Inference runs in threads, which cannot be cancelled: inference the stage
+        started before running out of time runs to completion in the background,
+        but none is started afterwards.
+        """
+        timeout = self.stage_timeout(stage_seconds)
+        if timeout is None:
+            return await work
+        if timeout > 0:
+            try:
+                with inference_deadline(time.monotonic() + timeout):
+                    return await asyncio.wait_for(work, timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.degrade(stage, fallback, timeout, started=True)
+        else:
+            work.close()
+            self.degrade(stage, fallback, timeout)
+        return get_fallback()
+
+    def context_token_budget(self, token_budget: int) -> int:
+        """
+        The token budget for the prompt's context. When less than
+        `CHAT_ANSWER_RESERVE_SECONDS` are left for answering, it is cut in
+        proportion, down to `CHAT_MIN_CONTEXT_FRACTION` of `token_budget`: a
+        shorter prompt is processed faster.
+        """
+        remaining = self.remaining()
+        if remaining is None or remaining >= CHAT_ANSWER_RESERVE_SECONDS:
+            return token_budget
+        fraction = max(
+            CHAT_MIN_CONTEXT_FRACTION, remaining / CHAT_ANSWER_RESERVE_SECONDS
+        )
+        self.degrade("prompt", "reduced_context", remaining)
+        return int(token_budget * fraction)
+
+
+# The latency budget of the current request
+_latency_budget: ContextVar[LatencyBudget | None] = ContextVar(
+    "latency_budget", default=None
+)
+
+
+def start_latency_budget(
+    total_seconds: float = CHAT_LATENCY_BUDGET_SECONDS,
+) -> LatencyBudget:
+    """
+    Start the latency budget of the current request, and return it. Call it at the
+    start of the request: tasks started afterwards, e.g. by a `StageGraph`, share
+    the budget.
+    """
+    latency_budget = LatencyBudget(total_seconds)
+    _latency_budget.set(latency_budget)
+    return latency_budget
+
+
+def get_latency_budget() -> LatencyBudget:
+    """Get the latency budget of the current request, or one without an
+    end-to-end budget."""
+    return _latency_budget.get() or LatencyBudget(total_seconds=0)
@@ -0,0 +1,251 @@
+"""This module contains a gateway that limits the number of concurrent LLM calls.
+
+Calls beyond the limit wait in a priority queue, so that answers are generated
+ahead of less urgent calls such as refining a message. When the expected wait for
+a slot exceeds a deadline, calls are rejected straight away with
+`LLMOverloadedError` so that clients can back off instead of timing out.
+
+The gateway is per process: with several workers, each allows
+`LLM_MAX_CONCURRENCY` calls at a time.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import AsyncIterator
+
+from pydantic import BaseModel
+
+from ...config import (
+    LLM_EXPECTED_CALL_SECONDS,
+    LLM_MAX_CONCURRENCY,
+    LLM_MAX_QUEUE_WAIT_SECONDS,
+)
+from ...utils import setup_logger
+from .metrics import LLM_IN_FLIGHT, LLM_QUEUED, LLM_REJECTED
+
+logger = setup_logger()
+
+# Weight of the latest observation in the moving averages of wait and call times
+EWMA_ALPHA = 0.2
+
+
+class LLMPriority(IntEnum):
+    """Priority of an LLM call. Lower values are served first."""
+
+    ANSWER = 0
+    REFINE = 1
+
+
+class LLMOverloadedError(Exception):
+    """Raised when an LLM call cannot get a slot within the queue deadline."""
+
+    def __init__(self, retry_after: float) -> None:
+        """Round the wait up to whole seconds, at least one."""
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"LLM is overloaded, retry after {self.retry_after} seconds")
+
+
+class LLMGatewayStats(BaseModel):
+    """Current state of the LLM gateway, with moving averages in seconds."""
+
+    max_concurrency: int
+    max_queue_wait_seconds: float
+    in_flight: int
+    queue_depth: int
+    queue_depth_by_priority: dict[str, int]
+    mean_wait_seconds: float
+    mean_call_seconds: float | None
+    n_completed: int
+    n_rejected: int
+
+
+class LLMGateway:
+    """
+    Limit the number of concurrent LLM calls, queueing the excess by priority.
+    Until calls have completed, waits are estimated with `expected_call_seconds`
+    as the duration of a call, if given.
+
+    Example
+    -------
+    >>> gateway = LLMGateway(max_concurrency=2, max_queue_wait_seconds=30)
+    >>> async with gateway.slot(LLMPriority.ANSWER):
+    ...     response = await acompletion(...)
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue_wait_seconds: float,
+        expected_call_seconds: float | None = None,
+    ) -> None:
+        """Start with no calls in flight or waiting."""
+        self.max_concurrency = max_concurrency
+        self.max_queue_wait_seconds = max_queue_wait_seconds
+        self.expected_call_seconds = expected_call_seconds
+        self._in_flight = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._mean_wait_seconds = 0.0
+        self._mean_call_seconds: float | None = None
+        self._n_completed = 0
+        self._n_rejected = 0
+
+    @asynccontextmanager
+    async def slot(self, priority: LLMPriority) -> AsyncIterator[None]:
+        """
+        Wait for a slot, hold it while the block runs, then hand it to the next
+        waiter.
+
+        Raises
+        ------
+        LLMOverloadedError
+            If the expected or actual wait exceeds `max_queue_wait_seconds`.
+        """
+        await self._acquire(priority)
+        self._update_metrics()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._mean_call_seconds = _ewma(
+                self._mean_call_seconds, time.monotonic() - start
+            )
+            self._n_completed += 1
+            self._release()
+            self._update_metrics()
+
+    def estimate_wait(self, priority: LLMPriority) -> float:
+        """
+        Estimate how long a call with this priority would wait for a slot, from
+        the number of calls ahead of it and the mean duration of a call, or the
+        expected duration until a call has completed.
+        """
+        if self._in_flight < self.max_concurrency and not self._waiters:
+            return 0.0
+        call_seconds = (
+            self._mean_call_seconds
+            if self._mean_call_seconds is not None
+            else self.expected_call_seconds
+        )
+        if call_seconds is None:
+            # No call has completed yet, so there is nothing to estimate from
+            return 0.0
+        n_ahead = sum(1 for p, _, _ in self._waiters if p <= priority)
+        return (n_ahead // self.max_concurrency + 1) * call_seconds
+
+    def stats(self) -> LLMGatewayStats:
+        """
+        Get the current state of the gateway.
+        """
+        depth_by_priority = {p.name.lower(): 0 for p in LLMPriority}
+        for p, _, _ in self._waiters:
+            depth_by_priority[LLMPriority(p).name.lower()] += 1
+        return LLMGatewayStats(
+            max_concurrency=self.max_concurrency,
+            max_queue_wait_seconds=self.max_queue_wait_seconds,
+            in_flight=self._in_flight,
+            queue_depth=len(self._waiters),
+            queue_depth_by_priority=depth_by_priority,
+            mean_wait_seconds=self._mean_wait_seconds,
+            mean_call_seconds=self._mean_call_seconds,
+            n_completed=self._n_completed,
+            n_rejected=self._n_rejected,
+        )
+
+    async def _acquire(self, priority: LLMPriority) -> None:
+        """Take a free slot, or queue for one."""
+        if self._in_flight < self.max_concurrency and not self._waiters:
+            self._in_flight += 1
+            self._mean_wait_seconds = _ewma(self._mean_wait_seconds, 0.0)
+            return
+
+        estimated_wait = self.estimate_wait(priority)
+        if estimated_wait > self.max_queue_wait_seconds:
+            self._reject(estimated_wait)
+
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        entry = (int(priority), next(self._sequence), future)
+        heapq.heappush(self._waiters, entry)
+        self._update_metrics()
+        try:
+            await asyncio.wait([future], timeout=self.max_queue_wait_seconds)
+        except asyncio.CancelledError:
+            if future.done():
+                # The slot was handed over just before cancellation
+                self._release()
+            else:
+                self._remove_waiter(entry)
+            raise
+
+        if not future.done():
+            self._remove_waiter(entry)
+            self._reject(self.estimate_wait(priority))
+
+        # The releasing call handed its slot over, so `_in_flight` is unchanged
+        self._mean_wait_seconds = _ewma(
+            self._mean_wait_seconds, time.monotonic() - start
+        )
+
+    def _release(self) -> None:
+        """Hand the slot to the highest-priority waiter, or free it."""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def _remove_waiter(self, entry: tuple[int, int, asyncio.Future]) -> None:
+        """Remove a waiter that gave up."""
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+        entry[2].cancel()
+        self._update_metrics()
+
+    def _update_metrics(self) -> None:
+        """Update the gauges of calls in flight and queued."""
+        LLM_IN_FLIGHT.set(self._in_flight)
+        LLM_QUEUED.set(len(self._waiters))
+
+    def _reject(self, expected_wait: float) -> None:
+        """Reject a call, suggesting when to retry."""
+        self._n_rejected += 1
+        LLM_REJECTED.inc()
+        logger.warning(
+            f"Rejecting LLM call: {len(self._waiters)} queued, "
+            f"{self._in_flight} in flight, expected wait {expected_wait:.1f}s"
+        )
+        raise LLMOverloadedError(
+            retry_after=max(
+                expected_wait,
+                self._mean_call_seconds or self.expected_call_seconds or 1.0,
+            )
+        )
+
+
+def _ewma(mean: float | None, value: float) -> float:
+    """Update an exponentially weighted moving average."""
+    if mean is None:
+        return value
+    return (1 - EWMA_ALPHA) * mean + EWMA_ALPHA * value
+
+
+_LLM_GATEWAY: LLMGateway | None = None
+
+
+def get_llm_gateway() -> LLMGateway:
+    """
+    Return the gateway shared by all LLM calls in this process.
+    """
+    global _LLM_GATEWAY
+    if _LLM_GATEWAY is None:
+        _LLM_GATEWAY = LLMGateway(
+            LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE_WAIT_SECONDS, LLM_EXPECTED_CALL_SECONDS
+        )
+    return _LLM_GATEWAY
@@ -0,0 +1,121 @@
+"""This module contains the configuration of the LLM used by each stage of the chat
+pipeline, and a record of the models that served each stage of a request.
+
+Each stage has its own model, token limit, temperature and timeout, and an
+optional chain of fallback models, configured in `app.config`.
+"""
+
+from contextvars import ContextVar
+from enum import Enum
+
+from pydantic import BaseModel
+
+from ...config import (
+    ANSWER_LLM_FALLBACK_MODELS,
+    ANSWER_LLM_MAX_TOKENS,
+    ANSWER_LLM_MODEL,
+    ANSWER_LLM_TEMPERATURE,
+    ANSWER_LLM_TIMEOUT_SECONDS,
+    REFINE_LLM_FALLBACK_MODELS,
+    REFINE_LLM_MAX_TOKENS,
+    REFINE_LLM_MODEL,
+    REFINE_LLM_TEMPERATURE,
+    REFINE_LLM_TIMEOUT_SECONDS,
+)
+from .llm_gateway import LLMPriority
+
+
+class LLMStage(str, Enum):
+    """A stage of the chat pipeline that calls the LLM."""
+
+    ANSWER = "answer"
+    REFINE = "refine"
+
+    @property
+    def priority(self) -> LLMPriority:
+        """Priority of the stage's calls in the LLM gateway."""
+        return LLMPriority[self.name]
+
+
+class LLMStageConfig(BaseModel):
+    """The models and completion parameters of a stage. `timeout_seconds` is None
+    for no timeout."""
+
+    models: list[str]
+    max_tokens: int
+    temperature: float
+    timeout_seconds: float | None
+
+
+class LLMCall(BaseModel):
+    """The model that served a stage, the models that failed before it, and the
+    tokens and wall time of the call, where known."""
+
+    model: str
+    failed_models: list[str] = []
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    seconds: float | None = None
+
+
+def _split(models: str) -> list[str]:
+    """Split a comma-separated list of models."""
+    return [m.strip() for m in models.split(",") if m.strip()]
+
+
+LLM_STAGE_CONFIGS = {
+    LLMStage.ANSWER: LLMStageConfig(
+        models=[ANSWER_LLM_MODEL, *_split(ANSWER_LLM_FALLBACK_MODELS)],
+        max_tokens=ANSWER_LLM_MAX_TOKENS,
+        temperature=ANSWER_LLM_TEMPERATURE,
+        timeout_seconds=ANSWER_LLM_TIMEOUT_SECONDS or None,
+    ),
+    LLMStage.REFINE: LLMStageConfig(
+        models=[REFINE_LLM_MODEL, *_split(REFINE_LLM_FALLBACK_MODELS)],
+        max_tokens=REFINE_LLM_MAX_TOKENS,
+        temperature=REFINE_LLM_TEMPERATURE,
+        timeout_seconds=REFINE_LLM_TIMEOUT_SECONDS or None,
+    ),
+}
+
+# The LLM calls of the current request, by stage
+_llm_calls: ContextVar[dict[str, LLMCall] | None] = ContextVar(
+    "llm_calls", default=None
+)
+
+
+def record_llm_calls() -> dict[str, LLMCall]:
+    """
+    Start recording the LLM calls of the current request, and return the record.
+    Call it at the start of the request: tasks started afterwards, e.g. by a
+    `StageGraph`, share the record.
+    """
+    llm_calls: dict[str, LLMCall] = {}
+    _llm_calls.set(llm_calls)
+    return llm_calls
+
+
+def get_llm_calls() -> dict[str, LLMCall]:
+    """Get the LLM calls of the current request recorded so far."""
+    return _llm_calls.get() or {}
+
+
+def record_llm_call(
+    stage: LLMStage,
+    model: str,
+    failed_models: list[str],
+    prompt_tokens: int | None = None,
+    completion_tokens: int | None = None,
+    seconds: float | None = None,
+) -> None:
+    """Record the model that served a stage, and the tokens and seconds of its
+    call, if the request is being recorded."""
+    llm_calls = _llm_calls.get()
+    if llm_calls is not None:
+        llm_calls[stage.value] = LLMCall(
+            model=model,
+            failed_models=failed_models,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            seconds=seconds,
+        )
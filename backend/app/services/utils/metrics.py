@@ -0,0 +1,207 @@
+"""This module contains the Prometheus metrics of the backend.
+
+With several workers, each process writes its metrics to files in
+`PROMETHEUS_MULTIPROC_DIR` and `/metrics` aggregates the files of all of them.
+Recording a metric only updates a memory-mapped file, so the metrics can stay on
+in production. Gauges are summed over the live processes.
+"""
+
+import os
+import time
+from typing import Any
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Seconds, from fast database calls to slow LLM answers
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to respond to HTTP requests, until the end of the response",
+    ["method", "route", "status"],
+    buckets=_BUCKETS,
+)
+CHAT_STAGE_SECONDS = Histogram(
+    "chat_stage_duration_seconds",
+    "Time taken by each stage of the chat pipeline, in completed requests",
+    ["stage"],
+    buckets=_BUCKETS,
+)
+LLM_CALL_SECONDS = Histogram(
+    "llm_call_duration_seconds",
+    "Time taken by LLM calls, without waiting for the LLM gateway",
+    ["stage", "model"],
+    buckets=_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "llm_tokens", "Tokens of LLM calls, as reported", ["stage", "model", "kind"]
+)
+LLM_IN_FLIGHT = Gauge(
+    "llm_calls_in_flight",
+    "LLM calls holding a slot of the LLM gateway",
+    multiprocess_mode="livesum",
+)
+LLM_QUEUED = Gauge(
+    "llm_calls_queued",
+    "LLM calls waiting for a slot of the LLM gateway",
+    multiprocess_mode="livesum",
+)
+LLM_REJECTED = Counter("llm_calls_rejected", "LLM calls rejected as overloaded")
+LLM_RESPONSE_PARSES = Counter(
+    "llm_response_parses", "How LLM responses were parsed", ["model", "outcome"]
+)
+INFERENCE_SECONDS = Histogram(
+    "inference_duration_seconds",
+    "Time taken by model inference calls (embeddings, reranking)",
+    ["function"],
+    buckets=_BUCKETS,
+)
+INFERENCE_QUEUED = Gauge(
+    "inference_queued",
+    "Inference calls waiting for a thread of the inference executor",
+    multiprocess_mode="livesum",
+)
+CACHE_LOOKUPS = Counter(
+    "cache_lookups", "Cache lookups, by cache and result", ["cache", "result"]
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "Database connections checked out of the pool",
+    multiprocess_mode="livesum",
+)
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow",
+    "Database connections open beyond the pool size",
+    multiprocess_mode="livesum",
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "db_pool_wait_seconds",
+    "Time to get a database connection from the pool, including connecting",
+    buckets=_BUCKETS,
+)
+
+
+def generate_metrics() -> tuple[bytes, str]:
+    """The metrics of all the workers, in Prometheus' text format, and its content
+    type."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    """Count a lookup of a cache, e.g. "history" or "semantic"."""
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def observe_chat_stages(stage_seconds: dict[str, float]) -> None:
+    """Record the seconds each stage of a completed chat request took."""
+    for stage, seconds in stage_seconds.items():
+        CHAT_STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def observe_llm_call(
+    stage: str,
+    model: str,
+    seconds: float,
+    prompt_tokens: int | None,
+    completion_tokens: int | None,
+) -> None:
+    """Record the time and tokens of an LLM call."""
+    LLM_CALL_SECONDS.labels(stage, model).observe(seconds)
+    if prompt_tokens is not None:
+        LLM_TOKENS.labels(stage, model, "prompt").inc(prompt_tokens)
+    if completion_tokens is not None:
+        LLM_TOKENS.labels(stage, model, "completion").inc(completion_tokens)
+
+
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """The default pool of async engines, recording how long each checkout waits
+    for a connection."""
+
+    def _do_get(self) -> Any:
+        """Check out a connection, timing the wait."""
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+
+def instrument_pool(pool: Pool) -> None:
+    """Keep the gauges of checked out and overflow connections up to date."""
+
+    def update(*args: Any) -> None:
+        """Set the gauges from the pool."""
+        DB_POOL_CHECKED_OUT.set(pool.checkedout())  # type: ignore[attr-defined]
+        DB_POOL_OVERFLOW.set(max(0, pool.overflow()))  # type: ignore[attr-defined]
+
+    event.listen(pool, "checkout", update)
+    event.listen(pool, "checkin", update)
+
+
+class HTTPMetricsMiddleware:
+    """
+    ASGI middleware recording the time to respond to each request, by route
+    template (e.g. `/chat/{chat_id}`) rather than path, to keep the number of
+    series bounded.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        """Wrap `app`; route templates are looked up on first use."""
+        self.app = app
+        self._route_paths: dict[Any, str] | None = None
+
+    async def __call__(
+        self,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+    ) -> None:
+        """Time an HTTP request and record it under its route and status."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            """Note the response status, then send the message."""
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"], self._route(scope), str(status)
+            ).observe(time.perf_counter() - start)
+
+    def _route(self, scope: Scope) -> str:
+        """The path template of the route that handled the request. The router
+        sets the endpoint in the scope; the app's routes map it to its path."""
+        if self._route_paths is None and "app" in scope:
+            self._route_paths = {
+                route.endpoint: route.path
+                for route in scope["app"].routes
+                if hasattr(route, "endpoint")
+            }
+        return (self._route_paths or {}).get(scope.get("endpoint"), "unmatched")
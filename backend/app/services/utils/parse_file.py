@@ -1,35 +1,75 @@
+import asyncio
 from io import BytesIO
 from typing import List
 
 import PyPDF2
 
+from ...config import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNKING_STRATEGY
+from ...ingestion.schemas import TextChunk
+from .chunking import TokenChunker
+from .embeddings import count_tokens, get_max_sequence_length
 
-async def parse_file(file: bytes) -> List[str]:
+FIXED_CHUNK_SIZE = 1000  # characters, used by the "page" strategy for text files
+
+
+async def parse_file(
+    file: bytes,
+    strategy: str = CHUNKING_STRATEGY,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> List[TextChunk]:
     """Parse the content of an uploaded file into chunks.
 
-    For PDFs, each page is treated as its own chunk.
-    For text files, the content is split into chunks of fixed size.
+    With the "token" strategy, the text is split into chunks of at most
+    `max_tokens` tokens of the embedding model (capped at the model's maximum
+    sequence length), respecting paragraph and sentence boundaries.
+
+    With the "page" strategy, each PDF page is treated as its own chunk and text
+    files are split into chunks of fixed size.
 
     Parameters
     ----------
     file : bytes
         The content of the uploaded file.
+    strategy : str
+        The chunking strategy, either "token" or "page".
+    max_tokens : int
+        The token budget for each chunk when using the "token" strategy.
+    overlap_tokens : int
+        The number of tokens shared by consecutive chunks when using the "token"
+        strategy.
 
     Returns
     -------
-    List[str]
-        A list of text chunks extracted from the file.
+    List[TextChunk]
+        A list of text chunks extracted from the file, with their token counts.
     """
+    return await asyncio.to_thread(
+        split_file, file, strategy, max_tokens, overlap_tokens
+    )
+
+
+def split_file(
+    file: bytes, strategy: str, max_tokens: int, overlap_tokens: int
+) -> List[TextChunk]:
+    """
+    Extract the text of a file and split it into chunks. This is the blocking
+    implementation of `parse_file`; see its docstring for the parameters.
+    """
+    if strategy not in ("token", "page"):
+        raise ValueError(f"Unknown chunking strategy: {strategy}")
+
     if file[:5] == b"%PDF-":
         pdf_reader = PyPDF2.PdfReader(BytesIO(file))
-        chunks = []
+        sections = []
         for page_num in range(len(pdf_reader.pages)):
             page = pdf_reader.pages[page_num]
             page_text = page.extract_text()
             if page_text and page_text.strip():
-                chunks.append(page_text.strip())
-        if not chunks:
+                sections.append(page_text.strip())
+        if not sections:
             raise RuntimeError("No text could be extracted from the uploaded PDF file.")
+        fixed_size_chunks = sections
 
     else:
         # Assume it's text
@@ -38,7 +78,21 @@ async def parse_file(file: bytes) -> List[str]:
             raise RuntimeError(
                 "No text could be extracted from the uploaded text file."
             )
-        chunk_size = 1000
-        chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+        sections = [text]
+        fixed_size_chunks = [
+            text[i : i + FIXED_CHUNK_SIZE]
+            for i in range(0, len(text), FIXED_CHUNK_SIZE)
+        ]
+
+    if strategy == "page":
+        return [
+            TextChunk(text=chunk, n_tokens=count_tokens(chunk))
+            for chunk in fixed_size_chunks
+        ]
 
-    return chunks
+    chunker = TokenChunker(
+        count_tokens=count_tokens,
+        max_tokens=min(max_tokens, get_max_sequence_length()),
+        overlap_tokens=overlap_tokens,
+    )
+    return chunker.split("\n\n".join(sections))
@@ -0,0 +1,176 @@
+"""This module contains a small staged pipeline connected by bounded asyncio
+queues.
+
+Each stage runs a configurable number of concurrent workers that take items from
+the stage's input queue and put results on the next stage's queue. Queues are
+bounded, so a slow stage applies backpressure to the stages before it instead of
+letting work pile up in memory. Items that fail in a stage skip the remaining
+stages and are returned with their error.
+
+A stage can split each item into parts, e.g. a file into batches of chunks, that
+go through the later stages as separate items, so that the later stages overlap
+on the parts of a single item too.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Iterable
+
+from ...ingestion.schemas import StageMetrics
+
+
+@dataclass
+class Stage:
+    """A pipeline stage: an async function applied to every item. If `split`, the
+    function returns a list of parts, which the later stages process separately."""
+
+    name: str
+    func: Callable[[Any], Awaitable[Any]]
+    workers: int = 1
+    queue_size: int = 4
+    split: bool = False
+
+
+@dataclass
+class PipelineResult:
+    """The result of an item, or of a part of it, that went through the pipeline."""
+
+    index: int
+    part: int = 0
+    value: Any = None
+    error: Exception | None = None
+    failed_stage: str | None = None
+
+
+@dataclass
+class _StageState:
+    """Mutable counters for a stage while the pipeline runs."""
+
+    stage: Stage
+    queue: asyncio.Queue
+    n_items: int = 0
+    busy_seconds: float = 0.0
+    queue_samples: list[float] = field(default_factory=list)
+    n_active_workers: int = 0
+
+
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Run items through a sequence of stages concurrently.
+
+    Parameters
+    ----------
+    stages
+        The stages, in order. The output of a stage is the input of the next one.
+        At most one stage can split items into parts.
+    """
+
+    def __init__(self, stages: list[Stage]) -> None:
+        """Check the stages and set them."""
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        if sum(stage.split for stage in stages) > 1:
+            raise ValueError("At most one stage of a pipeline can split items")
+        self.stages = stages
+        self.metrics: list[StageMetrics] = []
+
+    async def run(self, items: Iterable[Any]) -> list[PipelineResult]:
+        """
+        Run `items` through all stages and return their results in input order,
+        the parts of a split item in order after one another. Per-stage metrics
+        are available in `metrics` once the run is complete.
+        """
+        states = [
+            _StageState(stage=stage, queue=asyncio.Queue(maxsize=stage.queue_size))
+            for stage in self.stages
+        ]
+        results: list[PipelineResult] = []
+        start = time.perf_counter()
+
+        tasks = [asyncio.create_task(self._feed(items, states[0]))]
+        for i, state in enumerate(states):
+            next_state = states[i + 1] if i + 1 < len(states) else None
+            state.n_active_workers = state.stage.workers
+            tasks.extend(
+                asyncio.create_task(self._work(state, next_state, results))
+                for _ in range(state.stage.workers)
+            )
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        wall_seconds = time.perf_counter() - start
+        self.metrics = [self._get_metrics(state, wall_seconds) for state in states]
+        return sorted(results, key=lambda r: (r.index, r.part))
+
+    async def _feed(self, items: Iterable[Any], first: _StageState) -> None:
+        """Put items on the first queue, waiting when it is full."""
+        for index, item in enumerate(items):
+            await first.queue.put(PipelineResult(index=index, value=item))
+        for _ in range(first.stage.workers):
+            await first.queue.put(_DONE)
+
+    async def _work(
+        self,
+        state: _StageState,
+        next_state: _StageState | None,
+        results: list[PipelineResult],
+    ) -> None:
+        """Process items from a stage's queue until the stage is done."""
+        while True:
+            state.queue_samples.append(state.queue.qsize() / state.stage.queue_size)
+            item = await state.queue.get()
+            if item is _DONE:
+                break
+
+            outputs = [item]
+            if item.error is None:
+                started = time.perf_counter()
+                try:
+                    item.value = await state.stage.func(item.value)
+                except Exception as e:
+                    item.error, item.failed_stage = e, state.stage.name
+                state.busy_seconds += time.perf_counter() - started
+                state.n_items += 1
+                if state.stage.split and item.error is None:
+                    outputs = [
+                        PipelineResult(index=item.index, part=part, value=value)
+                        for part, value in enumerate(item.value)
+                    ]
+
+            for output in outputs:
+                if next_state is None:
+                    results.append(output)
+                else:
+                    await next_state.queue.put(output)
+
+        # The last worker of a stage to finish tells the next stage it is done
+        state.n_active_workers -= 1
+        if state.n_active_workers == 0 and next_state is not None:
+            for _ in range(next_state.stage.workers):
+                await next_state.queue.put(_DONE)
+
+    @staticmethod
+    def _get_metrics(state: _StageState, wall_seconds: float) -> StageMetrics:
+        """Summarise a stage's counters."""
+        samples = state.queue_samples or [0.0]
+        return StageMetrics(
+            name=state.stage.name,
+            workers=state.stage.workers,
+            n_items=state.n_items,
+            busy_seconds=state.busy_seconds,
+            items_per_second=state.n_items / wall_seconds if wall_seconds else 0.0,
+            utilisation=(
+                state.busy_seconds / (wall_seconds * state.stage.workers)
+                if wall_seconds
+                else 0.0
+            ),
+            mean_queue_occupancy=sum(samples) / len(samples),
+            max_queue_occupancy=max(samples),
+        )
@@ -20,10 +20,10 @@ class RAG(BaseModel):
         """
         You are going to write a JSON, whose TypeScript Interface is given below:
 
-        interface Response {{
+        interface Response {
             extracted_info: string[];
             answer: string;
-        }}
+        }
 
 
         For "extracted_info", extract from the REFERENCE TEXT below the most useful \
@@ -38,22 +38,33 @@ class RAG(BaseModel):
         """
         + """
         EXAMPLE RESPONSES:
-        {{"extracted_info": ["Pineapples are a blend of pinecones and apples.", \
+        {"extracted_info": ["Pineapples are a blend of pinecones and apples.", \
         "Pineapples have the shape of a pinecone."], "answer": "The 'pine-' from \
         pineapples likely come from the fact that pineapples are a hybrid of \
-        pinecones and apples and its pinecone-like shape."}}
-        {{"extracted_info": [], "answer": "FAILED"}}
-
+        pinecones and apples and its pinecone-like shape."}
+        {"extracted_info": [], "answer": "FAILED"}
+        """
+    )
+    RAG_NOTES_PROMPT: ClassVar[str] = textwrap.dedent(
+        """
+        IMPORTANT NOTES ON THE "answer" FIELD:
+        - Answer in the language of the question.
+        - Answer should be concise, to the point, and no longer than 80 words.
+        - Do not include any information that is not present in the REFERENCE TEXT.
+        """
+    )
+    # What changes from one request to the next comes last, after the
+    # instructions, so that LLM runtimes can reuse the instructions' cache
+    RAG_USER_PROMPT: ClassVar[str] = textwrap.dedent(
+        """
         CONVERSATION HISTORY:
         {session_summary}
 
         REFERENCE TEXT:
         {context}
 
-        IMPORTANT NOTES ON THE "answer" FIELD:
-        - Answer in the language of the question.
-        - Answer should be concise, to the point, and no longer than 80 words.
-        - Do not include any information that is not present in the REFERENCE TEXT.
+        QUESTION:
+        {question}
         """
     )
 
@@ -62,60 +73,58 @@ class RAG(BaseModel):
     extracted_info: list[str]
     answer: str
 
-    prompt: ClassVar[str] = RAG_RESPONSE_PROMPT
+    prompt: ClassVar[str] = RAG_RESPONSE_PROMPT + RAG_NOTES_PROMPT
+    user_prompt: ClassVar[str] = RAG_USER_PROMPT
 
 
-class SummarizeConversationHistory:
-    """Summarize a conversation history"""
+class SummarizeAndRefineMessage(BaseModel):
+    """Update a rolling conversation summary with the newest turns and refine the
+    user message using it, in a single call"""
 
-    SUMMARY_PROFILE_PROMPT: str = textwrap.dedent(
+    SUMMARIZE_AND_REFINE_PROMPT: ClassVar[str] = textwrap.dedent(
         """
-        You are an accurate conversation summarizer. \
-        Summarize the previous conversation history provided \
-        in a few short sentences.
-        """
-    )
+        You are an accurate conversation summarizer. You are given the SUMMARY of a
+        conversation so far and the NEW TURNS that happened after it.
 
-    SUMMARY_RESPONSE_PROMPT: str = SUMMARY_PROFILE_PROMPT + textwrap.dedent(
-        """
-        Ensure you keep all context necessary to answer the user question:
+        You are going to write a JSON, whose TypeScript Interface is given below:
 
-        {context}
+        interface Response {
+            session_summary: string;
+            refined_message: string;
+        }
+
+        For "session_summary", update the SUMMARY so that it also covers the NEW
+        TURNS, in a few short sentences. Keep all context necessary to answer
+        follow-up questions, and drop details that are no longer relevant.
+
+        For "refined_message", reframe the user message to make it less ambiguous
+        by replacing pronouns with the actual nouns and adding any missing context
+        from the updated summary. Do not answer the user question, only paraphrase
+        the user message. If it is already unambiguous, return it unchanged.
 
         EXAMPLE RESPONSES:
-        "User has asked about covid cases in the the district of Delhi. The system
-        responded with the total number of cases in Delhi as 5000."
+        {"session_summary": "User has asked about covid cases in the district of \
+        Delhi. The system responded with the total number of cases in Delhi as \
+        5000.", "refined_message": "How many covid cases are there in Mumbai?"}
         """
     )
-
-    prompt: str = SUMMARY_RESPONSE_PROMPT
-
-
-class RefineMessageUsingHistory:
-    """Refine a message using conversation history"""
-
-    REFINE_PROFILE_PROMPT: str = textwrap.dedent(
+    SUMMARIZE_AND_REFINE_USER_PROMPT: ClassVar[str] = textwrap.dedent(
         """
-        Your job is to reframe the user message to make it less ambigious by
-        replacing pronounce with the actual nouns and adding any missing context
-        from CONVERSATION HISTORY.
+        SUMMARY:
+        {session_summary}
 
-        Do not answer the user question, only paraphrase the user message.
+        NEW TURNS:
+        {new_turns}
 
-        For example:
-        "What is it's capital" -> "What is the capital of India"
-        "Who is the leader of that country" -> "Who is the leader of India"
+        USER MESSAGE:
+        {user_message}
         """
     )
 
-    REFINE_RESPONSE_PROMPT: str = REFINE_PROFILE_PROMPT + textwrap.dedent(
-        """
-        Only return the refined message string without any additional
-        information or preamble.
+    model_config = ConfigDict(strict=True)
 
-        CONVERSATION HISTORY:
-        {context}
-        """
-    )
+    session_summary: str
+    refined_message: str
 
-    prompt: str = REFINE_RESPONSE_PROMPT
+    prompt: ClassVar[str] = SUMMARIZE_AND_REFINE_PROMPT
+    user_prompt: ClassVar[str] = SUMMARIZE_AND_REFINE_USER_PROMPT
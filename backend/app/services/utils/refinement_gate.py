@@ -0,0 +1,98 @@
+"""This module decides whether a message needs to be refined using the chat history
+before it is searched for and answered.
+
+Most follow-up messages that depend on the conversation refer back to it ("how
+often should I give it?", "and for adults?"). The gate looks for such references
+with cheap word-level heuristics, so that self-contained messages ("what is the
+dose of ORS for a 2 year old?") skip the LLM call.
+"""
+
+import re
+
+from pydantic import BaseModel
+
+from ...chat.config import N_RECENT_TURNS, REFINEMENT_GATE_MIN_WORDS
+from ...chat.schemas import ChatContext
+
+WORD = re.compile(r"[a-z']+")
+
+# Words that usually refer to something said earlier in the conversation
+REFERENCE_WORDS = {
+    "it",
+    "its",
+    "it's",
+    "they",
+    "them",
+    "their",
+    "theirs",
+    "he",
+    "him",
+    "his",
+    "she",
+    "her",
+    "hers",
+    "this",
+    "that",
+    "these",
+    "those",
+    "there",
+    "then",
+    "same",
+    "such",
+    "above",
+    "previous",
+    "earlier",
+    "former",
+    "latter",
+    "else",
+    "again",
+    "instead",
+    "another",
+    "other",
+    "others",
+}
+
+# Openings of messages that continue the previous one, e.g. "and for adults?"
+CONTINUATION_OPENINGS = (
+    "and",
+    "but",
+    "or",
+    "so",
+    "also",
+    "what about",
+    "how about",
+    "why not",
+    "what if",
+    "what else",
+)
+
+
+class RefinementDecision(BaseModel):
+    """Whether a message is refined using the chat history, and why."""
+
+    refine: bool
+    reason: str
+
+
+def needs_refinement(message: str, chat_context: ChatContext) -> RefinementDecision:
+    """
+    Decide whether a message needs to be refined using the chat history.
+
+    The message is refined if the chat has history and either the message looks
+    like it depends on it, or enough exchanges have happened since the session
+    summary was updated that it should catch up before the backlog grows.
+    """
+    if not chat_context.session_summary and not chat_context.new_turns:
+        return RefinementDecision(refine=False, reason="no_history")
+    if len(chat_context.new_turns) >= 2 * N_RECENT_TURNS:
+        return RefinementDecision(refine=True, reason="summary_backlog")
+
+    text = message.lower().strip()
+    words = WORD.findall(text)
+    if len(words) < REFINEMENT_GATE_MIN_WORDS:
+        return RefinementDecision(refine=True, reason="short")
+    if any(re.match(rf"{opening}\b", text) for opening in CONTINUATION_OPENINGS):
+        return RefinementDecision(refine=True, reason="continuation")
+    if REFERENCE_WORDS.intersection(words):
+        return RefinementDecision(refine=True, reason="reference")
+    return RefinementDecision(refine=False, reason="self_contained")
@@ -0,0 +1,103 @@
+"""This module contains a small executor for a dependency graph of async stages.
+
+Each stage starts as soon as all the stages it depends on have finished, so
+independent stages run concurrently. A stage receives the results of its
+dependencies as keyword arguments named after them.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable
+
+from pydantic import BaseModel
+
+from .tracing import span
+
+
+class StageTiming(BaseModel):
+    """When a stage started (relative to the start of the graph) and how long it
+    took, in seconds."""
+
+    start: float
+    duration: float
+
+
+class StageGraph:
+    """
+    A dependency graph of async stages.
+
+    Example
+    -------
+    >>> graph = StageGraph()
+    >>> graph.add("history", load_history)
+    >>> graph.add("embed", embed_message)
+    >>> graph.add("answer", answer, depends_on=["history", "embed"])
+    >>> results = await graph.run()  # `answer(history=..., embed=...)`
+    """
+
+    def __init__(self) -> None:
+        """Start with no stages."""
+        self._stages: dict[str, tuple[Callable[..., Awaitable[Any]], list[str]]] = {}
+        self.timings: dict[str, StageTiming] = {}
+        # Results of the stages that have finished, also if the graph is cancelled
+        self.results: dict[str, Any] = {}
+
+    @property
+    def stage_names(self) -> list[str]:
+        """Names of the stages, in the order they were added."""
+        return list(self._stages)
+
+    def add(
+        self,
+        name: str,
+        func: Callable[..., Awaitable[Any]],
+        depends_on: list[str] | None = None,
+    ) -> None:
+        """
+        Add a stage. Dependencies must already have been added, which also makes
+        cycles impossible.
+        """
+        if name in self._stages:
+            raise ValueError(f"Stage {name} already exists")
+        depends_on = depends_on or []
+        for dependency in depends_on:
+            if dependency not in self._stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self._stages[name] = (func, depends_on)
+
+    async def run(self) -> dict[str, Any]:
+        """
+        Run all stages and return their results by name. If a stage raises, the
+        stages still running are cancelled and the exception is re-raised.
+        """
+        graph_start = time.perf_counter()
+        tasks: dict[str, asyncio.Task] = {}
+
+        async def run_stage(name: str) -> Any:
+            """Run a stage once its dependencies have finished, and time it."""
+            func, depends_on = self._stages[name]
+            dependency_results = await asyncio.gather(*(tasks[d] for d in depends_on))
+            start = time.perf_counter()
+            try:
+                with span(name):
+                    result = await func(**dict(zip(depends_on, dependency_results)))
+                self.results[name] = result
+                return result
+            finally:
+                self.timings[name] = StageTiming(
+                    start=start - graph_start, duration=time.perf_counter() - start
+                )
+
+        # Stages are in insertion order, so dependencies are created first
+        for name in self._stages:
+            tasks[name] = asyncio.create_task(run_stage(name))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+
+        return {name: task.result() for name, task in tasks.items()}
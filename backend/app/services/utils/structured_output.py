@@ -0,0 +1,187 @@
+"""This module asks LLMs for structured output and reads their JSON tolerantly.
+
+Where the provider supports it, the expected JSON schema, or at least JSON
+output, is passed as the completion's `response_format`, which litellm
+translates for the provider (e.g. Ollama's `format`). Models still produce
+malformed JSON at times, e.g. wrapped in markdown, truncated at the token limit
+or with a trailing comma, so the response is repaired before it is parsed rather
+than asking again. How each model's responses were parsed is counted, to compare
+the models' failure rates.
+"""
+
+import json
+import re
+from functools import lru_cache
+from typing import Literal
+
+import litellm
+from pydantic import BaseModel
+
+from ...config import LLM_STRUCTURED_OUTPUT
+from ...utils import remove_json_markdown
+from .metrics import LLM_RESPONSE_PARSES
+
+# How a response was parsed: as valid JSON, as JSON after repairing it, by
+# extracting a field from broken JSON, as prose, or not at all
+ParseOutcome = Literal["json", "repaired", "extracted", "prose", "failed"]
+
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+
+
+@lru_cache(maxsize=None)
+def structured_output_mode(model: str) -> Literal["json_schema", "json_object", None]:
+    """
+    The kind of `response_format` to request from a model: set by
+    `LLM_STRUCTURED_OUTPUT` or, for "auto", what litellm knows the model supports.
+    """
+    if LLM_STRUCTURED_OUTPUT == "off":
+        return None
+    if LLM_STRUCTURED_OUTPUT == "schema":
+        return "json_schema"
+    if LLM_STRUCTURED_OUTPUT == "json":
+        return "json_object"
+    try:
+        if litellm.supports_response_schema(model=model):
+            return "json_schema"
+    except Exception:
+        pass
+    try:
+        if "response_format" in (
+            litellm.get_supported_openai_params(model=model) or []
+        ):
+            return "json_object"
+    except Exception:
+        pass
+    return None
+
+
+def get_response_format(model: str, response_model: type[BaseModel]) -> dict | None:
+    """The `response_format` completion parameter for a response of
+    `response_model`, or None if the model is not asked for structured output."""
+    mode = structured_output_mode(model)
+    if mode == "json_schema":
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": response_model.__name__,
+                "schema": response_model.model_json_schema(),
+            },
+        }
+    if mode == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
+def parse_json_object(text: str) -> tuple[dict | None, ParseOutcome]:
+    """
+    Parse the JSON object in an LLM response. If it is not valid JSON, it is
+    repaired: text around the object is dropped, trailing commas are removed, and
+    unterminated strings, arrays and objects are closed.
+
+    Returns the object, or None, and whether it was valid JSON ("json"), repaired
+    ("repaired") or could not be parsed ("failed").
+    """
+    try:
+        parsed = json.loads(remove_json_markdown(text))
+        if isinstance(parsed, dict):
+            return parsed, "json"
+    except ValueError:
+        pass
+
+    start = text.find("{")
+    if start == -1:
+        return None, "failed"
+    try:
+        parsed = json.loads(_close_json(text[start:]))
+    except ValueError:
+        return None, "failed"
+    if not isinstance(parsed, dict):
+        return None, "failed"
+    return parsed, "repaired"
+
+
+def _close_json(text: str) -> str:
+    """
+    Cut the text after the first complete JSON value, or close what is still open
+    at its end, and remove trailing commas.
+    """
+    closers: list[str] = []
+    in_string = escaped = False
+    end = len(text)
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]" and closers:
+            closers.pop()
+            if not closers:
+                end = i + 1
+                break
+
+    repaired = text[:end]
+    if in_string:
+        if escaped:
+            repaired = repaired[:-1]
+        repaired += '"'
+    repaired = repaired.rstrip()
+    if repaired.endswith(":"):
+        repaired += " null"
+    repaired = repaired.rstrip(",")
+    repaired += "".join(reversed(closers))
+    return _TRAILING_COMMA.sub(r"\1", repaired)
+
+
+class ModelParseStats(BaseModel):
+    """How the responses of a model were parsed. `parse_failure_rate` is the share
+    that was not valid JSON, `unrecovered_rate` the share that could not be read
+    at all."""
+
+    n_responses: int
+    outcomes: dict[str, int]
+    parse_failure_rate: float
+    unrecovered_rate: float
+
+
+class ParseStats:
+    """Count how the responses of each model were parsed."""
+
+    def __init__(self) -> None:
+        """Start with no responses counted."""
+        self._outcomes: dict[str, dict[str, int]] = {}
+
+    def record(self, model: str, outcome: ParseOutcome) -> None:
+        """Record how a response of `model` was parsed."""
+        outcomes = self._outcomes.setdefault(model, {})
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        LLM_RESPONSE_PARSES.labels(model, outcome).inc()
+
+    def stats(self) -> dict[str, ModelParseStats]:
+        """Get the counts so far, by model."""
+        stats = {}
+        for model, outcomes in self._outcomes.items():
+            n = sum(outcomes.values())
+            stats[model] = ModelParseStats(
+                n_responses=n,
+                outcomes=dict(outcomes),
+                parse_failure_rate=round(1 - outcomes.get("json", 0) / n, 4),
+                unrecovered_rate=round(outcomes.get("failed", 0) / n, 4),
+            )
+        return stats
+
+
+_PARSE_STATS = ParseStats()
+
+
+def get_parse_stats() -> ParseStats:
+    """
+    Return the parse statistics of this process.
+    """
+    return _PARSE_STATS
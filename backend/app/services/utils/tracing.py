@@ -0,0 +1,303 @@
+"""This module traces where the time of each request goes.
+
+Each request has a trace, started by `TracingMiddleware`, and code records spans
+in it with `span`: the chat pipeline's stages, LLM calls, inference, vector
+searches, history reads and database commits. Spans are in-process and cheap,
+so every request is traced. Of these traces, the slowest `TRACE_KEEP_SLOWEST` of
+each hour are kept and, once the hour is over, handed to the trace exporter.
+
+Requests with the `TRACE_DEBUG_HEADER` header get their spans back in a
+`Server-Timing` header and, from the chat endpoints, as a timing waterfall.
+"""
+
+import heapq
+import itertools
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Iterator
+
+from pydantic import BaseModel, Field, PrivateAttr
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from ...config import (
+    TRACE_DEBUG_HEADER,
+    TRACE_EXPORTER,
+    TRACE_FILE,
+    TRACE_KEEP_SLOWEST,
+)
+from ...utils import setup_logger
+
+logger = setup_logger()
+
+
+class Span(BaseModel):
+    """A timed operation, with its start relative to the start of the trace and
+    its depth in the nesting of spans, both in seconds."""
+
+    name: str
+    start: float
+    duration: float
+    depth: int
+    attributes: dict[str, Any] = Field(default_factory=dict)
+
+
+class Trace(BaseModel):
+    """The spans of a request."""
+
+    trace_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    name: str
+    started_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    total_seconds: float | None = None
+    spans: list[Span] = Field(default_factory=list)
+    _start: float = PrivateAttr(default_factory=time.perf_counter)
+
+    def elapsed(self) -> float:
+        """Seconds since the trace started."""
+        return time.perf_counter() - self._start
+
+    def finish(self) -> None:
+        """Record the total time of the request."""
+        self.total_seconds = round(self.elapsed(), 6)
+
+    def waterfall(self) -> list[str]:
+        """
+        The spans as lines of a compact waterfall, in order of start: the start
+        and duration in milliseconds, then the name, indented by depth, and the
+        attributes.
+        """
+        total = self.total_seconds if self.total_seconds is not None else self.elapsed()
+        lines = [f"{0:8.1f} {total * 1000:8.1f}  total"]
+        for s in sorted(self.spans, key=lambda s: s.start):
+            attributes = " ".join(f"{k}={v}" for k, v in s.attributes.items())
+            lines.append(
+                f"{s.start * 1000:8.1f} {s.duration * 1000:8.1f}  "
+                f"{'  ' * s.depth}{s.name} {attributes}".rstrip()
+            )
+        return lines
+
+    def server_timing(self) -> str:
+        """The spans as the value of a `Server-Timing` header, with the start of
+        each as its description."""
+        total = self.total_seconds if self.total_seconds is not None else self.elapsed()
+        entries = [f"total;dur={total * 1000:.1f}"]
+        for s in sorted(self.spans, key=lambda s: s.start):
+            entries.append(
+                f'{s.name};dur={s.duration * 1000:.1f};desc="+{s.start * 1000:.1f}ms"'
+            )
+        return ", ".join(entries)
+
+
+# The trace of the current request, and the depth of the current span in it
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+_depth: ContextVar[int] = ContextVar("trace_depth", default=0)
+
+
+def start_trace(name: str) -> Trace:
+    """
+    Start the trace of the current request, and return it. Tasks started
+    afterwards, e.g. by a `StageGraph`, record their spans in it too.
+    """
+    trace = Trace(name=name)
+    _trace.set(trace)
+    _depth.set(0)
+    return trace
+
+
+def get_trace() -> Trace | None:
+    """Get the trace of the current request, if it is traced."""
+    return _trace.get()
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[dict[str, Any]]:
+    """
+    Record the time the block takes as a span of the current trace, if there is
+    one. Yields the span's attributes, to add to them in the block.
+
+    Example
+    -------
+    >>> with span("llm", stage="answer") as attributes:
+    ...     response = await acompletion(...)
+    ...     attributes["model"] = response.model
+    """
+    trace = _trace.get()
+    if trace is None:
+        yield attributes
+        return
+
+    depth = _depth.get()
+    token = _depth.set(depth + 1)
+    start = trace.elapsed()
+    try:
+        yield attributes
+    finally:
+        end = trace.elapsed()
+        try:
+            _depth.reset(token)
+        except ValueError:
+            # An async generator closed in another context, e.g. when collected
+            pass
+        trace.spans.append(
+            Span(
+                name=name,
+                start=round(start, 6),
+                duration=round(end - start, 6),
+                depth=depth,
+                attributes=attributes,
+            )
+        )
+
+
+class TraceExporter:
+    """Send kept traces elsewhere. This one drops them ("off")."""
+
+    def export(self, traces: list[Trace]) -> None:
+        """Export the kept traces of an hour."""
+
+
+class InMemoryTraceExporter(TraceExporter):
+    """Keep exported traces in memory, e.g. for tests."""
+
+    def __init__(self) -> None:
+        """Start with no traces."""
+        self.traces: list[Trace] = []
+
+    def export(self, traces: list[Trace]) -> None:
+        """Add the traces to `traces`."""
+        self.traces.extend(traces)
+
+
+class FileTraceExporter(TraceExporter):
+    """Append exported traces to a file, one JSON object per line."""
+
+    def __init__(self, path: str) -> None:
+        """Export to the file at `path`, created on first export."""
+        self.path = path
+
+    def export(self, traces: list[Trace]) -> None:
+        """Append the traces to the file."""
+        try:
+            with open(self.path, "a") as f:
+                for trace in traces:
+                    f.write(trace.model_dump_json() + "\n")
+        except OSError as e:
+            logger.error(f"Failed to export {len(traces)} traces: {e!r}")
+
+
+class SlowestTraces:
+    """
+    Keep the `n` slowest traces of each hour. When the first trace of a new hour
+    arrives, or on `flush`, the kept traces are exported, slowest first.
+    """
+
+    def __init__(self, n: int, exporter: TraceExporter) -> None:
+        """Start with no traces kept, exporting to `exporter`."""
+        self.n = n
+        self.exporter = exporter
+        self._hour: int | None = None
+        # Min-heap of (total seconds, sequence, trace) of the current hour
+        self._kept: list[tuple[float, int, Trace]] = []
+        self._previous: list[Trace] = []
+        self._sequence = itertools.count()
+
+    def offer(self, trace: Trace) -> None:
+        """Keep a finished trace if it is one of the slowest of its hour."""
+        if self.n <= 0 or trace.total_seconds is None:
+            return
+        hour = int(trace.started_at.timestamp() // 3600)
+        if hour != self._hour:
+            self.flush()
+            self._hour = hour
+        entry = (trace.total_seconds, next(self._sequence), trace)
+        if len(self._kept) < self.n:
+            heapq.heappush(self._kept, entry)
+        elif entry[0] > self._kept[0][0]:
+            heapq.heapreplace(self._kept, entry)
+
+    def flush(self) -> None:
+        """Export the traces kept for the current hour and start afresh."""
+        if not self._kept:
+            return
+        self._previous = self._slowest_first(self._kept)
+        self._kept = []
+        self.exporter.export(self._previous)
+
+    def traces(self) -> list[Trace]:
+        """The traces kept for the current hour, then those of the previous one
+        exported, each slowest first."""
+        return self._slowest_first(self._kept) + self._previous
+
+    @staticmethod
+    def _slowest_first(kept: list[tuple[float, int, Trace]]) -> list[Trace]:
+        """The traces of heap entries, slowest first."""
+        return [trace for _, _, trace in sorted(kept, reverse=True)]
+
+
+_SLOWEST_TRACES: SlowestTraces | None = None
+
+
+def get_slowest_traces() -> SlowestTraces:
+    """
+    Return the slowest traces of this process, exported as configured by
+    `TRACE_EXPORTER`: "file", "memory" or "off".
+    """
+    global _SLOWEST_TRACES
+    if _SLOWEST_TRACES is None:
+        exporter: TraceExporter
+        if TRACE_EXPORTER == "file":
+            exporter = FileTraceExporter(TRACE_FILE)
+        elif TRACE_EXPORTER == "memory":
+            exporter = InMemoryTraceExporter()
+        else:
+            exporter = TraceExporter()
+        _SLOWEST_TRACES = SlowestTraces(TRACE_KEEP_SLOWEST, exporter)
+    return _SLOWEST_TRACES
+
+
+def wants_trace(headers: Headers) -> bool:
+    """Whether a request's headers ask for its timing waterfall."""
+    return headers.get(TRACE_DEBUG_HEADER, "").lower() in ("1", "true", "yes")
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware tracing each HTTP request. The trace is offered to the
+    slowest traces once the response has been sent; with the debug header, the
+    spans recorded until the response starts are returned in `Server-Timing`.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        """Wrap `app`."""
+        self.app = app
+
+    async def __call__(
+        self,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+    ) -> None:
+        """Trace an HTTP request, and offer the trace once it has been answered."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = start_trace(f"{scope['method']} {scope['path']}")
+        debug = wants_trace(Headers(scope=scope))
+
+        async def send_with_timing(message: Message) -> None:
+            """Add `Server-Timing` to a debug response, then send the message."""
+            if debug and message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", trace.server_timing().encode()))
+                message["headers"] = headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            trace.finish()
+            get_slowest_traces().offer(trace)
@@ -0,0 +1,180 @@
+"""
+Benchmark chat history queries on a large chat table.
+
+Seeds the chat tables with synthetic chats (optionally), then times reading the
+history of random chats with:
+
+- `two_queries`: the previous approach, one query per table and a merge in Python;
+- `union_all`: the single `UNION ALL` query of `ChatService.get_chat_history`;
+- `union_all_page`: the same query for one page of `--page-size` messages.
+
+With `--without-indexes`, each query is also timed with the `(chat_id,
+created_datetime_utc)` indexes dropped inside a transaction that is rolled back.
+Dropping an index locks its table, so only use it on a benchmark database. The
+query plan of each variant is printed for the first chat.
+
+Usage (from the `backend` directory, against a migrated database):
+
+    python -m scripts.benchmark_chat_history --seed-requests 10000000 \
+        --n-chats 1000000
+    python -m scripts.benchmark_chat_history --without-indexes --repeats 20
+"""
+
+import argparse
+import random
+import statistics
+import time
+from typing import Callable
+
+from app.chat.models import ChatRequestDB, ChatResponseDB
+from app.database import get_sqlalchemy_engine
+from app.services.ChatService import _chat_history_query
+from sqlalchemy import Connection, Row, Select, text
+from sqlalchemy.future import select
+
+CHAT_ID_PREFIX = "benchmark-"
+INDEXES = [
+    "chat_requests_chat_id_created_datetime_utc_idx",
+    "chat_responses_chat_id_created_datetime_utc_idx",
+]
+
+
+def seed(connection: Connection, n_requests: int, n_chats: int) -> None:
+    """Insert `n_requests` requests spread over `n_chats` chats, each with a
+    response, i.e. `2 * n_requests` messages."""
+    start = time.perf_counter()
+    connection.execute(
+        text(
+            """
+            INSERT INTO chat_requests (chat_id, created_datetime_utc, user_id, message)
+            SELECT :prefix || (i % :n_chats),
+                   timestamp '2024-01-01' + i * interval '1 second',
+                   1,
+                   md5(i::text)
+            FROM generate_series(1, :n_requests) AS i
+            """
+        ),
+        {"prefix": CHAT_ID_PREFIX, "n_chats": n_chats, "n_requests": n_requests},
+    )
+    connection.execute(
+        text(
+            """
+            INSERT INTO chat_responses
+                (request_id, created_datetime_utc, response, response_metadata, chat_id)
+            SELECT request_id, created_datetime_utc + interval '500 milliseconds',
+                   md5(message), '{}'::json, chat_id
+            FROM chat_requests
+            WHERE chat_id LIKE :prefix || '%'
+            """
+        ),
+        {"prefix": CHAT_ID_PREFIX},
+    )
+    connection.execute(text("ANALYZE chat_requests, chat_responses"))
+    connection.commit()
+    print(
+        f"Seeded {2 * n_requests:,} messages in {n_chats:,} chats "
+        f"in {time.perf_counter() - start:.0f}s"
+    )
+
+
+def two_queries(chat_id: str) -> list[Select]:
+    """The queries of the previous `get_chat_history`."""
+    return [
+        select(ChatRequestDB)
+        .where(ChatRequestDB.chat_id == chat_id)
+        .order_by(ChatRequestDB.created_datetime_utc),
+        select(ChatResponseDB)
+        .join(ChatRequestDB)
+        .where(ChatRequestDB.chat_id == chat_id)
+        .order_by(ChatResponseDB.created_datetime_utc),
+    ]
+
+
+def run(connection: Connection, statements: list[Select], explain: bool) -> float:
+    """Run the statements and return the time taken in ms. Print their plans if
+    `explain` is set."""
+    start = time.perf_counter()
+    rows: list[Row] = []
+    for statement in statements:
+        rows.extend(connection.execute(statement).all())
+    if len(statements) > 1:
+        # The previous approach merged the two results in Python
+        rows.sort(key=lambda row: row.created_datetime_utc)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    if explain:
+        for statement in statements:
+            compiled = statement.compile(dialect=connection.dialect)
+            plan = connection.exec_driver_sql(
+                f"EXPLAIN (ANALYZE, BUFFERS) {compiled}", compiled.params
+            ).all()
+            print("\n".join(line for (line,) in plan), end="\n\n")
+    return elapsed
+
+
+def benchmark(
+    connection: Connection,
+    chat_ids: list[str],
+    variants: dict[str, Callable[[str], list[Select]]],
+    label: str,
+) -> None:
+    """Time each variant on each chat and print the plans for the first chat."""
+    for name, build in variants.items():
+        print(f"--- {name} ({label}) ---")
+        timings = [
+            run(connection, build(chat_id), explain=i == 0)
+            for i, chat_id in enumerate(chat_ids)
+        ]
+        print(
+            f"{name} ({label}): median {statistics.median(timings):.2f} ms, "
+            f"max {max(timings):.2f} ms over {len(timings)} chats\n"
+        )
+
+
+def main() -> None:
+    """Seed the tables if asked, then run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seed-requests", type=int, default=0)
+    parser.add_argument("--n-chats", type=int, default=100_000)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--without-indexes", action="store_true")
+    args = parser.parse_args()
+
+    engine = get_sqlalchemy_engine()
+    with engine.connect() as connection:
+        if args.seed_requests:
+            seed(connection, args.seed_requests, args.n_chats)
+
+        n_messages = connection.execute(
+            text(
+                "SELECT (SELECT count(*) FROM chat_requests)"
+                " + (SELECT count(*) FROM chat_responses)"
+            )
+        ).scalar_one()
+        print(f"{n_messages:,} messages in the chat tables\n")
+
+        chat_ids = [
+            f"{CHAT_ID_PREFIX}{random.randrange(args.n_chats)}"
+            for _ in range(args.repeats)
+        ]
+        variants = {
+            "two_queries": two_queries,
+            "union_all": lambda chat_id: [_chat_history_query(chat_id, None, None)],
+            "union_all_page": lambda chat_id: [
+                _chat_history_query(chat_id, None, args.page_size)
+            ],
+        }
+
+        benchmark(connection, chat_ids, variants, "with indexes")
+        connection.rollback()
+
+        if args.without_indexes:
+            for index in INDEXES:
+                connection.execute(text(f"DROP INDEX IF EXISTS {index}"))
+            benchmark(connection, chat_ids, variants, "without indexes")
+            connection.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark chunking strategies on a local corpus.
+
+For each strategy, every file in the corpus is parsed and embedded, and the
+questions are answered by cosine similarity over the resulting chunks (in memory,
+no database required). The benchmark reports the number of chunks, token
+statistics, embedding time and the retrieval hit rate at `k`.
+
+The questions file is a JSON Lines file with one object per line:
+
+    {"question": "...", "file_name": "guide.pdf", "answer": "optional substring"}
+
+A question is a hit if one of the top `k` chunks comes from `file_name` and, when
+`answer` is given, contains it (case-insensitive).
+
+Usage (from the `backend` directory):
+
+    python -m scripts.benchmark_chunking --corpus-dir data/ --questions q.jsonl \
+        --max-tokens 256 512 --overlap-tokens 0 64
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+from app.services.utils.embeddings import get_embedding_model
+from app.services.utils.parse_file import parse_file
+
+
+async def chunk_corpus(
+    files: list[Path], strategy: str, max_tokens: int, overlap_tokens: int
+) -> tuple[list[str], list[str], list[int]]:
+    """Parse all files and return chunk texts, their file names and token counts."""
+    texts: list[str] = []
+    file_names: list[str] = []
+    n_tokens: list[int] = []
+    for path in files:
+        chunks = await parse_file(
+            path.read_bytes(),
+            strategy=strategy,
+            max_tokens=max_tokens,
+            overlap_tokens=overlap_tokens,
+        )
+        texts.extend(chunk.text for chunk in chunks)
+        file_names.extend(path.name for _ in chunks)
+        n_tokens.extend(chunk.n_tokens for chunk in chunks)
+    return texts, file_names, n_tokens
+
+
+def hit_rate(
+    questions: list[dict],
+    chunk_embeddings: np.ndarray,
+    texts: list[str],
+    file_names: list[str],
+    top_k: int,
+) -> float:
+    """Return the share of questions with a relevant chunk in the top `k`."""
+    embed_model = get_embedding_model()
+    query_embeddings = embed_model.encode(
+        [q["question"] for q in questions], normalize_embeddings=True
+    )
+    scores = query_embeddings @ chunk_embeddings.T
+
+    n_hits = 0
+    for question, question_scores in zip(questions, scores):
+        top_indices = np.argsort(-question_scores)[:top_k]
+        answer = question.get("answer", "").lower()
+        n_hits += any(
+            file_names[i] == question["file_name"] and answer in texts[i].lower()
+            for i in top_indices
+        )
+    return n_hits / len(questions)
+
+
+async def run_benchmark(args: argparse.Namespace) -> None:
+    """Run the benchmark for every configuration and print a results table."""
+    files = sorted(p for p in Path(args.corpus_dir).iterdir() if p.is_file())
+    with open(args.questions) as f:
+        questions = [json.loads(line) for line in f if line.strip()]
+
+    embed_model = get_embedding_model()
+    max_seq_length = embed_model.max_seq_length
+
+    configs = [("page", 0, 0)] + [
+        ("token", max_tokens, overlap)
+        for max_tokens in args.max_tokens
+        for overlap in args.overlap_tokens
+        if overlap < max_tokens
+    ]
+
+    header = (
+        f"{'strategy':<10}{'max_tok':>8}{'overlap':>8}{'chunks':>8}"
+        f"{'mean_tok':>9}{'peak_tok':>9}{'truncated':>10}{'embed_s':>9}"
+        f"{'hit@' + str(args.top_k):>8}"
+    )
+    print(header)
+    print("-" * len(header))
+
+    for strategy, max_tokens, overlap in configs:
+        texts, file_names, n_tokens = await chunk_corpus(
+            files, strategy, max_tokens, overlap
+        )
+
+        start = time.perf_counter()
+        chunk_embeddings = embed_model.encode(
+            texts, batch_size=args.batch_size, normalize_embeddings=True
+        )
+        embed_seconds = time.perf_counter() - start
+
+        n_truncated = sum(n > max_seq_length for n in n_tokens)
+        hits = hit_rate(questions, chunk_embeddings, texts, file_names, args.top_k)
+        print(
+            f"{strategy:<10}{max_tokens or '-':>8}{overlap if max_tokens else '-':>8}"
+            f"{len(texts):>8}{np.mean(n_tokens):>9.1f}{max(n_tokens):>9}"
+            f"{n_truncated:>10}{embed_seconds:>9.2f}"
+            f"{hits:>8.2%}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--corpus-dir", required=True, help="Folder of documents")
+    parser.add_argument("--questions", required=True, help="JSON Lines questions")
+    parser.add_argument("--max-tokens", type=int, nargs="+", default=[256, 512])
+    parser.add_argument("--overlap-tokens", type=int, nargs="+", default=[0, 64])
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=32)
+
+    asyncio.run(run_benchmark(parser.parse_args()))
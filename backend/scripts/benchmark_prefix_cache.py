@@ -0,0 +1,277 @@
+"""
+Benchmark time to first token with and without reuse of the prompt's prefix cache.
+
+Local runtimes such as Ollama keep the KV cache of the last prompt in each slot
+and, for a new prompt, only process the tokens after the longest prefix it shares
+with a cached one. This starts a stand-in for Ollama's `/api/chat` that models
+this: processing a prompt takes `--prefill-ms-per-token` for each token not in a
+slot's cache, and each generated token takes `--decode-ms-per-token`. Tokens are
+words.
+
+The same stream of answer prompts, with a different question, summary and
+context each time, is then sent with:
+
+- `previous_layout`: the summary and context inside the system message, before
+  the final notes, and the question as the user message;
+- `static_first`: the layout of `get_rag_prompt`, i.e. the static instructions
+  as the system message and everything that changes after them;
+- `static_first_no_reuse`: the same, with the stand-in's cache disabled.
+
+For each, it reports the time to first token and the share of prompt tokens
+served from the cache. Against a real Ollama instance, pass `--url` instead; the
+cache share is then only rough, as Ollama's `prompt_eval_count` counts its own
+tokens rather than words.
+
+Usage (from the `backend` directory):
+
+    python -m scripts.benchmark_prefix_cache --n-requests 50
+    python -m scripts.benchmark_prefix_cache --url http://localhost:11434 \
+        --model llama3.2:1b
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import socket
+import statistics
+import threading
+import time
+from typing import AsyncIterator, Callable
+
+import httpx
+import uvicorn
+from app.services.utils.prompts import RAG
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+WORDS = (
+    "child fever dose oral rehydration salts zinc diarrhoea days water clean "
+    "breastfeeding vaccine clinic health worker referral danger signs cough "
+    "breathing malaria test treatment weight age months mother visit"
+).split()
+
+
+class StandInLLM:
+    """A stand-in for Ollama's chat API that models per-slot prefix caching."""
+
+    def __init__(
+        self, prefill_seconds: float, decode_seconds: float, n_slots: int
+    ) -> None:
+        """Start with every slot empty and prefix caching on."""
+        self.prefill_seconds = prefill_seconds
+        self.decode_seconds = decode_seconds
+        self.n_slots = n_slots
+        self.reuse_cache = True
+        self.slots: list[list[str]] = []
+        self._lock = asyncio.Lock()
+
+    def app(self) -> Starlette:
+        """The ASGI app serving `/api/chat`."""
+        return Starlette(routes=[Route("/api/chat", self.chat, methods=["POST"])])
+
+    async def chat(self, request: Request) -> StreamingResponse:
+        """Stream a made-up answer after "processing" the prompt's uncached
+        tokens."""
+        body = await request.json()
+        tokens = " ".join(m["content"] for m in body["messages"]).split()
+        n_output = body.get("options", {}).get("num_predict", 32)
+        return StreamingResponse(
+            self._generate(tokens, n_output), media_type="application/x-ndjson"
+        )
+
+    async def _generate(self, tokens: list[str], n_output: int) -> AsyncIterator[str]:
+        """Yield NDJSON chunks like Ollama's. One request runs at a time."""
+        async with self._lock:
+            n_cached, slot = self._lookup(tokens)
+            await asyncio.sleep((len(tokens) - n_cached) * self.prefill_seconds)
+            self._store(slot, tokens)
+            for i in range(n_output):
+                if i:
+                    await asyncio.sleep(self.decode_seconds)
+                chunk = {"message": {"role": "assistant", "content": "word "}}
+                yield json.dumps({**chunk, "done": False}) + "\n"
+            yield json.dumps(
+                {
+                    "done": True,
+                    "prompt_eval_count": len(tokens) - n_cached,
+                    "eval_count": n_output,
+                }
+            ) + "\n"
+
+    def _lookup(self, tokens: list[str]) -> tuple[int, int]:
+        """Return the longest cached prefix and the slot to use: the one with the
+        longest prefix, or else the least recently used."""
+        best, best_slot = 0, None
+        if self.reuse_cache:
+            for i, cached in enumerate(self.slots):
+                n = _common_prefix(cached, tokens)
+                if n > best:
+                    best, best_slot = n, i
+        if best_slot is None:
+            best_slot = len(self.slots) if len(self.slots) < self.n_slots else 0
+        return best, best_slot
+
+    def _store(self, slot: int, tokens: list[str]) -> None:
+        """Cache a prompt in a slot, moving the slot to most recently used."""
+        if slot < len(self.slots):
+            del self.slots[slot]
+        self.slots.append(tokens)
+
+
+def _common_prefix(a: list[str], b: list[str]) -> int:
+    """Length of the common prefix of two token lists."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def random_text(rng: random.Random, n_words: int) -> str:
+    """Made-up text of `n_words` words."""
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def previous_layout(summary: str, context: str, question: str) -> list[dict]:
+    """The layout before the instructions were moved first."""
+    system = (
+        RAG.RAG_RESPONSE_PROMPT
+        + f"\nCONVERSATION HISTORY:\n{summary}\n\nREFERENCE TEXT:\n{context}\n"
+        + RAG.RAG_NOTES_PROMPT
+    )
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": question},
+    ]
+
+
+def static_first(summary: str, context: str, question: str) -> list[dict]:
+    """The layout of `get_rag_prompt`."""
+    user = RAG.user_prompt.format(
+        session_summary=summary, context=context, question=question
+    )
+    return [
+        {"role": "system", "content": RAG.prompt},
+        {"role": "user", "content": user},
+    ]
+
+
+async def run(
+    url: str,
+    model: str,
+    layout: Callable[[str, str, str], list[dict]],
+    n_requests: int,
+    context_words: int,
+    seed: int,
+) -> dict:
+    """
+    Send `n_requests` prompts one after the other and time the first tokens.
+    Responses without any content have no first token and are left out.
+    """
+    rng = random.Random(seed)
+    ttfts: list[float] = []
+    cached_shares: list[float] = []
+    async with httpx.AsyncClient(base_url=url, timeout=300) as client:
+        for _ in range(n_requests):
+            messages = layout(
+                random_text(rng, 60),
+                random_text(rng, context_words),
+                random_text(rng, 12) + "?",
+            )
+            n_prompt_words = len(" ".join(m["content"] for m in messages).split())
+            start = time.perf_counter()
+            ttft = None
+            body = {
+                "model": model,
+                "messages": messages,
+                "stream": True,
+                "options": {"num_predict": 32},
+            }
+            async with client.stream("POST", "/api/chat", json=body) as response:
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if ttft is None and chunk.get("message", {}).get("content"):
+                        ttft = time.perf_counter() - start
+                    if chunk.get("done"):
+                        n_evaluated = chunk.get("prompt_eval_count", n_prompt_words)
+                        cached_shares.append(1 - n_evaluated / n_prompt_words)
+            if ttft is not None:
+                ttfts.append(ttft)
+
+    if not ttfts:
+        raise RuntimeError(f"None of the {n_requests} responses had any content")
+    ttfts.sort()
+    return {
+        "mean_ttft": round(statistics.mean(ttfts), 4),
+        "p50_ttft": round(ttfts[len(ttfts) // 2], 4),
+        "p95_ttft": round(ttfts[int(0.95 * (len(ttfts) - 1))], 4),
+        "mean_cached_share": round(statistics.mean(cached_shares), 3),
+    }
+
+
+def start_stand_in(stand_in: StandInLLM) -> tuple[uvicorn.Server, str]:
+    """Serve the stand-in on a free local port, in a background thread."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(stand_in.app(), host="127.0.0.1", port=port, log_level="error")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def main() -> None:
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-requests", type=int, default=30)
+    parser.add_argument("--context-words", type=int, default=800)
+    parser.add_argument("--prefill-ms-per-token", type=float, default=1.0)
+    parser.add_argument("--decode-ms-per-token", type=float, default=20.0)
+    parser.add_argument("--slots", type=int, default=1, help="Like OLLAMA_NUM_PARALLEL")
+    parser.add_argument("--url", help="A real Ollama instance to use instead")
+    parser.add_argument("--model", default="llama3.2:1b")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stand_in, server = None, None
+    url = args.url
+    if url is None:
+        stand_in = StandInLLM(
+            args.prefill_ms_per_token / 1000,
+            args.decode_ms_per_token / 1000,
+            args.slots,
+        )
+        server, url = start_stand_in(stand_in)
+
+    runs = {
+        "previous_layout": (previous_layout, True),
+        "static_first": (static_first, True),
+        "static_first_no_reuse": (static_first, False),
+    }
+    results = {}
+    for name, (layout, reuse_cache) in runs.items():
+        if stand_in is not None:
+            stand_in.reuse_cache = reuse_cache
+            stand_in.slots.clear()
+        elif not reuse_cache:
+            continue  # The cache of a real instance cannot be turned off
+        results[name] = asyncio.run(
+            run(url, args.model, layout, args.n_requests, args.context_words, args.seed)
+        )
+
+    if server is not None:
+        server.should_exit = True
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
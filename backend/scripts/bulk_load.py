@@ -0,0 +1,241 @@
+"""
+Bulk-load a corpus of documents into the database without going through the API.
+
+Files are parsed and embedded across a pool of processes (one embedding model per
+process) and written to Postgres in batches with `DocumentService.save_documents`:
+one transaction and one multi-row INSERT per table for up to `--batch-files` files.
+Chunking, near-duplicate detection and the `files` table behave as for uploads.
+
+Progress is checkpointed to a JSON Lines file after each batch is committed. Re-run
+the same command to resume an interrupted load: files already in the checkpoint
+(same path, size and modification time) are skipped.
+
+Usage (from the `backend` directory):
+
+    python -m scripts.bulk_load path/to/corpus/            # a folder, recursively
+    python -m scripts.bulk_load manifest.txt --workers 16  # one path per line
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import IO
+
+from app.database import get_async_session_context_manager
+from app.ingestion.schemas import TextChunk
+from app.services.DocumentService import DocumentService
+from app.services.utils.embeddings import get_embedding_model
+from app.services.utils.parse_file import split_file
+from app.utils import setup_logger
+from numpy import ndarray
+
+logger = setup_logger("bulk_load")
+
+SUPPORTED_SUFFIXES = {".pdf", ".txt", ".md"}
+
+
+def init_worker() -> None:
+    """Load the embedding model once per worker process, using a single thread so
+    that workers do not compete for cores."""
+    import torch
+
+    torch.set_num_threads(1)
+    get_embedding_model()
+
+
+def parse_and_embed(path: str) -> tuple[list[TextChunk], ndarray, int]:
+    """Parse and embed a file in a worker process. Returns the chunks, their
+    embeddings and the size of the file."""
+    from app.config import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNKING_STRATEGY
+
+    content = Path(path).read_bytes()
+    chunks = split_file(
+        content, CHUNKING_STRATEGY, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS
+    )
+    embeddings = get_embedding_model().encode([chunk.text for chunk in chunks])
+    return chunks, embeddings, len(content)
+
+
+def list_files(source: Path) -> list[Path]:
+    """List the files to load from a folder (recursively) or a manifest file."""
+    if source.is_dir():
+        paths = [p for p in sorted(source.rglob("*")) if p.is_file()]
+    else:
+        with open(source) as f:
+            paths = [Path(line.strip()) for line in f if line.strip()]
+    return [p for p in paths if p.suffix.lower() in SUPPORTED_SUFFIXES]
+
+
+def checkpoint_key(path: Path) -> str:
+    """Identify a version of a file by its path, size and modification time."""
+    stat = path.stat()
+    return f"{path.resolve()}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+def load_checkpoint(checkpoint: Path) -> set[str]:
+    """Return the keys of files already loaded, ignoring a last line cut short by
+    a crash."""
+    if not checkpoint.exists():
+        return set()
+    keys = set()
+    with open(checkpoint) as f:
+        for line in f:
+            try:
+                keys.add(json.loads(line)["key"])
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return keys
+
+
+def pending_files(files: list[Path], done: set[str]) -> list[Path]:
+    """Return the files that are not in the checkpoint, in order. A file that
+    changed since it was loaded has a new key, so it is loaded again."""
+    return [p for p in files if checkpoint_key(p) not in done]
+
+
+def record_loaded(
+    checkpoint_file: IO[str], keys_and_file_ids: list[tuple[str, str]]
+) -> None:
+    """Append committed files to the checkpoint."""
+    for key, file_id in keys_and_file_ids:
+        checkpoint_file.write(json.dumps({"key": key, "file_id": file_id}) + "\n")
+    checkpoint_file.flush()
+
+
+async def bulk_load(args: argparse.Namespace) -> None:
+    """Parse and embed files in a process pool and write them in batches as they
+    complete."""
+    checkpoint = Path(args.checkpoint)
+    done = load_checkpoint(checkpoint)
+    files = pending_files(list_files(Path(args.source)), done)
+    logger.warning(
+        f"{len(files)} files to load ({len(done)} already in {checkpoint}) "
+        f"with {args.workers} worker processes"
+    )
+
+    loop = asyncio.get_running_loop()
+    # Parsed files waiting to be written, bounded to limit memory use
+    parsed: asyncio.Queue = asyncio.Queue(maxsize=2 * args.batch_files)
+    start = time.perf_counter()
+    n_files, n_chunks, n_failed = 0, 0, 0
+
+    def report() -> None:
+        """Print the progress and throughput so far."""
+        elapsed = time.perf_counter() - start
+        print(
+            f"{n_files}/{len(files)} files, {n_chunks} chunks in "
+            f"{elapsed:.0f}s: {n_files / elapsed:.2f} files/s, "
+            f"{n_chunks / elapsed:.1f} chunks/s, {n_failed} failed",
+            flush=True,
+        )
+
+    with ProcessPoolExecutor(
+        max_workers=args.workers, initializer=init_worker
+    ) as executor, open(checkpoint, "a") as checkpoint_file:
+        in_flight = asyncio.Semaphore(2 * args.workers)
+
+        async def parse(path: Path) -> None:
+            """Parse and embed a file in a worker process and queue it."""
+            nonlocal n_failed
+            async with in_flight:
+                try:
+                    chunks, embeddings, file_size = await loop.run_in_executor(
+                        executor, parse_and_embed, str(path)
+                    )
+                except Exception as e:
+                    n_failed += 1
+                    logger.error(f"Failed to load {path}: {e}")
+                    return
+                await parsed.put((path, chunks, embeddings, file_size))
+
+        async def write(
+            batch: list[tuple[Path, list[TextChunk], ndarray, int]]
+        ) -> None:
+            """Save a batch of files in one transaction and checkpoint them."""
+            nonlocal n_files, n_chunks, n_failed
+            try:
+                async with get_async_session_context_manager() as session:
+                    responses = await DocumentService.save_documents(
+                        [
+                            (path.name, file_size, list(zip(chunks, embeddings)))
+                            for path, chunks, embeddings, file_size in batch
+                        ],
+                        session,
+                    )
+            except Exception as e:
+                n_failed += len(batch)
+                logger.error(f"Failed to write a batch of {len(batch)} files: {e}")
+                return
+
+            record_loaded(
+                checkpoint_file,
+                [
+                    (checkpoint_key(path), response.file_id)
+                    for (path, *_), response in zip(batch, responses)
+                ],
+            )
+            previous = n_files
+            n_files += len(batch)
+            n_chunks += sum(response.total_chunks for response in responses)
+            if n_files // args.report_every > previous // args.report_every:
+                report()
+
+        async def write_batches() -> None:
+            """Write the parsed files in batches until the queue is closed."""
+            batch: list[tuple[Path, list[TextChunk], ndarray, int]] = []
+            while True:
+                item = await parsed.get()
+                if item is not None:
+                    batch.append(item)
+                # Write when the batch is full, or with what there is rather than
+                # waiting while nothing else is parsed yet
+                if batch and (
+                    item is None or len(batch) >= args.batch_files or parsed.empty()
+                ):
+                    await write(batch)
+                    batch = []
+                if item is None:
+                    return
+
+        writer = asyncio.create_task(write_batches())
+        await asyncio.gather(*(parse(path) for path in files))
+        await parsed.put(None)
+        await writer
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Done: {n_files} files, {n_chunks} chunks, {n_failed} failed in "
+        f"{elapsed:.0f}s ({n_files / max(elapsed, 1e-9):.2f} files/s, "
+        f"{n_chunks / max(elapsed, 1e-9):.1f} chunks/s)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bulk-load documents into the database."
+    )
+    parser.add_argument("source", help="Folder of documents or manifest file")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Processes that parse and embed files (default: number of cores)",
+    )
+    parser.add_argument(
+        "--batch-files",
+        type=int,
+        default=32,
+        help="Most files written in one transaction (default: 32)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=".bulk_load_checkpoint.jsonl",
+        help="File recording loaded files, used to resume",
+    )
+    parser.add_argument("--report-every", type=int, default=10)
+
+    asyncio.run(bulk_load(parser.parse_args()))
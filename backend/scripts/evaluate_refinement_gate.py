@@ -0,0 +1,129 @@
+"""
+Evaluate the refinement gate on logged conversations.
+
+Runs the gate on logged messages that were refined by the LLM, i.e. requests with a
+`message_original`, and reports:
+
+- the skip rate: the share of these messages that the gate would not refine,
+  overall and by reason;
+- the retrieval degradation for the skipped messages: how much the top `k`
+  content retrieved for the original message differs from the top `k` retrieved
+  for the refined one. `overlap_at_k` is the share of the refined message's top
+  `k` that the original message also retrieves.
+
+Only the message is judged: refinements forced because the session summary fell
+behind are not counted. The gate is run as configured by `app.chat.config`.
+
+Usage (from the `backend` directory, against the production database or a copy):
+
+    python -m scripts.evaluate_refinement_gate --limit 1000 --output gate.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+from collections import Counter
+
+from app.chat.config import N_TOP_CONTENT
+from app.chat.models import ChatRequestDB
+from app.chat.schemas import ChatContext
+from app.database import get_async_session_context_manager
+from app.services.DocumentService import DocumentService
+from app.services.utils.embeddings import create_embeddings
+from app.services.utils.refinement_gate import needs_refinement
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+# Context with history and no summary backlog, so that only the message is judged
+CONTEXT_WITH_HISTORY = ChatContext(session_summary="Earlier conversation.")
+
+
+async def retrieved_content(
+    message: str, top_k: int, asession: AsyncSession
+) -> list[int | None]:
+    """Return the ids of the top `k` content retrieved for a message."""
+    embedding = await create_embeddings(message)
+    chunks = await DocumentService.get_similar_n_chunks(embedding, top_k, asession)
+    return [chunk.content_id for chunk in chunks.values()]
+
+
+async def evaluate(limit: int, top_k: int) -> list[dict]:
+    """Run the gate on the newest `limit` refined messages."""
+    results = []
+    async with get_async_session_context_manager() as asession:
+        stmt = (
+            select(ChatRequestDB)
+            .where(ChatRequestDB.message_original.is_not(None))
+            .order_by(ChatRequestDB.request_id.desc())
+            .limit(limit)
+        )
+        chat_requests = (await asession.execute(stmt)).scalars().all()
+
+        for chat_request in chat_requests:
+            decision = needs_refinement(
+                chat_request.message_original, CONTEXT_WITH_HISTORY
+            )
+            result = {
+                "request_id": chat_request.request_id,
+                "message_original": chat_request.message_original,
+                "message": chat_request.message,
+                "refine": decision.refine,
+                "reason": decision.reason,
+            }
+            if not decision.refine:
+                original = await retrieved_content(
+                    chat_request.message_original, top_k, asession
+                )
+                refined = await retrieved_content(chat_request.message, top_k, asession)
+                result["overlap_at_k"] = len(set(original) & set(refined)) / max(
+                    len(refined), 1
+                )
+                result["same_top_1"] = original[:1] == refined[:1]
+            results.append(result)
+    return results
+
+
+def report(results: list[dict], top_k: int) -> dict:
+    """Summarise the skip rate and the retrieval degradation of skipped messages."""
+    skipped = [r for r in results if not r["refine"]]
+    summary = {
+        "n_messages": len(results),
+        "n_skipped": len(skipped),
+        "skip_rate": len(skipped) / len(results) if results else None,
+        "reasons": dict(Counter(r["reason"] for r in results)),
+        "top_k": top_k,
+    }
+    if skipped:
+        summary["mean_overlap_at_k"] = statistics.mean(
+            r["overlap_at_k"] for r in skipped
+        )
+        summary["share_same_top_k"] = sum(
+            r["overlap_at_k"] == 1 for r in skipped
+        ) / len(skipped)
+        summary["share_same_top_1"] = sum(r["same_top_1"] for r in skipped) / len(
+            skipped
+        )
+    return summary
+
+
+def main() -> None:
+    """Evaluate the gate and print the summary."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--top-k", type=int, default=N_TOP_CONTENT)
+    parser.add_argument(
+        "--output", help="JSON Lines file for the decision on each message"
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(evaluate(args.limit, args.top_k))
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+    print(json.dumps(report(results, args.top_k), indent=2))
+
+
+if __name__ == "__main__":
+    main()
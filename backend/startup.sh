@@ -1,5 +1,13 @@
 # #!/bin/bash
 # python -m alembic upgrade head
+
+# Remove the metrics files of previous runs
+if [ -n "${PROMETHEUS_MULTIPROC_DIR}" ]; then
+    mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+    rm -f "${PROMETHEUS_MULTIPROC_DIR}"/counter_*.db \
+        "${PROMETHEUS_MULTIPROC_DIR}"/gauge_*.db \
+        "${PROMETHEUS_MULTIPROC_DIR}"/histogram_*.db
+fi
 # exec gunicorn -k main.Worker -w 4 -b 0.0.0.0:8000 --preload \
 #     -c gunicorn_hooks_config.py main:app
 # #
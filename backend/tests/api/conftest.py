@@ -9,7 +9,7 @@ from app.auth.config import API_SECRET_KEY
 from app.config import PGVECTOR_VECTOR_SIZE
 from app.database import get_connection_url
 from app.ingestion.schemas import DocumentChunk
-from app.services.utils.prompts import RAG
+from app.services.utils.prompts import RAG, SummarizeAndRefineMessage
 from fastapi.testclient import TestClient
 from numpy import ndarray
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
@@ -78,16 +78,18 @@ def patch_llm_call(monkeysession: pytest.MonkeyPatch) -> None:
     )
     monkeysession.setattr(app.chat.routers, "get_llm_response", async_fake_llm_response)
     monkeysession.setattr(
-        app.services.ChatService, "get_session_summary", async_get_session_summary
+        app.chat.routers, "stream_llm_response", async_fake_stream_llm_response
     )
     monkeysession.setattr(
         app.services.ChatService,
-        "get_refined_message",
-        async_get_refined_message,
+        "get_summary_and_refined_message",
+        async_get_summary_and_refined_message,
     )
     monkeysession.setattr(
         app.chat.routers.DocumentService, "rerank_chunks", async_fake_rerank_chunks
     )
+    # Repeated test questions would otherwise be answered from the semantic cache
+    monkeysession.setattr(app.chat.routers, "SEMANTIC_CACHE_ENABLED", "False")
 
 
 async def async_fake_rerank_chunks(
@@ -113,9 +115,18 @@ async def async_fake_llm_response(*args: list, **kwargs: dict) -> RAG:
     )
 
 
-async def async_get_session_summary(*args: list, **kwargs: dict) -> str:
-    return "fake_summary"
+async def async_fake_stream_llm_response(
+    *args: list, **kwargs: dict
+) -> AsyncGenerator[str | RAG, None]:
+    """Fake streamed LLM response that yields the answer in two pieces."""
+    yield "fake_"
+    yield "answer"
+    yield await async_fake_llm_response()
 
 
-async def async_get_refined_message(*args: list, **kwargs: dict) -> str:
-    return "fake_refined_message"
+async def async_get_summary_and_refined_message(
+    *args: list, **kwargs: dict
+) -> SummarizeAndRefineMessage:
+    return SummarizeAndRefineMessage(
+        session_summary="fake_summary", refined_message="fake_refined_message"
+    )
@@ -0,0 +1,63 @@
+import os
+from pathlib import Path
+
+from scripts.bulk_load import (
+    checkpoint_key,
+    list_files,
+    load_checkpoint,
+    pending_files,
+    record_loaded,
+)
+
+
+def write_corpus(folder: Path, n_files: int) -> list[Path]:
+    paths = []
+    for i in range(n_files):
+        path = folder / f"doc_{i}.txt"
+        path.write_text(f"Document number {i}.")
+        paths.append(path)
+    return paths
+
+
+class TestCheckpoint:
+    def test_missing_checkpoint_is_empty(self, tmp_path: Path) -> None:
+        assert load_checkpoint(tmp_path / "checkpoint.jsonl") == set()
+
+    def test_truncated_last_line_is_ignored(self, tmp_path: Path) -> None:
+        checkpoint = tmp_path / "checkpoint.jsonl"
+        checkpoint.write_text('{"key": "a", "file_id": "1"}\n{"key": "b", "fi')
+
+        assert load_checkpoint(checkpoint) == {"a"}
+
+    def test_loaded_files_are_skipped(self, tmp_path: Path) -> None:
+        paths = write_corpus(tmp_path, 2)
+        checkpoint = tmp_path / "checkpoint.jsonl"
+        with open(checkpoint, "a") as f:
+            record_loaded(f, [(checkpoint_key(p), "id") for p in paths])
+
+        assert pending_files(paths, load_checkpoint(checkpoint)) == []
+
+    def test_modified_file_is_loaded_again(self, tmp_path: Path) -> None:
+        (path,) = write_corpus(tmp_path, 1)
+        done = {checkpoint_key(path)}
+
+        path.write_text("Document number 0, edited.")
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+        assert pending_files([path], done) == [path]
+
+    def test_resume_after_partial_run(self, tmp_path: Path) -> None:
+        corpus = tmp_path / "corpus"
+        corpus.mkdir()
+        paths = write_corpus(corpus, 3)
+        checkpoint = tmp_path / "checkpoint.jsonl"
+
+        # The first run committed two files before it stopped
+        files = list_files(corpus)
+        with open(checkpoint, "a") as f:
+            record_loaded(f, [(checkpoint_key(p), "id") for p in files[:2]])
+
+        assert pending_files(list_files(corpus), load_checkpoint(checkpoint)) == [
+            paths[2]
+        ]
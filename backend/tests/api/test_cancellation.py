@@ -0,0 +1,75 @@
+import asyncio
+from typing import cast
+
+import pytest
+from app.services.utils.cancellation import (
+    CancellationTracker,
+    ClientDisconnectedError,
+    run_until_disconnected,
+)
+from fastapi import Request
+
+
+class FakeRequest:
+    """A request whose client disconnects after `disconnect_after` seconds."""
+
+    def __init__(self, disconnect_after: float) -> None:
+        self.disconnect_at = asyncio.get_running_loop().time() + disconnect_after
+
+    async def is_disconnected(self) -> bool:
+        return asyncio.get_running_loop().time() >= self.disconnect_at
+
+
+class TestRunUntilDisconnected:
+    async def test_work_is_cancelled_when_client_disconnects(self) -> None:
+        cancelled = asyncio.Event()
+
+        async def slow_answer() -> str:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+            return "answer"
+
+        with pytest.raises(ClientDisconnectedError):
+            await asyncio.wait_for(
+                run_until_disconnected(
+                    cast(Request, FakeRequest(disconnect_after=0.05)),
+                    slow_answer(),
+                    poll_seconds=0.01,
+                ),
+                timeout=1,
+            )
+        assert cancelled.is_set()
+
+    async def test_result_is_returned_if_client_stays(self) -> None:
+        async def answer() -> str:
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        result = await run_until_disconnected(
+            cast(Request, FakeRequest(disconnect_after=10)), answer(), poll_seconds=0.01
+        )
+
+        assert result == "answer"
+
+
+class TestCancellationTracker:
+    def test_seconds_saved_by_unfinished_stages(self) -> None:
+        tracker = CancellationTracker()
+        tracker.record_completed({"embed": 0.2, "refine": 1.0, "answer": 3.0})
+        tracker.record_completed({"embed": 0.4, "refine": 2.0, "answer": 5.0})
+
+        saved = tracker.record_cancelled(
+            ["embed", "refine", "answer"],
+            finished={"embed"},
+            stage_seconds={"embed": 0.3, "refine": 0.5},
+        )
+
+        # refine had 1.5 - 0.5 left and answer 4.0
+        assert saved == pytest.approx(5.0)
+        stats = tracker.stats()
+        assert stats.n_completed == 2
+        assert stats.n_cancelled == 1
+        assert stats.stage_seconds_saved == pytest.approx(5.0)
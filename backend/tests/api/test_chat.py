@@ -1,12 +1,19 @@
+import asyncio
+import json
+from datetime import datetime
 from typing import AsyncGenerator
+from uuid import uuid4
 
 import pytest
 from app.auth.config import API_SECRET_KEY
 from app.chat.models import (
     ChatRequestDB,
     ChatResponseDB,
+    ChatSummaryDB,
+    SemanticCacheDB,
     save_chat_request,
     save_chat_response,
+    save_chat_summary,
 )
 from app.chat.schemas import (
     ChatResponseBase,
@@ -14,9 +21,15 @@ from app.chat.schemas import (
     ChatUserMessageRefined,
 )
 from app.services.ChatService import ChatService
+from app.services.IdempotencyService import (
+    IdempotencyKeyReusedError,
+    IdempotencyService,
+)
+from app.services.utils.cancellation import ClientDisconnectedError
+from app.services.utils.history_cache import get_history_cache
 from fastapi.testclient import TestClient
-from sqlalchemy import delete
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import delete, update
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
 
 @pytest.fixture
@@ -42,12 +55,15 @@ def headers() -> dict:
 
 
 async def clean_up_chat_history(asession: AsyncSession) -> None:
+    await asession.execute(delete(ChatSummaryDB))
     stmt_child = delete(ChatResponseDB)
     await asession.execute(stmt_child)
     stmt_parent = delete(ChatRequestDB)
     await asession.execute(stmt_parent)
 
     await asession.commit()
+    for chat_id in ("test_session1", "test_session2"):
+        await get_history_cache().delete(chat_id)
 
 
 @pytest.fixture
@@ -137,6 +153,335 @@ class TestSingleTurnChat:
 
         assert response.status_code == 200
 
+    def test_speculative_search_reused_for_unrefined_message(
+        self,
+        client: TestClient,
+        load_pdf: None,
+        headers: dict,
+    ) -> None:
+        message = {"chat_id": str(uuid4()), "user_id": 1, "message": "New question"}
+        response = client.post("/chat", headers=headers, json=message)
+
+        speculation = response.json()["response_metadata"]["speculative_search"]
+        assert speculation["reused"] is True
+        assert speculation["similarity"] == 1.0
+        assert "search_raw" in response.json()["stage_timings"]
+
+    def test_chat_stream(
+        self,
+        client: TestClient,
+        chat_message: ChatUserMessageBase,
+        load_pdf: None,
+        headers: dict,
+    ) -> None:
+        with client.stream(
+            "POST", "/chat/stream", headers=headers, json=chat_message.model_dump()
+        ) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            events = [
+                (event.split("\n")[0].removeprefix("event: "), event.split("data: ")[1])
+                for event in response.read().decode().strip().split("\n\n")
+            ]
+
+        assert [name for name, _ in events] == ["retrieval", "token", "token", "done"]
+        assert "".join(json.loads(data)["text"] for _, data in events[1:3]) == (
+            "fake_answer"
+        )
+        done = json.loads(events[-1][1])
+        assert done["response"] == "fake_answer"
+        assert done["response_id"] > 0
+        assert "time_to_first_token" in done["stage_timings"]
+
+
+class TestUsage:
+    async def test_usage_is_saved_and_aggregated(
+        self,
+        client: TestClient,
+        chat_message: ChatUserMessageBase,
+        load_pdf: None,
+        headers: dict,
+        asession: AsyncSession,
+    ) -> None:
+        response = client.post(
+            "/chat", headers=headers, json=chat_message.model_dump()
+        ).json()
+
+        chat_response = await asession.get(ChatResponseDB, response["response_id"])
+        assert chat_response is not None
+        assert chat_response.total_seconds > 0
+        assert chat_response.embed_seconds is not None
+        assert chat_response.rerank_seconds is not None
+
+        stats = client.get("/monitoring/usage?hours=1", headers=headers).json()
+        assert stats["n_responses"] >= 1
+        assert stats["latency"]["total"]["n"] >= 1
+        assert stats["latency"]["total"]["p99"] >= stats["latency"]["total"]["p50"]
+
+
+class TestSemanticCache:
+    @pytest.fixture
+    async def semantic_cache(
+        self, monkeypatch: pytest.MonkeyPatch, asession: AsyncSession
+    ) -> AsyncGenerator[None, None]:
+        monkeypatch.setattr("app.chat.routers.SEMANTIC_CACHE_ENABLED", "True")
+        await asession.execute(delete(SemanticCacheDB))
+        await asession.commit()
+        yield
+        await asession.execute(delete(SemanticCacheDB))
+        await asession.commit()
+
+    def test_repeated_question_is_answered_from_cache(
+        self,
+        client: TestClient,
+        load_pdf: None,
+        headers: dict,
+        semantic_cache: None,
+    ) -> None:
+        message = {"user_id": 1, "message": "What is the capital of Malawi?"}
+        first = client.post("/chat", headers=headers, json=message)
+        second = client.post("/chat", headers=headers, json=message)
+
+        assert "semantic_cache" not in first.json()["response_metadata"]
+        assert second.json()["response_metadata"]["semantic_cache"]["hit"] is True
+        assert second.json()["response"] == first.json()["response"]
+
+    def test_answer_with_summary_is_not_cached(
+        self,
+        client: TestClient,
+        load_pdf: None,
+        headers: dict,
+        semantic_cache: None,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        monkeypatch.setattr("app.services.ChatService.REFINEMENT_GATE_ENABLED", "False")
+        follow_ups = []
+        for chat_id in [str(uuid4()), str(uuid4())]:
+            for message in ["What is the capital of Malawi?", "And its population?"]:
+                response = client.post(
+                    "/chat",
+                    headers=headers,
+                    json={"user_id": 1, "chat_id": chat_id, "message": message},
+                )
+            follow_ups.append(response.json()["response_metadata"])
+
+        # Both follow-ups are refined to the same message, but with the summary
+        # of a different chat
+        assert all(metadata["refinement"]["refined"] for metadata in follow_ups)
+        assert "semantic_cache" not in follow_ups[1]
+
+    def test_refined_follow_up_can_hit_the_cache(
+        self,
+        client: TestClient,
+        load_pdf: None,
+        headers: dict,
+        semantic_cache: None,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        monkeypatch.setattr("app.services.ChatService.REFINEMENT_GATE_ENABLED", "False")
+        first = client.post(
+            "/chat",
+            headers=headers,
+            json={"user_id": 1, "message": "What is the population of Malawi?"},
+        )
+        chat_id = str(uuid4())
+        for message in ["What is the capital of Malawi?", "And its population?"]:
+            follow_up = client.post(
+                "/chat",
+                headers=headers,
+                json={"user_id": 1, "chat_id": chat_id, "message": message},
+            )
+
+        metadata = follow_up.json()["response_metadata"]
+        assert metadata["refinement"]["refined"]
+        assert metadata["semantic_cache"]["hit"] is True
+        assert follow_up.json()["response"] == first.json()["response"]
+
+
+class TestIdempotency:
+    def test_same_key_returns_same_response(
+        self,
+        client: TestClient,
+        load_pdf: None,
+        headers: dict,
+    ) -> None:
+        message = {"user_id": 1, "message": "What is the capital of Malawi?"}
+        headers = {**headers, "Idempotency-Key": str(uuid4())}
+        first = client.post("/chat", headers=headers, json=message)
+        second = client.post("/chat", headers=headers, json=message)
+
+        assert first.status_code == second.status_code == 200
+        assert second.json()["response_id"] == first.json()["response_id"]
+
+    def test_key_reused_for_another_message_is_rejected(
+        self,
+        client: TestClient,
+        load_pdf: None,
+        headers: dict,
+    ) -> None:
+        headers = {**headers, "Idempotency-Key": str(uuid4())}
+        first = client.post(
+            "/chat",
+            headers=headers,
+            json={"user_id": 1, "message": "What is the capital of Malawi?"},
+        )
+        second = client.post(
+            "/chat",
+            headers=headers,
+            json={"user_id": 1, "message": "What is the population of Malawi?"},
+        )
+
+        assert first.status_code == 200
+        assert second.status_code == 422
+
+    async def test_key_reused_while_first_request_runs_is_rejected(
+        self, monkeypatch: pytest.MonkeyPatch, async_engine: AsyncEngine
+    ) -> None:
+        monkeypatch.setattr(
+            "app.services.IdempotencyService.get_async_session_context_manager",
+            lambda: AsyncSession(async_engine, expire_on_commit=False),
+        )
+
+        async def slow_chat() -> ChatResponseBase:
+            await asyncio.sleep(0.2)
+            return ChatResponseBase(response="answer", request_id=1, chat_id="chat")
+
+        key = f"test:{uuid4()}"
+        first = asyncio.create_task(
+            IdempotencyService.run_once(key, 60, "a", slow_chat)
+        )
+        await asyncio.sleep(0.05)
+
+        with pytest.raises(IdempotencyKeyReusedError):
+            await IdempotencyService.run_once(key, 60, "b", slow_chat)
+        assert (await first)["response"] == "answer"
+
+    async def test_concurrent_duplicates_run_once(
+        self, monkeypatch: pytest.MonkeyPatch, async_engine: AsyncEngine
+    ) -> None:
+        # Use the test's engine, which is bound to the test's event loop
+        monkeypatch.setattr(
+            "app.services.IdempotencyService.get_async_session_context_manager",
+            lambda: AsyncSession(async_engine, expire_on_commit=False),
+        )
+        n_calls = 0
+
+        async def slow_chat() -> ChatResponseBase:
+            nonlocal n_calls
+            n_calls += 1
+            await asyncio.sleep(0.2)
+            return ChatResponseBase(response="answer", request_id=1, chat_id="chat")
+
+        key = f"test:{uuid4()}"
+        results = await asyncio.gather(
+            *(IdempotencyService.run_once(key, 60, None, slow_chat) for _ in range(3))
+        )
+
+        assert n_calls == 1
+        assert all(result["response"] == "answer" for result in results)
+
+    def test_same_message_without_key_is_answered_again(
+        self,
+        client: TestClient,
+        load_pdf: None,
+        headers: dict,
+    ) -> None:
+        message = {"user_id": 1, "message": "What is the capital of Malawi?"}
+        first = client.post("/chat", headers=headers, json=message)
+        second = client.post("/chat", headers=headers, json=message)
+
+        assert second.json()["response_id"] != first.json()["response_id"]
+
+    async def test_duplicate_runs_cancelled_request(
+        self, monkeypatch: pytest.MonkeyPatch, async_engine: AsyncEngine
+    ) -> None:
+        monkeypatch.setattr(
+            "app.services.IdempotencyService.get_async_session_context_manager",
+            lambda: AsyncSession(async_engine, expire_on_commit=False),
+        )
+        n_calls = 0
+
+        async def slow_chat() -> ChatResponseBase:
+            nonlocal n_calls
+            n_calls += 1
+            await asyncio.sleep(0.2)
+            return ChatResponseBase(response="answer", request_id=1, chat_id="chat")
+
+        key = f"test:{uuid4()}"
+        first = asyncio.create_task(
+            IdempotencyService.run_once(key, 60, None, slow_chat)
+        )
+        await asyncio.sleep(0.1)
+        duplicate = asyncio.create_task(
+            IdempotencyService.run_once(key, 60, None, slow_chat)
+        )
+        await asyncio.sleep(0)
+        first.cancel()
+
+        assert (await duplicate)["response"] == "answer"
+        assert first.cancelled()
+        assert n_calls == 2
+
+    async def test_duplicate_runs_request_whose_client_disconnected(
+        self, monkeypatch: pytest.MonkeyPatch, async_engine: AsyncEngine
+    ) -> None:
+        monkeypatch.setattr(
+            "app.services.IdempotencyService.get_async_session_context_manager",
+            lambda: AsyncSession(async_engine, expire_on_commit=False),
+        )
+        n_calls = 0
+
+        async def chat_until_disconnected() -> ChatResponseBase:
+            nonlocal n_calls
+            n_calls += 1
+            await asyncio.sleep(0.2)
+            if n_calls == 1:
+                raise ClientDisconnectedError("Client disconnected")
+            return ChatResponseBase(response="answer", request_id=1, chat_id="chat")
+
+        key = f"test:{uuid4()}"
+        first = asyncio.create_task(
+            IdempotencyService.run_once(key, 60, None, chat_until_disconnected)
+        )
+        await asyncio.sleep(0.1)
+        duplicate = IdempotencyService.run_once(key, 60, None, chat_until_disconnected)
+
+        assert (await duplicate)["response"] == "answer"
+        with pytest.raises(ClientDisconnectedError):
+            await first
+        assert n_calls == 2
+
+    async def test_slow_request_keeps_its_claim(
+        self, monkeypatch: pytest.MonkeyPatch, async_engine: AsyncEngine
+    ) -> None:
+        monkeypatch.setattr(
+            "app.services.IdempotencyService.get_async_session_context_manager",
+            lambda: AsyncSession(async_engine, expire_on_commit=False),
+        )
+        monkeypatch.setattr(
+            "app.services.IdempotencyService.IDEMPOTENCY_LEASE_SECONDS", 1
+        )
+        n_calls = 0
+
+        async def slow_chat() -> ChatResponseBase:
+            nonlocal n_calls
+            n_calls += 1
+            await asyncio.sleep(2)
+            return ChatResponseBase(response="answer", request_id=1, chat_id="chat")
+
+        key = f"test:{uuid4()}"
+        first = asyncio.create_task(
+            IdempotencyService.run_once(key, 60, None, slow_chat)
+        )
+        await asyncio.sleep(1.5)
+        # A duplicate in another worker, after the first lease would have expired
+        result = await IdempotencyService._run_once_across_workers(
+            key, 60, None, slow_chat
+        )
+
+        assert (await first)["response"] == result["response"] == "answer"
+        assert n_calls == 1
+
 
 class TestRetrieveChat:
     def test_retrieve_nonexistent_chat_id(
@@ -160,6 +505,75 @@ class TestRetrieveChat:
         assert response.status_code == 200
         assert len(response.json()) == 10
 
+    def test_chat_history_pages(
+        self,
+        client: TestClient,
+        chat_history: None,
+        headers: dict,
+    ) -> None:
+        full = client.get("/chat/test_session1", headers=headers).json()
+
+        newest = client.get("/chat/test_session1?limit=4", headers=headers).json()
+        previous = client.get(
+            "/chat/test_session1",
+            params={"limit": 4, "before": newest[0]["created_datetime_utc"]},
+            headers=headers,
+        ).json()
+
+        assert previous + newest == full[-8:]
+        assert "response_id" not in newest[0] and "response_id" in newest[1]
+
+    async def test_chat_history_pages_split_messages_created_together(
+        self,
+        client: TestClient,
+        chat_history: None,
+        headers: dict,
+        asession: AsyncSession,
+    ) -> None:
+        created = datetime(2026, 10, 19, 9)
+        for table in (ChatRequestDB, ChatResponseDB):
+            await asession.execute(
+                update(table)
+                .where(table.chat_id == "test_session1")
+                .values(created_datetime_utc=created)
+            )
+        await asession.commit()
+        await get_history_cache().delete("test_session1")
+
+        full = client.get("/chat/test_session1", headers=headers).json()
+        pages: list = []
+        params: dict = {"limit": 3}
+        while page := client.get(
+            "/chat/test_session1", params=params, headers=headers
+        ).json():
+            pages = page + pages
+            params = {
+                "limit": 3,
+                "before": page[0]["created_datetime_utc"],
+                "before_kind": "response" if "response_id" in page[0] else "request",
+                "before_request_id": page[0]["request_id"],
+            }
+
+        assert len(full) == 10
+        assert pages == full
+
+    async def test_chat_history_from_cache_matches_database(
+        self,
+        chat_history: None,
+        asession: AsyncSession,
+    ) -> None:
+        from_database = await ChatService.get_chat_history(
+            "test_session1", asession, limit=3
+        )
+        # A full read caches the history
+        await ChatService.get_chat_history("test_session1", asession)
+        assert await get_history_cache().get("test_session1") is not None
+
+        from_cache = await ChatService.get_chat_history(
+            "test_session1", asession, limit=3
+        )
+        assert from_cache == from_database
+
 
 class TestMultiturnChat:
     @pytest.mark.parametrize(
@@ -188,3 +602,39 @@ class TestMultiturnChat:
             assert new_message.message_original is None
             assert new_message.message == original_message
             assert new_message.session_summary is None
+
+    async def test_context_includes_all_unsummarized_turns(
+        self,
+        chat_history: None,
+        asession: AsyncSession,
+    ) -> None:
+        context = await ChatService.get_chat_context("test_session1", asession)
+
+        assert context.session_summary is None
+        assert len(context.new_turns) == 2 * 5
+        assert [m.request_id for m in context.new_turns] == sorted(
+            m.request_id for m in context.new_turns
+        )
+
+    async def test_context_excludes_summarized_turns(
+        self,
+        chat_history: None,
+        asession: AsyncSession,
+    ) -> None:
+        context = await ChatService.get_chat_context("test_session1", asession)
+        newest_request_id = context.new_turns[-1].request_id
+        await save_chat_summary(
+            "test_session1", "old summary", newest_request_id - 1, asession
+        )
+        await save_chat_summary(
+            "test_session1", "new summary", newest_request_id, asession
+        )
+        # An older summary does not replace a newer one
+        await save_chat_summary(
+            "test_session1", "stale summary", newest_request_id - 1, asession
+        )
+
+        context = await ChatService.get_chat_context("test_session1", asession)
+
+        assert context.session_summary == "new summary"
+        assert context.new_turns == []
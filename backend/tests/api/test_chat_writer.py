@@ -0,0 +1,183 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncContextManager, AsyncIterator, Callable
+
+import pytest
+from app.chat.models import ChatRequestDB, ChatResponseDB
+from app.services.utils.chat_writer import ChatWrite, ChatWriter
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+CHAT_ID = "test_chat_writer"
+
+
+def request_insert(request_id: int) -> ChatWrite:
+    return ChatWrite(
+        table="chat_requests",
+        kind="insert",
+        values={
+            "request_id": request_id,
+            "chat_id": CHAT_ID,
+            "created_datetime_utc": datetime.utcnow(),
+            "user_id": 1,
+            "message": "how much ORS?",
+        },
+    )
+
+
+@pytest.fixture
+async def clean_up_chat(async_engine: AsyncEngine) -> AsyncIterator[None]:
+    yield
+    async with AsyncSession(async_engine) as asession:
+        await asession.execute(
+            delete(ChatResponseDB).where(ChatResponseDB.chat_id == CHAT_ID)
+        )
+        await asession.execute(
+            delete(ChatRequestDB).where(ChatRequestDB.chat_id == CHAT_ID)
+        )
+        await asession.commit()
+
+
+def session_factory(
+    async_engine: AsyncEngine, released: asyncio.Event | None = None
+) -> Callable[[], AsyncContextManager[AsyncSession]]:
+    """Sessions on the test database, which wait for `released` if given."""
+
+    @asynccontextmanager
+    async def factory() -> AsyncIterator[AsyncSession]:
+        if released is not None:
+            await released.wait()
+        async with AsyncSession(async_engine, expire_on_commit=False) as asession:
+            yield asession
+
+    return factory
+
+
+class TestChatWriter:
+    async def test_batch_is_written_in_order(
+        self, async_engine: AsyncEngine, clean_up_chat: None
+    ) -> None:
+        writer = ChatWriter(
+            batch_size=10,
+            flush_seconds=10,
+            session_factory=session_factory(async_engine),
+        )
+        await writer.start()
+        request_id = await writer.allocate_id("chat_requests")
+        response_id = await writer.allocate_id("chat_responses")
+
+        await writer.write(request_insert(request_id))
+        await writer.write(
+            ChatWrite(
+                table="chat_requests",
+                kind="update",
+                values={"message": "how much ORS for a child?"},
+                key={"request_id": request_id},
+            )
+        )
+        await writer.write(
+            ChatWrite(
+                table="chat_responses",
+                kind="insert",
+                values={
+                    "response_id": response_id,
+                    "request_id": request_id,
+                    "chat_id": CHAT_ID,
+                    "created_datetime_utc": datetime.utcnow(),
+                    "response": "Half a cup",
+                },
+            )
+        )
+        # The flush does not wait for the 10 seconds
+        await asyncio.wait_for(writer.flush(), timeout=5)
+        await writer.stop()
+
+        async with AsyncSession(async_engine) as asession:
+            chat_request = await asession.get(ChatRequestDB, request_id)
+            chat_response = await asession.get(ChatResponseDB, response_id)
+        assert chat_request is not None and chat_response is not None
+        assert chat_request.message == "how much ORS for a child?"
+        assert chat_response.request_id == request_id
+        stats = writer.stats()
+        assert stats.n_written == 3
+        assert stats.n_batches == 1
+
+    async def test_full_queue_makes_writes_wait(
+        self, async_engine: AsyncEngine
+    ) -> None:
+        released = asyncio.Event()
+        writer = ChatWriter(
+            max_queue_size=1,
+            batch_size=1,
+            flush_seconds=0,
+            session_factory=session_factory(async_engine, released),
+        )
+        await writer.start()
+        # Updates to a missing request, which change nothing
+        missing = ChatWrite(
+            table="chat_requests",
+            kind="update",
+            values={"message": ""},
+            key={"request_id": -1},
+        )
+        await writer.write(missing)  # Taken by the writer, which waits for a session
+        await asyncio.sleep(0.05)
+        await writer.write(missing)  # Fills the queue
+
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(writer.write(missing), timeout=0.1)
+        assert writer.stats().n_backpressure_waits == 1
+
+        released.set()
+        await writer.stop()
+        assert writer.stats().queue_depth == 0
+
+    async def test_failed_writer_fails_flush(
+        self, async_engine: AsyncEngine, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        writer = ChatWriter(session_factory=session_factory(async_engine))
+
+        async def fail(writes: list[ChatWrite]) -> None:
+            raise ConnectionError("no database")
+
+        monkeypatch.setattr(writer, "_commit", fail)
+        await writer.start()
+        await writer.write(request_insert(-1))
+
+        with pytest.raises(RuntimeError, match="stopped"):
+            await asyncio.wait_for(writer.flush(), timeout=5)
+        with pytest.raises(RuntimeError, match="stopped"):
+            await writer.write(request_insert(-2))
+        with pytest.raises(ConnectionError):
+            await writer.stop()
+
+    async def test_journal_of_dead_process_is_replayed(
+        self, async_engine: AsyncEngine, tmp_path: Path, clean_up_chat: None
+    ) -> None:
+        replaying_writer = ChatWriter(
+            journal_dir=str(tmp_path), session_factory=session_factory(async_engine)
+        )
+        request_id = await replaying_writer.allocate_id("chat_requests")
+
+        crashed_writer = ChatWriter(
+            journal_dir=str(tmp_path),
+            session_factory=session_factory(async_engine, asyncio.Event()),
+        )
+        await crashed_writer.start()
+        await crashed_writer.write(request_insert(request_id))
+        # Crash before the write is committed
+        assert crashed_writer._task is not None
+        assert crashed_writer._journal is not None
+        crashed_writer._task.cancel()
+        crashed_writer._journal.close()
+
+        await replaying_writer.start()
+        await replaying_writer.stop()
+
+        async with AsyncSession(async_engine) as asession:
+            chat_request = await asession.get(ChatRequestDB, request_id)
+        assert chat_request is not None
+        assert chat_request.message == "how much ORS?"
+        assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,70 @@
+import pytest
+from app.services.utils.chunking import TokenChunker
+
+
+def count_words(text: str) -> int:
+    """Use whitespace-separated words as tokens."""
+    return len(text.split())
+
+
+@pytest.fixture
+def chunker() -> TokenChunker:
+    return TokenChunker(count_tokens=count_words, max_tokens=10, overlap_tokens=0)
+
+
+class TestTokenChunker:
+    def test_short_text_is_single_chunk(self, chunker: TokenChunker) -> None:
+        chunks = chunker.split("One short sentence. And another one.")
+
+        assert len(chunks) == 1
+        assert chunks[0].text == "One short sentence. And another one."
+        assert chunks[0].n_tokens == 6
+
+    def test_chunks_respect_budget(self, chunker: TokenChunker) -> None:
+        text = " ".join(f"Sentence number {i} is here." for i in range(20))
+        chunks = chunker.split(text)
+
+        assert len(chunks) > 1
+        assert all(chunk.n_tokens <= 10 for chunk in chunks)
+        assert all(chunk.text.endswith(".") for chunk in chunks)
+
+    def test_long_sentence_is_split_on_words(self, chunker: TokenChunker) -> None:
+        chunks = chunker.split(" ".join(["word"] * 25))
+
+        assert [chunk.n_tokens for chunk in chunks] == [10, 10, 5]
+
+    def test_paragraph_boundary_starts_new_chunk(self, chunker: TokenChunker) -> None:
+        text = "The first paragraph has six words.\n\nSecond one. Then a bit more."
+        chunks = chunker.split(text)
+
+        assert [chunk.text for chunk in chunks] == [
+            "The first paragraph has six words.",
+            "Second one. Then a bit more.",
+        ]
+
+    def test_overlap_repeats_trailing_sentences(self) -> None:
+        chunker = TokenChunker(count_tokens=count_words, max_tokens=8, overlap_tokens=3)
+        chunks = chunker.split("A b c. D e f. G h i. J k l.")
+
+        assert [chunk.text for chunk in chunks] == [
+            "A b c. D e f.",
+            "D e f. G h i.",
+            "G h i. J k l.",
+        ]
+
+    def test_chunk_is_split_where_joined_text_exceeds_budget(self) -> None:
+        def count_with_breaks(text: str) -> int:
+            """Count paragraph breaks as a token too."""
+            return count_words(text) + text.count("\n\n")
+
+        chunker = TokenChunker(count_tokens=count_with_breaks, max_tokens=4)
+        chunks = chunker.split("A b.\n\nC d.")
+
+        assert [(chunk.text, chunk.n_tokens) for chunk in chunks] == [
+            ("A b.", 2),
+            ("C d.", 2),
+        ]
+
+    def test_invalid_overlap_raises(self) -> None:
+        with pytest.raises(ValueError):
+            TokenChunker(count_tokens=count_words, max_tokens=5, overlap_tokens=5)
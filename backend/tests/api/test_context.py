@@ -0,0 +1,47 @@
+from app.ingestion.schemas import DocumentChunk
+from app.services.utils.context import assemble_context
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def chunk(text: str) -> DocumentChunk:
+    return DocumentChunk(file_name="doc.pdf", chunk_id=0, text=text, distance=0.1)
+
+
+QUERY = "How many health posts are in Tigray?"
+LONG_TEXT = (
+    "The report covers several regions. "
+    "Tigray has 712 health posts. "
+    "Funding increased in 2019. "
+    "Health posts in Tigray are staffed by two workers."
+)
+
+
+class TestAssembleContext:
+    def test_everything_fits(self) -> None:
+        context = assemble_context(
+            {0: chunk("Short text."), 1: chunk("More text.")}, QUERY, 100, count_words
+        )
+
+        assert context.full_chunks == [0, 1]
+        assert "Short text." in context.text and "More text." in context.text
+        assert context.n_tokens <= 100
+
+    def test_overflowing_chunk_keeps_relevant_sentences(self) -> None:
+        context = assemble_context({0: chunk(LONG_TEXT)}, QUERY, 17, count_words)
+
+        assert context.trimmed_chunks == [0]
+        assert "Tigray has 712 health posts." in context.text
+        assert "Health posts in Tigray are staffed by two workers." in context.text
+        assert "Funding" not in context.text
+        assert context.n_tokens <= 17
+
+    def test_chunks_are_dropped_once_budget_is_spent(self) -> None:
+        context = assemble_context(
+            {0: chunk(LONG_TEXT), 1: chunk(LONG_TEXT)}, QUERY, 26, count_words
+        )
+
+        assert context.full_chunks == [0]
+        assert context.dropped_chunks == [1]
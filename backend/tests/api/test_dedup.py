@@ -0,0 +1,65 @@
+import hashlib
+
+from app.services.utils.dedup import (
+    _PERMUTATIONS,
+    estimate_similarity,
+    get_shingles,
+    lsh_band_hashes,
+    minhash_signature,
+)
+
+BOILERPLATE = (
+    "This document is provided for informational purposes only and does not "
+    "constitute medical advice. Always consult a qualified health professional "
+    "before starting any treatment. The ministry accepts no liability for errors."
+)
+
+
+def test_shingles_ignore_case_and_punctuation() -> None:
+    assert get_shingles("Wash your HANDS, often!", shingle_size=2) == {
+        "wash your",
+        "your hands",
+        "hands often",
+    }
+
+
+def test_identical_text_has_identical_signature() -> None:
+    signature = minhash_signature(BOILERPLATE)
+
+    assert signature == minhash_signature(BOILERPLATE.upper())
+    assert lsh_band_hashes(signature) == lsh_band_hashes(minhash_signature(BOILERPLATE))
+
+
+def test_near_duplicate_is_more_similar_than_unrelated_text() -> None:
+    near_duplicate = BOILERPLATE.replace("errors", "errors or omissions")
+    unrelated = (
+        "Give oral rehydration salts to children with diarrhoea in small sips "
+        "after each loose stool, and continue breastfeeding throughout."
+    )
+    signature = minhash_signature(BOILERPLATE)
+
+    near_similarity = estimate_similarity(signature, minhash_signature(near_duplicate))
+    unrelated_similarity = estimate_similarity(signature, minhash_signature(unrelated))
+
+    assert near_similarity > 0.7
+    assert unrelated_similarity < 0.2
+
+
+def test_signature_is_exact_modulo_prime() -> None:
+    prime = (1 << 61) - 1
+    shingle_hashes = [
+        int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), "big")
+        for s in get_shingles(BOILERPLATE)
+    ]
+    expected = [
+        min((int(a) * h + int(b)) % prime & 0xFFFFFFFF for h in shingle_hashes)
+        for a, b in zip(*_PERMUTATIONS)
+    ]
+
+    assert minhash_signature(BOILERPLATE) == expected
+
+
+def test_band_hashes_fit_in_bigint() -> None:
+    band_hashes = lsh_band_hashes(minhash_signature(BOILERPLATE))
+
+    assert all(0 <= h < 2**63 for h in band_hashes)
@@ -0,0 +1,92 @@
+import time
+from datetime import datetime
+
+from app.chat.schemas import ChatResponse, ChatUserMessage
+from app.services.utils.history_cache import InMemoryHistoryCache
+
+
+def request(
+    chat_id: str, request_id: int, message: str = "question"
+) -> ChatUserMessage:
+    return ChatUserMessage(
+        chat_id=chat_id,
+        user_id=1,
+        message=message,
+        request_id=request_id,
+        created_datetime_utc=datetime.utcnow(),
+    )
+
+
+def response(chat_id: str, request_id: int) -> ChatResponse:
+    return ChatResponse(
+        chat_id=chat_id,
+        response="answer",
+        request_id=request_id,
+        response_id=request_id,
+        created_datetime_utc=datetime.utcnow(),
+    )
+
+
+async def load(cache: InMemoryHistoryCache, chat_id: str, history: list) -> None:
+    token = await cache.begin_load(chat_id)
+    await cache.set(chat_id, history, token)
+
+
+class TestInMemoryHistoryCache:
+    async def test_writes_go_through_to_cached_chats_only(self) -> None:
+        cache = InMemoryHistoryCache(max_bytes=10**6, idle_seconds=60)
+        first_request, first_response = request("chat1", 1), response("chat1", 1)
+        await load(cache, "chat1", [first_request])
+
+        await cache.append("chat1", first_response)
+        await cache.append("chat2", request("chat2", 2))
+
+        assert await cache.get("chat1") == [first_request, first_response]
+        assert await cache.get("chat2") is None
+
+    async def test_update_request(self) -> None:
+        cache = InMemoryHistoryCache(max_bytes=10**6, idle_seconds=60)
+        await load(cache, "chat1", [request("chat1", 1), response("chat1", 1)])
+
+        await cache.update_request(
+            "chat1", 1, {"message": "refined", "message_original": "question"}
+        )
+
+        history = await cache.get("chat1")
+        assert history is not None
+        assert isinstance(history[0], ChatUserMessage)
+        assert history[0].message == "refined"
+        assert history[0].message_original == "question"
+        assert isinstance(history[1], ChatResponse)
+
+    async def test_load_is_dropped_if_chat_written_meanwhile(self) -> None:
+        cache = InMemoryHistoryCache(max_bytes=10**6, idle_seconds=60)
+        token = await cache.begin_load("chat1")
+        # Saved after the history was read from the database
+        await cache.append("chat1", request("chat1", 2))
+        await cache.set("chat1", [request("chat1", 1)], token)
+
+        assert await cache.get("chat1") is None
+
+    async def test_least_recently_used_evicted_over_budget(self) -> None:
+        size = len(request("chat1", 1).model_dump_json())
+        cache = InMemoryHistoryCache(max_bytes=2 * size, idle_seconds=60)
+        await load(cache, "chat1", [request("chat1", 1)])
+        await load(cache, "chat2", [request("chat2", 1)])
+        await cache.get("chat1")
+
+        await load(cache, "chat3", [request("chat3", 1)])
+
+        assert await cache.get("chat2") is None
+        assert await cache.get("chat1") is not None
+        assert await cache.get("chat3") is not None
+        assert cache.n_bytes <= 2 * size
+
+    async def test_idle_chats_evicted(self) -> None:
+        cache = InMemoryHistoryCache(max_bytes=10**6, idle_seconds=0.05)
+        await load(cache, "chat1", [request("chat1", 1)])
+        time.sleep(0.1)
+
+        assert await cache.get("chat1") is None
+        assert len(cache) == 0
+        assert cache.n_bytes == 0
@@ -20,3 +20,158 @@ async def test_ingestion(client: TestClient, filename: str, status: int) -> None
         response = client.post("/ingestion", headers=headers, files=files)
 
     assert response.status_code == status
+
+
+class TestNearDuplicateDetection:
+    @pytest.fixture
+    def headers(self) -> dict:
+        return {
+            "accept": "application/json",
+            "Authorization": f"Bearer {API_SECRET_KEY}",
+        }
+
+    def upload(self, client: TestClient, headers: dict, filename: str) -> dict:
+        with open(Path(__file__).parent / f"data/{filename}", "rb") as f:
+            files = {"file": (filename, f, "text/plain")}
+            response = client.post("/ingestion", headers=headers, files=files)
+        assert response.status_code == 200
+        return response.json()
+
+    def test_reupload_is_deduplicated(self, client: TestClient, headers: dict) -> None:
+        self.upload(client, headers, "TestFile.txt")
+        second_upload = self.upload(client, headers, "TestFile.txt")
+
+        assert second_upload["n_duplicate_chunks"] == second_upload["total_chunks"]
+
+        response = client.get("/ingestion/dedup_report", headers=headers)
+        assert response.status_code == 200
+        report = response.json()
+        assert report["n_duplicate_chunks"] >= second_upload["n_duplicate_chunks"]
+        assert report["n_files_all_duplicates"] >= 1
+        assert report["text_bytes_saved"] > 0
+
+        response = client.get(
+            "/ingestion/list_docs", headers=headers, params={"file_name": "TestFile"}
+        )
+        listed = {d["file_id"]: d for d in response.json()["documents"]}
+        assert (
+            listed[second_upload["file_id"]]["n_duplicate_chunks"]
+            == second_upload["n_duplicate_chunks"]
+        )
+
+
+class TestListDocs:
+    @pytest.fixture
+    def headers(self) -> dict:
+        return {
+            "accept": "application/json",
+            "Authorization": f"Bearer {API_SECRET_KEY}",
+        }
+
+    @pytest.fixture
+    def uploaded_files(self, client: TestClient, headers: dict) -> list[str]:
+        file_ids = []
+        for _ in range(3):
+            with open(Path(__file__).parent / "data/TestFile.txt", "rb") as f:
+                files = {"file": ("ListDocsFile.txt", f, "text/plain")}
+                response = client.post("/ingestion", headers=headers, files=files)
+            file_ids.append(response.json()["file_id"])
+        return file_ids
+
+    def test_keyset_pagination(
+        self, client: TestClient, headers: dict, uploaded_files: list[str]
+    ) -> None:
+        params: dict = {"limit": 2, "file_name": "listdocsfile"}
+        first_page = client.get("/ingestion/list_docs", headers=headers, params=params)
+        assert first_page.status_code == 200
+        assert len(first_page.json()["documents"]) == 2
+        assert first_page.json()["next_cursor"] is not None
+
+        params["cursor"] = first_page.json()["next_cursor"]
+        second_page = client.get("/ingestion/list_docs", headers=headers, params=params)
+        assert second_page.status_code == 200
+
+        file_ids = [
+            doc["file_id"]
+            for page in (first_page, second_page)
+            for doc in page.json()["documents"]
+        ]
+        assert set(uploaded_files) <= set(file_ids)
+        assert len(file_ids) == len(set(file_ids))
+
+    def test_etag_not_modified(
+        self, client: TestClient, headers: dict, uploaded_files: list[str]
+    ) -> None:
+        response = client.get("/ingestion/list_docs", headers=headers)
+        etag = response.headers["ETag"]
+
+        response = client.get(
+            "/ingestion/list_docs", headers={**headers, "If-None-Match": etag}
+        )
+        assert response.status_code == 304
+
+    def test_etag_changes_after_upload(
+        self, client: TestClient, headers: dict, uploaded_files: list[str]
+    ) -> None:
+        etag = client.get("/ingestion/list_docs", headers=headers).headers["ETag"]
+
+        with open(Path(__file__).parent / "data/TestFile.txt", "rb") as f:
+            files = {"file": ("ListDocsFile.txt", f, "text/plain")}
+            client.post("/ingestion", headers=headers, files=files)
+
+        response = client.get(
+            "/ingestion/list_docs", headers={**headers, "If-None-Match": etag}
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+    def test_invalid_cursor(self, client: TestClient, headers: dict) -> None:
+        response = client.get(
+            "/ingestion/list_docs", headers=headers, params={"cursor": "not-a-cursor"}
+        )
+        assert response.status_code == 400
+
+
+def test_batch_ingestion(client: TestClient) -> None:
+    headers = {
+        "accept": "application/json",
+        "Authorization": f"Bearer {API_SECRET_KEY}",
+    }
+    data_dir = Path(__file__).parent / "data"
+    with open(data_dir / "TestFile.txt", "rb") as f1, open(
+        data_dir / "EmptyFile.txt", "rb"
+    ) as f2:
+        files = [
+            ("files", ("TestFile.txt", f1, "text/plain")),
+            ("files", ("EmptyFile.txt", f2, "text/plain")),
+        ]
+        response = client.post("/ingestion/batch", headers=headers, files=files)
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [f["file_name"] for f in body["files"]] == ["TestFile.txt"]
+    assert [(e["file_name"], e["stage"]) for e in body["errors"]] == [
+        ("EmptyFile.txt", "parse")
+    ]
+    assert [m["name"] for m in body["pipeline_metrics"]] == ["parse", "embed", "write"]
+
+
+def test_file_is_embedded_and_written_in_batches(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr("app.services.DocumentService.INGESTION_BATCH_CHUNKS", 1)
+    headers = {
+        "accept": "application/json",
+        "Authorization": f"Bearer {API_SECRET_KEY}",
+    }
+    filename = "Ethiopia_DH_CaseStudy.pdf"
+    with open(Path(__file__).parent / f"data/{filename}", "rb") as f:
+        files = [("files", (filename, f, "application/pdf"))]
+        response = client.post("/ingestion/batch", headers=headers, files=files)
+
+    assert response.status_code == 200
+    body = response.json()
+    (saved,) = body["files"]
+    embed, write = body["pipeline_metrics"][1:]
+    assert saved["total_chunks"] > 1
+    assert embed["n_items"] == write["n_items"] == saved["total_chunks"]
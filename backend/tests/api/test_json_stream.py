@@ -0,0 +1,56 @@
+import json
+
+import pytest
+from app.services.utils.json_stream import JSONStringFieldExtractor
+
+RESPONSE = json.dumps(
+    {
+        "extracted_info": ['Not the "answer": field'],
+        "answer": 'He said "hi"\nthen left \\ é 😀',
+    }
+)
+
+
+class TestJSONStringFieldExtractor:
+    @pytest.mark.parametrize("piece_size", [1, 2, 3, 7, len(RESPONSE)])
+    def test_pieces_decode_to_field_value(self, piece_size: int) -> None:
+        extractor = JSONStringFieldExtractor("answer")
+        decoded = "".join(
+            extractor.feed(RESPONSE[i : i + piece_size])
+            for i in range(0, len(RESPONSE), piece_size)
+        )
+
+        assert decoded == json.loads(RESPONSE)["answer"]
+        assert extractor.done
+
+    def test_missing_field_yields_nothing(self) -> None:
+        extractor = JSONStringFieldExtractor("answer")
+
+        assert extractor.feed("The answer is 42") == ""
+        assert not extractor.done
+
+    @pytest.mark.parametrize(
+        "value, expected",
+        [
+            ("\\uZZZZ ok", "\ufffdZZZZ ok"),
+            ("\\u12", "\ufffd"),
+            ("\\ud83d then", "\ufffd then"),
+            ("\\ud83d\\n", "\ufffd\n"),
+            ("\\ud83d\\u0041", "\ufffdA"),
+            ("\\ude00 low", "\ufffd low"),
+            ("\\ud83d\\ude00", "😀"),
+        ],
+    )
+    @pytest.mark.parametrize("piece_size", [1, 100])
+    def test_invalid_unicode_escapes_are_replaced(
+        self, value: str, expected: str, piece_size: int
+    ) -> None:
+        text = '{"answer": "' + value + '"}'
+        extractor = JSONStringFieldExtractor("answer")
+        decoded = "".join(
+            extractor.feed(text[i : i + piece_size])
+            for i in range(0, len(text), piece_size)
+        )
+
+        assert decoded == expected
+        assert extractor.done
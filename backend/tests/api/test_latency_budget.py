@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import pytest
+from app.chat.config import CHAT_ANSWER_RESERVE_SECONDS, CHAT_MIN_CONTEXT_FRACTION
+from app.services.utils.inference import run_inference
+from app.services.utils.latency_budget import LatencyBudget
+
+
+async def slow_rerank(seconds: float) -> str:
+    await asyncio.sleep(seconds)
+    return "reranked"
+
+
+class TestLatencyBudget:
+    async def test_stage_within_budget_runs(self) -> None:
+        budget = LatencyBudget(total_seconds=10)
+
+        result = await budget.run_stage(
+            "rerank", 1, slow_rerank(0.01), "vector_order", lambda: "vector order"
+        )
+
+        assert result == "reranked"
+        assert budget.degradations == []
+
+    async def test_stage_over_its_budget_falls_back(self) -> None:
+        budget = LatencyBudget(total_seconds=10)
+
+        result = await budget.run_stage(
+            "rerank", 0.05, slow_rerank(1), "vector_order", lambda: "vector order"
+        )
+
+        assert result == "vector order"
+        assert budget.degradations[0].stage == "rerank"
+        assert budget.degradations[0].fallback == "vector_order"
+        assert budget.degradations[0].budget_seconds == pytest.approx(0.05)
+
+    async def test_stage_is_skipped_when_request_budget_is_spent(self) -> None:
+        budget = LatencyBudget(total_seconds=0.01)
+        await asyncio.sleep(0.02)
+        started = False
+
+        async def refine() -> str:
+            nonlocal started
+            started = True
+            return "refined"
+
+        result = await budget.run_stage(
+            "refine", 10, refine(), "raw_message", lambda: "raw"
+        )
+
+        assert result == "raw"
+        assert not started
+
+    async def test_inference_is_not_started_after_the_stage_budget(self) -> None:
+        budget = LatencyBudget(total_seconds=10)
+        calls: list[str] = []
+
+        async def rerank() -> str:
+            time.sleep(0.1)  # Blocks past the stage's budget
+            await run_inference(calls.append, "predict")
+            return "reranked"
+
+        result = await budget.run_stage(
+            "rerank", 0.05, rerank(), "vector_order", lambda: "vector order"
+        )
+
+        assert result == "vector order"
+        assert calls == []
+
+    def test_context_is_cut_when_little_time_is_left(self) -> None:
+        budget = LatencyBudget(total_seconds=CHAT_ANSWER_RESERVE_SECONDS / 2)
+
+        assert budget.context_token_budget(1000) == pytest.approx(500, abs=1)
+        assert budget.degradations[0].fallback == "reduced_context"
+
+        budget.start -= CHAT_ANSWER_RESERVE_SECONDS
+        assert budget.context_token_budget(1000) == int(
+            1000 * CHAT_MIN_CONTEXT_FRACTION
+        )
+
+    def test_no_budget_keeps_context(self) -> None:
+        budget = LatencyBudget(total_seconds=0)
+
+        assert budget.context_token_budget(1000) == 1000
+        assert budget.degradations == []
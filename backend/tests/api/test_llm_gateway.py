@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+from app.services.utils.llm_gateway import (
+    LLMGateway,
+    LLMOverloadedError,
+    LLMPriority,
+)
+
+
+async def call(
+    gateway: LLMGateway, priority: LLMPriority, log: list, duration: float = 0.05
+) -> None:
+    async with gateway.slot(priority):
+        log.append(priority)
+        await asyncio.sleep(duration)
+
+
+class TestLLMGateway:
+    async def test_concurrency_is_capped(self) -> None:
+        gateway = LLMGateway(max_concurrency=2, max_queue_wait_seconds=10)
+        max_in_flight = 0
+
+        async def tracked_call() -> None:
+            nonlocal max_in_flight
+            async with gateway.slot(LLMPriority.ANSWER):
+                max_in_flight = max(max_in_flight, gateway.stats().in_flight)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(tracked_call() for _ in range(6)))
+
+        assert max_in_flight == 2
+        assert gateway.stats().in_flight == 0
+        assert gateway.stats().n_completed == 6
+
+    async def test_answers_are_served_before_refinements(self) -> None:
+        gateway = LLMGateway(max_concurrency=1, max_queue_wait_seconds=10)
+        log: list[LLMPriority] = []
+
+        first = asyncio.create_task(call(gateway, LLMPriority.ANSWER, log))
+        await asyncio.sleep(0.01)
+        queued = [
+            asyncio.create_task(call(gateway, LLMPriority.REFINE, log, 0.01)),
+            asyncio.create_task(call(gateway, LLMPriority.ANSWER, log, 0.01)),
+        ]
+        await asyncio.sleep(0.01)
+        assert gateway.stats().queue_depth_by_priority == {"answer": 1, "refine": 1}
+
+        await asyncio.gather(first, *queued)
+        assert log == [LLMPriority.ANSWER, LLMPriority.ANSWER, LLMPriority.REFINE]
+
+    async def test_overload_is_rejected_with_retry_after(self) -> None:
+        gateway = LLMGateway(max_concurrency=1, max_queue_wait_seconds=0.1)
+        log: list[LLMPriority] = []
+        # Learn how long a call takes
+        await call(gateway, LLMPriority.ANSWER, log, duration=0.2)
+
+        running = asyncio.create_task(call(gateway, LLMPriority.ANSWER, log, 0.2))
+        await asyncio.sleep(0.01)
+        with pytest.raises(LLMOverloadedError) as e:
+            await call(gateway, LLMPriority.ANSWER, log)
+        await running
+
+        assert e.value.retry_after >= 1
+        assert gateway.stats().n_rejected == 1
+        assert gateway.stats().queue_depth == 0
+
+    async def test_cold_gateway_rejects_with_expected_call_time(self) -> None:
+        gateway = LLMGateway(
+            max_concurrency=1, max_queue_wait_seconds=1, expected_call_seconds=5
+        )
+        log: list[LLMPriority] = []
+
+        running = asyncio.create_task(call(gateway, LLMPriority.ANSWER, log, 0.2))
+        await asyncio.sleep(0.01)
+        assert gateway.estimate_wait(LLMPriority.ANSWER) == 5
+        with pytest.raises(LLMOverloadedError) as e:
+            await call(gateway, LLMPriority.ANSWER, log)
+        await running
+
+        assert e.value.retry_after == 5
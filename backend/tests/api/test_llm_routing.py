@@ -0,0 +1,124 @@
+import asyncio
+from types import SimpleNamespace
+from typing import AsyncIterator
+
+import pytest
+from app.services.utils import completion
+from app.services.utils.llm_routing import (
+    LLM_STAGE_CONFIGS,
+    LLMStage,
+    LLMStageConfig,
+    record_llm_calls,
+)
+
+USAGE = SimpleNamespace(prompt_tokens=12, completion_tokens=3)
+
+
+def fake_response(content: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=USAGE,
+    )
+
+
+async def fake_stream(content: str) -> AsyncIterator[SimpleNamespace]:
+    for delta in content.split(" "):
+        yield SimpleNamespace(
+            choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))]
+        )
+    # The usage comes in a final chunk without choices
+    yield SimpleNamespace(choices=[], usage=USAGE)
+
+
+async def fake_acompletion(model: str, stream: bool = False, **kwargs: dict) -> object:
+    """`broken` errors, `slow` takes a second, any other model answers with its
+    name."""
+    if model == "broken":
+        raise RuntimeError("model unavailable")
+    if model == "slow":
+        await asyncio.sleep(1)
+    return fake_stream(f"from {model}") if stream else fake_response(model)
+
+
+@pytest.fixture
+def fake_llm(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(completion, "acompletion", fake_acompletion)
+
+
+def use_models(monkeypatch: pytest.MonkeyPatch, models: list[str]) -> None:
+    monkeypatch.setitem(
+        LLM_STAGE_CONFIGS,
+        LLMStage.REFINE,
+        LLMStageConfig(
+            models=models, max_tokens=16, temperature=0, timeout_seconds=0.2
+        ),
+    )
+
+
+class TestLLMRouting:
+    async def test_primary_model_serves_stage(
+        self, fake_llm: None, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        use_models(monkeypatch, ["small", "large"])
+        llm_calls = record_llm_calls()
+
+        response = await completion._ask_llm_async("hi", "system", LLMStage.REFINE)
+
+        assert response == "small"
+        assert llm_calls["refine"].model == "small"
+        assert llm_calls["refine"].failed_models == []
+
+    @pytest.mark.parametrize("failing_model", ["broken", "slow"])
+    async def test_falls_back_on_error_or_timeout(
+        self,
+        fake_llm: None,
+        monkeypatch: pytest.MonkeyPatch,
+        failing_model: str,
+    ) -> None:
+        use_models(monkeypatch, [failing_model, "large"])
+        llm_calls = record_llm_calls()
+
+        response = await completion._ask_llm_async("hi", "system", LLMStage.REFINE)
+
+        assert response == "large"
+        assert llm_calls["refine"].failed_models == [failing_model]
+
+    async def test_last_model_error_is_raised(
+        self, fake_llm: None, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        use_models(monkeypatch, ["broken"])
+
+        with pytest.raises(RuntimeError):
+            await completion._ask_llm_async("hi", "system", LLMStage.REFINE)
+
+    async def test_stream_falls_back_before_first_token(
+        self, fake_llm: None, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        use_models(monkeypatch, ["slow", "large"])
+        llm_calls = record_llm_calls()
+
+        deltas = [
+            delta
+            async for delta in completion._ask_llm_stream(
+                "hi", "system", LLMStage.REFINE
+            )
+        ]
+
+        assert deltas == ["from", "large"]
+        assert llm_calls["refine"].model == "large"
+
+    async def test_tokens_and_seconds_are_recorded(
+        self, fake_llm: None, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        use_models(monkeypatch, ["small"])
+        llm_calls = record_llm_calls()
+
+        await completion._ask_llm_async("hi", "system", LLMStage.REFINE)
+        refine_call = llm_calls["refine"]
+        async for _ in completion._ask_llm_stream("hi", "system", LLMStage.REFINE):
+            pass
+        stream_call = llm_calls["refine"]
+
+        for llm_call in (refine_call, stream_call):
+            assert (llm_call.prompt_tokens, llm_call.completion_tokens) == (12, 3)
+            assert llm_call.seconds is not None
@@ -0,0 +1,62 @@
+import pytest
+from app.services.utils.inference import run_inference
+from app.services.utils.metrics import HTTPMetricsMiddleware, generate_metrics
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+
+def request_count(route: str, status: str) -> float:
+    labels = {"method": "GET", "route": route, "status": status}
+    return REGISTRY.get_sample_value("http_request_duration_seconds_count", labels) or 0
+
+
+@pytest.fixture
+def metrics_client() -> TestClient:
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: int) -> dict:
+        if item_id < 0:
+            raise HTTPException(status_code=404, detail="Not found")
+        return {"item_id": item_id}
+
+    app.add_middleware(HTTPMetricsMiddleware)
+    return TestClient(app)
+
+
+class TestHTTPMetrics:
+    def test_requests_are_counted_by_route_template(
+        self, metrics_client: TestClient
+    ) -> None:
+        before_ok = request_count("/items/{item_id}", "200")
+        before_not_found = request_count("/items/{item_id}", "404")
+        before_unmatched = request_count("unmatched", "404")
+
+        metrics_client.get("/items/1")
+        metrics_client.get("/items/2")
+        metrics_client.get("/items/-1")
+        metrics_client.get("/other")
+
+        assert request_count("/items/{item_id}", "200") == before_ok + 2
+        assert request_count("/items/{item_id}", "404") == before_not_found + 1
+        assert request_count("unmatched", "404") == before_unmatched + 1
+
+    def test_metrics_are_exported(self, metrics_client: TestClient) -> None:
+        metrics_client.get("/items/1")
+
+        content, content_type = generate_metrics()
+
+        assert content_type.startswith("text/plain")
+        assert b"http_request_duration_seconds_bucket" in content
+
+
+class TestInferenceMetrics:
+    async def test_queue_is_empty_after_calls(self) -> None:
+        await run_inference(sum, [1, 2])
+
+        assert REGISTRY.get_sample_value("inference_queued") == 0
+        n_calls = REGISTRY.get_sample_value(
+            "inference_duration_seconds_count", {"function": "sum"}
+        )
+        assert n_calls is not None and n_calls >= 1
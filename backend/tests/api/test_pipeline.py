@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+from app.services.utils.pipeline import Pipeline, Stage
+
+
+async def double(x: int) -> int:
+    await asyncio.sleep(0.001)
+    return 2 * x
+
+
+async def fail_on_three(x: int) -> int:
+    if x == 6:
+        raise ValueError("three")
+    return x + 1
+
+
+class TestPipeline:
+    async def test_results_are_in_input_order(self) -> None:
+        pipeline = Pipeline(
+            [Stage("double", double, workers=3), Stage("add", fail_on_three)]
+        )
+        results = await pipeline.run([1, 2, 4, 5])
+
+        assert [r.value for r in results] == [3, 5, 9, 11]
+        assert all(r.error is None for r in results)
+
+    async def test_failed_items_skip_later_stages(self) -> None:
+        pipeline = Pipeline(
+            [
+                Stage("double", double),
+                Stage("add", fail_on_three),
+                Stage("double_again", double),
+            ]
+        )
+        results = await pipeline.run([1, 3, 4])
+
+        assert [r.value for r in results if r.error is None] == [6, 18]
+        assert results[1].failed_stage == "add"
+        assert isinstance(results[1].error, ValueError)
+        assert [m.n_items for m in pipeline.metrics] == [3, 3, 2]
+
+    async def test_later_stage_starts_before_earlier_stage_finishes(self) -> None:
+        events: list[str] = []
+        second_started = asyncio.Event()
+
+        async def first(x: int) -> int:
+            if x == 1:
+                # Only completes if the second stage runs item 0 meanwhile
+                await second_started.wait()
+            events.append(f"first {x}")
+            return x
+
+        async def second(x: int) -> int:
+            events.append(f"second {x}")
+            second_started.set()
+            return x
+
+        pipeline = Pipeline([Stage("first", first), Stage("second", second)])
+        await asyncio.wait_for(pipeline.run(range(2)), timeout=5)
+
+        assert events == ["first 0", "second 0", "first 1", "second 1"]
+
+    async def test_bounded_queue_applies_backpressure(self) -> None:
+        released = asyncio.Event()
+        n_fast = 0
+
+        async def fast(x: int) -> int:
+            nonlocal n_fast
+            n_fast += 1
+            return x
+
+        async def blocked(x: int) -> int:
+            await released.wait()
+            return x
+
+        pipeline = Pipeline(
+            [Stage("fast", fast, queue_size=1), Stage("blocked", blocked, queue_size=1)]
+        )
+        run = asyncio.create_task(pipeline.run(range(10)))
+        await asyncio.sleep(0.05)
+
+        # One item in the blocked stage, one in its queue and one waiting to be put
+        # on it: the fast stage stops there
+        assert n_fast == 3
+        released.set()
+        assert len(await run) == 10
+
+    async def test_split_items_go_through_later_stages_as_parts(self) -> None:
+        async def split(x: int) -> list[int]:
+            return [x] * x
+
+        pipeline = Pipeline(
+            [Stage("split", split, split=True), Stage("double", double, workers=2)]
+        )
+        results = await pipeline.run([1, 2])
+
+        assert [(r.index, r.part, r.value) for r in results] == [
+            (0, 0, 2),
+            (1, 0, 4),
+            (1, 1, 4),
+        ]
+        assert [m.n_items for m in pipeline.metrics] == [2, 3]
+
+    def test_empty_pipeline_raises(self) -> None:
+        with pytest.raises(ValueError):
+            Pipeline([])
+
+    def test_second_split_stage_raises(self) -> None:
+        with pytest.raises(ValueError):
+            Pipeline([Stage("a", double, split=True), Stage("b", double, split=True)])
@@ -0,0 +1,38 @@
+import pytest
+from app.ingestion.schemas import DocumentChunk
+from app.services.utils import completion
+from app.services.utils.llm_routing import LLM_STAGE_CONFIGS, LLMStage
+
+
+def chunk(text: str) -> DocumentChunk:
+    return DocumentChunk(file_name="guide.pdf", chunk_id=0, text=text, distance=0.1)
+
+
+@pytest.fixture
+def count_words(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(completion, "count_llm_tokens", lambda text: len(text.split()))
+
+
+class TestPromptLayout:
+    def test_static_instructions_come_first(self, count_words: None) -> None:
+        first = completion.get_rag_prompt(
+            "How much ORS?", "Asked about diarrhoea.", {0: chunk("Give ORS.")}
+        )
+        second = completion.get_rag_prompt(
+            "When to vaccinate?", "Asked about vaccines.", {0: chunk("At 6 weeks.")}
+        )
+
+        # The system prompt is shared, and what changes is in the user message
+        assert first.system_prompt == second.system_prompt
+        assert "Give ORS." not in first.system_prompt
+        assert "Asked about diarrhoea." in first.user_message
+        assert first.user_message.rstrip().endswith("How much ORS?")
+
+    def test_ollama_calls_keep_the_model_loaded(self) -> None:
+        config = LLM_STAGE_CONFIGS[LLMStage.ANSWER]
+
+        params = completion._get_completion_params(
+            "hi", "system", "ollama/llama3.2:1b", config
+        )
+
+        assert params["keep_alive"] == completion.LLM_KEEP_ALIVE
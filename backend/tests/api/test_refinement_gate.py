@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import pytest
+from app.chat.config import N_RECENT_TURNS
+from app.chat.schemas import ChatContext, ChatResponse, ChatUserMessage
+from app.services.utils.refinement_gate import needs_refinement
+
+
+def turns(n: int) -> list:
+    now = datetime.utcnow()
+    messages: list = []
+    for i in range(1, n + 1):
+        messages.append(
+            ChatUserMessage(
+                chat_id="chat",
+                user_id=1,
+                message="How do I treat diarrhoea in children?",
+                request_id=i,
+                created_datetime_utc=now,
+            )
+        )
+        messages.append(
+            ChatResponse(
+                chat_id="chat",
+                response="Give ORS and zinc.",
+                request_id=i,
+                response_id=i,
+                created_datetime_utc=now,
+            )
+        )
+    return messages
+
+
+class TestRefinementGate:
+    @pytest.mark.parametrize(
+        "message, reason",
+        [
+            ("What is the dose of ORS for a 2 year old?", "self_contained"),
+            ("How often should I give it?", "reference"),
+            ("And for adults?", "short"),
+            ("What about children under five years old?", "continuation"),
+            ("Are those safe during pregnancy?", "reference"),
+            ("Why?", "short"),
+        ],
+    )
+    def test_decision(self, message: str, reason: str) -> None:
+        decision = needs_refinement(message, ChatContext(new_turns=turns(1)))
+
+        assert decision.reason == reason
+        assert decision.refine == (reason != "self_contained")
+
+    def test_no_history(self) -> None:
+        decision = needs_refinement("How often should I give it?", ChatContext())
+
+        assert not decision.refine
+        assert decision.reason == "no_history"
+
+    def test_summary_backlog_is_refined(self) -> None:
+        context = ChatContext(new_turns=turns(N_RECENT_TURNS))
+
+        decision = needs_refinement(
+            "What is the dose of ORS for a 2 year old?", context
+        )
+
+        assert decision.refine
+        assert decision.reason == "summary_backlog"
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+from app.services.utils.stage_graph import StageGraph
+
+
+async def slow(value: int) -> int:
+    await asyncio.sleep(0.05)
+    return value
+
+
+class TestStageGraph:
+    async def test_dependencies_are_passed_by_name(self) -> None:
+        async def add(a: int, b: int) -> int:
+            return a + b
+
+        graph = StageGraph()
+        graph.add("a", lambda: slow(1))
+        graph.add("b", lambda: slow(2))
+        graph.add("sum", add, depends_on=["a", "b"])
+        results = await graph.run()
+
+        assert results == {"a": 1, "b": 2, "sum": 3}
+
+    async def test_independent_stages_overlap(self) -> None:
+        graph = StageGraph()
+        for name in ["a", "b", "c"]:
+            graph.add(name, lambda: slow(0))
+        await graph.run()
+
+        total = max(t.start + t.duration for t in graph.timings.values())
+        # 3 stages x 0.05s sequentially would take 0.15s
+        assert total < 0.12
+
+    async def test_failure_cancels_other_stages(self) -> None:
+        async def fail() -> None:
+            raise ValueError("failed")
+
+        async def never(a: int) -> None:
+            raise AssertionError("should not run")
+
+        graph = StageGraph()
+        graph.add("a", lambda: slow(1))
+        graph.add("fail", fail)
+        graph.add("never", never, depends_on=["a"])
+
+        with pytest.raises(ValueError):
+            await graph.run()
+        assert "never" not in graph.timings
+
+    def test_unknown_dependency_raises(self) -> None:
+        graph = StageGraph()
+        with pytest.raises(ValueError):
+            graph.add("a", slow, depends_on=["b"])
@@ -0,0 +1,138 @@
+import json
+
+import pytest
+from app.services.utils import completion, structured_output
+from app.services.utils.prompts import RAG
+from app.services.utils.structured_output import (
+    ParseOutcome,
+    ParseStats,
+    get_response_format,
+    parse_json_object,
+)
+
+RESPONSE = {"extracted_info": ["Drink water"], "answer": 'Drink "clean" water'}
+
+
+class TestParseJSONObject:
+    @pytest.mark.parametrize(
+        "text",
+        [
+            json.dumps(RESPONSE),
+            f"```json\n{json.dumps(RESPONSE)}\n```",
+        ],
+    )
+    def test_valid_json(self, text: str) -> None:
+        assert parse_json_object(text) == (RESPONSE, "json")
+
+    @pytest.mark.parametrize(
+        "text",
+        [
+            f"Here is the answer: {json.dumps(RESPONSE)} Hope that helps!",
+            '{"extracted_info": ["Drink water",], '
+            '"answer": "Drink \\"clean\\" water",}',
+            '{"extracted_info": ["Drink water"], "answer": "Drink \\"clean\\" water',
+        ],
+    )
+    def test_repairs_broken_json(self, text: str) -> None:
+        assert parse_json_object(text) == (RESPONSE, "repaired")
+
+    def test_truncated_after_key(self) -> None:
+        parsed, outcome = parse_json_object('{"extracted_info": ["a"], "answer":')
+
+        assert parsed == {"extracted_info": ["a"], "answer": None}
+        assert outcome == "repaired"
+
+    def test_no_json(self) -> None:
+        assert parse_json_object("Drink clean water.") == (None, "failed")
+
+
+class TestParseRAGResponse:
+    @pytest.mark.parametrize(
+        "text, answer, outcome",
+        [
+            (json.dumps(RESPONSE), RESPONSE["answer"], "json"),
+            ('{"answer": "Rest", "extracted_info": "x"}', "Rest", "repaired"),
+            (
+                '{"answer": "Rest and drink", "extracted_info": [',
+                "Rest and drink",
+                "repaired",
+            ),
+            ('{"answer": "Rest \\u00e9", "extracted_info": [}}', "Rest é", "extracted"),
+            ("Rest and drink water.", "Rest and drink water.", "prose"),
+            ('{"extracted_info": ["a"]}', RAG.RAG_FAILURE_MESSAGE, "failed"),
+        ],
+    )
+    def test_answer_is_recovered(
+        self,
+        monkeypatch: pytest.MonkeyPatch,
+        text: str,
+        answer: str,
+        outcome: str,
+    ) -> None:
+        parse_stats = ParseStats()
+        monkeypatch.setattr(completion, "get_parse_stats", lambda: parse_stats)
+
+        response = completion.parse_rag_response(text, "model")
+
+        assert response.answer == answer
+        assert parse_stats.stats()["model"].outcomes == {outcome: 1}
+
+
+class TestSummaryAndRefinedMessage:
+    async def test_unparseable_response_keeps_summary(
+        self, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        async def ask_llm(*args: str, **kwargs: object) -> str:
+            return "Sorry, I cannot help with that."
+
+        monkeypatch.setattr(completion, "_ask_llm_async", ask_llm)
+        monkeypatch.setattr(completion, "get_parse_stats", ParseStats)
+
+        refined = await completion.get_summary_and_refined_message(
+            "User asked about malaria.", [], "What about its symptoms?"
+        )
+
+        assert refined is None
+
+
+class TestParseStats:
+    def test_rates_per_model(self) -> None:
+        parse_stats = ParseStats()
+        outcomes: list[ParseOutcome] = ["json", "json", "repaired", "failed"]
+        for outcome in outcomes:
+            parse_stats.record("small", outcome)
+        parse_stats.record("large", "json")
+
+        stats = parse_stats.stats()
+
+        assert stats["small"].n_responses == 4
+        assert stats["small"].parse_failure_rate == 0.5
+        assert stats["small"].unrecovered_rate == 0.25
+        assert stats["large"].parse_failure_rate == 0
+
+
+class TestResponseFormat:
+    @pytest.mark.parametrize(
+        "setting, expected_type",
+        [("schema", "json_schema"), ("json", "json_object"), ("off", None)],
+    )
+    def test_setting_overrides_model_support(
+        self,
+        monkeypatch: pytest.MonkeyPatch,
+        setting: str,
+        expected_type: str | None,
+    ) -> None:
+        monkeypatch.setattr(structured_output, "LLM_STRUCTURED_OUTPUT", setting)
+        structured_output.structured_output_mode.cache_clear()
+
+        response_format = get_response_format("ollama/llama3.2:1b", RAG)
+
+        structured_output.structured_output_mode.cache_clear()
+        if expected_type is None:
+            assert response_format is None
+        else:
+            assert response_format is not None
+            assert response_format["type"] == expected_type
+        if response_format is not None and expected_type == "json_schema":
+            schema = response_format["json_schema"]["schema"]
+            assert set(schema["required"]) == {"extracted_info", "answer"}
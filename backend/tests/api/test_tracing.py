@@ -0,0 +1,122 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from app.services.utils.stage_graph import StageGraph
+from app.services.utils.tracing import (
+    InMemoryTraceExporter,
+    SlowestTraces,
+    Trace,
+    TracingMiddleware,
+    get_trace,
+    span,
+    start_trace,
+)
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+
+def finished_trace(seconds: float, started_at: datetime) -> Trace:
+    return Trace(name=f"{seconds}s", started_at=started_at, total_seconds=seconds)
+
+
+class TestSpans:
+    def test_spans_are_nested_in_the_trace(self) -> None:
+        trace = start_trace("test")
+
+        with span("outer", n=3) as attributes:
+            with span("inner"):
+                pass
+            attributes["hit"] = True
+
+        inner, outer = trace.spans
+        assert (outer.name, outer.depth, outer.attributes) == (
+            "outer",
+            0,
+            {"n": 3, "hit": True},
+        )
+        assert (inner.name, inner.depth) == ("inner", 1)
+        assert outer.start <= inner.start
+        assert inner.duration <= outer.duration
+
+        trace.finish()
+        waterfall = trace.waterfall()
+        assert waterfall[0].endswith("total")
+        assert waterfall[1].endswith("outer n=3 hit=True")
+        assert waterfall[2].endswith("  inner")
+
+    async def test_stages_are_spans(self) -> None:
+        trace = start_trace("test")
+
+        async def stage(**dependencies: None) -> None:
+            with span("query"):
+                await asyncio.sleep(0)
+
+        graph = StageGraph()
+        graph.add("a", stage)
+        graph.add("b", stage, depends_on=["a"])
+        await graph.run()
+
+        assert sorted((s.name, s.depth) for s in trace.spans) == [
+            ("a", 0),
+            ("b", 0),
+            ("query", 1),
+            ("query", 1),
+        ]
+
+    def test_failed_span_is_recorded(self) -> None:
+        trace = start_trace("test")
+
+        with pytest.raises(ValueError):
+            with span("llm"):
+                raise ValueError
+
+        assert [s.name for s in trace.spans] == ["llm"]
+
+
+class TestSlowestTraces:
+    def test_slowest_traces_are_exported_at_the_end_of_the_hour(self) -> None:
+        exporter = InMemoryTraceExporter()
+        slowest = SlowestTraces(2, exporter)
+        hour = datetime(2026, 10, 19, 9, tzinfo=timezone.utc)
+
+        for seconds in [0.5, 3.0, 0.1, 2.0]:
+            slowest.offer(finished_trace(seconds, hour))
+        assert [t.total_seconds for t in slowest.traces()] == [3.0, 2.0]
+        assert exporter.traces == []
+
+        slowest.offer(finished_trace(0.2, hour + timedelta(hours=1)))
+
+        assert [t.total_seconds for t in exporter.traces] == [3.0, 2.0]
+        assert [t.total_seconds for t in slowest.traces()] == [0.2, 3.0, 2.0]
+
+        slowest.flush()
+        assert [t.total_seconds for t in exporter.traces] == [3.0, 2.0, 0.2]
+
+
+class TestTracingMiddleware:
+    @pytest.fixture
+    def client(self) -> TestClient:
+        app = FastAPI()
+
+        @app.get("/traced")
+        async def traced() -> dict:
+            with span("work"):
+                pass
+            return {"traced": get_trace() is not None}
+
+        app.add_middleware(TracingMiddleware)
+        return TestClient(app)
+
+    def test_server_timing_with_debug_header(self, client: TestClient) -> None:
+        response = client.get("/traced", headers={"X-Debug-Trace": "1"})
+
+        assert response.json() == {"traced": True}
+        assert response.headers["server-timing"].startswith("total;dur=")
+        assert "work;dur=" in response.headers["server-timing"]
+
+    def test_no_server_timing_without_debug_header(self, client: TestClient) -> None:
+        response = client.get("/traced")
+
+        assert response.json() == {"traced": True}
+        assert "server-timing" not in response.headers